@@ -0,0 +1,202 @@
+"""
+Synthetic internal databases for the benchmarks.
+
+The default sizes are 10 databases of 1,000 tables, 100,000 actors, 1,000
+groups and 1,000,000 audit rows. Set ACL_BENCHMARK_SCALE to scale them, for
+example ACL_BENCHMARK_SCALE=0.1 for a quick run.
+"""
+
+from datasette import hookimpl
+from datasette.app import Datasette
+from datasette.database import Database
+from datasette.plugins import pm
+from datasette_acl.views.table_acls import TABLE_ACTIONS
+import asyncio
+import json
+import os
+import pytest
+import random
+
+SCALE = float(os.environ.get("ACL_BENCHMARK_SCALE") or 1)
+DATABASES = 10
+TABLES_PER_DATABASE = max(int(1000 * SCALE), 1)
+ACTORS = max(int(100_000 * SCALE), 10)
+GROUPS = max(int(1000 * SCALE), 2)
+GROUPS_PER_ACTOR = 3
+TABLES_PER_GROUP = 20
+AUDIT_ROWS = max(int(1_000_000 * SCALE), 100)
+
+
+class ValidActorsPlugin:
+    __name__ = "ValidActorsPlugin"
+
+    @hookimpl
+    def datasette_acl_valid_actors(self, datasette):
+        return [
+            {"id": "actor{}".format(i), "display": "Actor {}".format(i)}
+            for i in range(ACTORS)
+        ]
+
+
+def populate(conn):
+    rng = random.Random(0)
+    conn.executemany(
+        "insert into acl_resources (id, database, resource) values (?, ?, ?)",
+        (
+            (d * TABLES_PER_DATABASE + t + 1, "db{}".format(d), "t{}".format(t))
+            for d in range(DATABASES)
+            for t in range(TABLES_PER_DATABASE)
+        ),
+    )
+    resources = DATABASES * TABLES_PER_DATABASE
+    conn.executemany(
+        "insert or ignore into acl_groups (id, name) values (?, ?)",
+        ((g + 100, "group{}".format(g)) for g in range(GROUPS)),
+    )
+    actions = [
+        row[0]
+        for row in conn.execute(
+            "select id from acl_actions where name in (select value from json_each(?))",
+            [json.dumps(TABLE_ACTIONS)],
+        )
+    ]
+    conn.executemany(
+        "insert or ignore into acl_actor_groups (actor_id, group_id) values (?, ?)",
+        (
+            ("actor{}".format(a), rng.randrange(GROUPS) + 100)
+            for a in range(ACTORS)
+            for _ in range(GROUPS_PER_ACTOR)
+        ),
+    )
+    conn.executemany(
+        "insert or ignore into acl (group_id, resource_id, action_id) values (?, ?, ?)",
+        (
+            (g + 100, rng.randrange(resources) + 1, rng.choice(actions))
+            for g in range(GROUPS)
+            for _ in range(TABLES_PER_GROUP)
+        ),
+    )
+    conn.executemany(
+        "insert or ignore into acl (actor_id, resource_id, action_id) values (?, ?, ?)",
+        (
+            ("actor{}".format(a), rng.randrange(resources) + 1, rng.choice(actions))
+            for a in range(0, ACTORS, 10)
+        ),
+    )
+    # The actor the benchmarks check, so they measure a granted permission
+    # rather than a check that can be skipped
+    conn.execute(
+        """
+        insert or ignore into acl (actor_id, resource_id, action_id)
+        values ('actor10', 1, (select id from acl_actions where name = 'insert-row'))
+        """
+    )
+    conn.executemany(
+        """
+        insert into acl_audit (operation_by, operation, action_id, resource_id, actor_id)
+        values ('root', ?, ?, ?, ?)
+        """,
+        (
+            (
+                rng.choice(("added", "removed")),
+                rng.choice(actions),
+                # Concentrate history on the first tables
+                int(rng.paretovariate(1)) % resources + 1,
+                "actor{}".format(rng.randrange(ACTORS)),
+            )
+            for _ in range(AUDIT_ROWS)
+        ),
+    )
+    conn.executemany(
+        """
+        insert into acl_groups_audit (operation_by, operation, group_id, actor_id)
+        values ('root', ?, ?, ?)
+        """,
+        (
+            (
+                rng.choice(("added", "removed")),
+                int(rng.paretovariate(1)) % GROUPS + 100,
+                "actor{}".format(rng.randrange(ACTORS)),
+            )
+            for _ in range(AUDIT_ROWS // 10)
+        ),
+    )
+
+
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def run(loop):
+    "Run a coroutine to completion on the benchmark event loop"
+    return loop.run_until_complete
+
+
+@pytest.fixture(scope="session")
+def ds(run, tmp_path_factory):
+    datasette = Datasette(
+        internal=str(tmp_path_factory.mktemp("acl") / "internal.db"),
+        config={
+            "plugins": {
+                "datasette-acl": {
+                    "dynamic-groups": {"staff": {"is_staff": True}},
+                }
+            },
+            "permissions": {"datasette-acl": {"id": "root"}},
+        },
+    )
+    pm.register(ValidActorsPlugin(), name="benchmark-valid-actors")
+    try:
+        # The table permissions page links to the table it is for
+        db0 = datasette.add_database(
+            Database(datasette, memory_name="acl_benchmark_db0"), name="db0"
+        )
+        run(db0.execute_write("create table if not exists t0 (id integer primary key)"))
+        run(datasette.invoke_startup())
+        run(datasette.get_internal_database().execute_write_fn(populate))
+        yield datasette
+    finally:
+        pm.unregister(name="benchmark-valid-actors")
+
+
+@pytest.fixture(scope="session")
+def cookies(ds, run):
+    root = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    response = run(ds.client.get("/db0/t0/-/acl", cookies=root))
+    return dict(root, ds_csrftoken=response.cookies["ds_csrftoken"])
+
+
+def percentile(sorted_data, fraction):
+    return sorted_data[min(int(len(sorted_data) * fraction), len(sorted_data) - 1)]
+
+
+@pytest.fixture
+def bench(benchmark, run):
+    """
+    Benchmark a coroutine function, recording p50 and p99 latency in
+    milliseconds in the benchmark's extra_info
+    """
+
+    def bench(fn, setup=None, rounds=200):
+        def target():
+            return run(fn())
+
+        if setup is None:
+            result = benchmark.pedantic(target, rounds=rounds, warmup_rounds=1)
+        else:
+            result = benchmark.pedantic(
+                target, setup=lambda: run(setup()), rounds=rounds
+            )
+        if benchmark.disabled or benchmark.stats is None:
+            # With --benchmark-disable each function runs once, untimed
+            return result
+        data = sorted(benchmark.stats.stats.data)
+        benchmark.extra_info["p50_ms"] = round(percentile(data, 0.5) * 1000, 3)
+        benchmark.extra_info["p99_ms"] = round(percentile(data, 0.99) * 1000, 3)
+        return result
+
+    return bench
@@ -0,0 +1,125 @@
+from datasette_acl import allowed_table_actions, update_dynamic_groups
+from datasette_acl.index import get_permission_index
+import itertools
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+ACTOR = {"id": "actor10"}
+
+
+def test_permission_allowed_cached(ds, bench):
+    async def check():
+        return await ds.permission_allowed(ACTOR, "insert-row", ("db0", "t0"))
+
+    # actor10 is granted insert-row on db0/t0 directly
+    assert bench(check, rounds=2000)
+
+
+def test_permission_allowed_cold(ds, bench):
+    actors = ({"id": "actor{}".format(i)} for i in itertools.count())
+
+    async def setup():
+        # Evict the loaded actors and groups, but keep the Presence sets so
+        # each round times loading one actor rather than rebuilding the index
+        index = get_permission_index(ds)
+        index.actors.clear()
+        index.groups.clear()
+        index.ancestors.clear()
+
+    async def check():
+        return await ds.permission_allowed(next(actors), "insert-row", ("db0", "t0"))
+
+    bench(check, setup=setup)
+
+
+def test_permission_allowed_sql(ds, bench):
+    config = ds.config["plugins"]["datasette-acl"]
+    config["permission-index"] = False
+
+    async def check():
+        return await ds.permission_allowed(ACTOR, "insert-row", ("db0", "t0"))
+
+    try:
+        assert bench(check, rounds=1000)
+    finally:
+        del config["permission-index"]
+
+
+def test_allowed_table_actions(ds, bench):
+    async def resolve():
+        return await allowed_table_actions(ds, ACTOR, "db0")
+
+    bench(resolve, rounds=500)
+
+
+def test_update_dynamic_groups(ds, bench):
+    # Alternate between joining and leaving the staff group
+    flips = itertools.cycle([True, False])
+
+    async def sync():
+        actor = {"id": "actor20", "is_staff": next(flips)}
+        await update_dynamic_groups(ds, actor, skip_cache=True)
+
+    bench(sync)
+
+
+def test_manage_table_acls_page(ds, bench, cookies):
+    async def render():
+        response = await ds.client.get("/db0/t0/-/acl", cookies=cookies)
+        assert response.status_code == 200
+
+    bench(render, rounds=100)
+
+
+def test_manage_group_page(ds, bench, cookies):
+    async def render():
+        response = await ds.client.get("/-/acl/groups/group0", cookies=cookies)
+        assert response.status_code == 200
+
+    bench(render, rounds=100)
+
+
+def test_actor_autocomplete(ds, bench, cookies):
+    queries = itertools.cycle(["actor1", "or 99", "ctor5", "a"])
+
+    async def search():
+        response = await ds.client.get(
+            "/-/acl/actors.json?q={}".format(next(queries)), cookies=cookies
+        )
+        assert response.status_code == 200
+
+    bench(search, rounds=500)
+
+
+def test_bulk_group_edit(ds, bench, cookies):
+    # Alternately add and remove the same 1,000 actors
+    actor_ids = ["actor{}".format(i) for i in range(1000)]
+    operations = itertools.cycle(["add", "remove"])
+
+    async def edit():
+        response = await ds.client.post(
+            "/-/acl/groups/group1",
+            json={next(operations): actor_ids},
+            headers={"x-csrftoken": cookies["ds_csrftoken"]},
+            cookies=cookies,
+        )
+        assert response.status_code == 200
+
+    bench(edit, rounds=20)
+
+
+def test_table_permissions_edit(ds, bench, cookies):
+    # Grant or revoke every action for 20 groups at once
+    groups = ["group{}".format(i) for i in range(20)]
+    grant = itertools.cycle([True, False])
+
+    async def edit():
+        actions = ["insert-row", "update-row", "delete-row"] if next(grant) else []
+        data = {"csrftoken": cookies["ds_csrftoken"]}
+        for group in groups:
+            data["group_permissions_{}".format(group)] = actions
+        response = await ds.client.post("/db1/t1/-/acl", data=data, cookies=cookies)
+        assert response.status_code == 302
+
+    bench(edit, rounds=20)
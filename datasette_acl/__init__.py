@@ -2,94 +2,65 @@ from datasette import hookimpl, Permission
 from datasette.events import CreateTableEvent
 from datasette.utils import actor_matches_allow
 from datasette.plugins import pm
-from datasette_acl.utils import can_edit_permissions
-from datasette_acl.views.table_acls import manage_table_acls
-from datasette_acl.views.groups import manage_groups, manage_group
+from datasette_acl.audit import audit_retention_loop, retention_config
+from datasette_acl.cache import get_cache
+from datasette_acl.ids import get_id_maps
+from datasette_acl.index import (
+    execute_acl_write_fn,
+    get_permission_index,
+    grant_from_row,
+)
+from datasette_acl.migrations import run_migrations
+from datasette_acl.stats import get_stats
+from datasette_acl.utils import can_edit_permissions, run_in_background
+from datasette_acl.views.actors import actors_json
+from datasette_acl.views.audit import audit_export
+from datasette_acl.views.bulk import export_json, import_json
+from datasette_acl.views.stats import acl_stats
+from datasette_acl.write_queue import get_write_queue, with_audit
+from datasette_acl.views.table_acls import manage_table_acls, table_acl_audit_json
+from datasette_acl.views.groups import group_audit_json, manage_groups, manage_group
 from . import hookspecs
+import hashlib
 import json
 import sys
 import time
 
 pm.add_hookspecs(hookspecs)
 
-CREATE_TABLES_SQL = """
-create table if not exists acl_resources (
-    id integer primary key,
-    database text not null,
-    resource text,
-    unique(database, resource)
-);
-
-create table if not exists acl_actions (
-    id integer primary key,
-    name text not null unique
-);
-
--- new table for groups
-create table if not exists acl_groups (
-    id integer primary key,
-    name text not null unique,
-    deleted integer
-);
-
--- new table for actor-group relationships
-create table if not exists acl_actor_groups (
-    actor_id text,
-    group_id integer,
-    primary key (actor_id, group_id),
-    foreign key (group_id) references acl_groups(id)
-);
-
--- Group membership audit log
-create table if not exists acl_groups_audit (
-    id integer primary key,
-    timestamp text default (datetime('now')),
-    operation_by text,
-    operation text check (operation in ('added', 'removed', 'created', 'deleted')),
-    group_id integer,
-    actor_id text,
-    foreign key (group_id) references acl_groups(id)
-);
-
-create table if not exists acl (
-    acl_id integer primary key,
-    actor_id text,
-    group_id integer,
-    resource_id integer,
-    action_id integer,
-    foreign key (group_id) references acl_groups(id),
-    foreign key (resource_id) references acl_resources(id),
-    foreign key (action_id) references acl_actions(id),
-    check ((actor_id is null) != (group_id is null)),
-    unique(actor_id, group_id, resource_id, action_id)
-);
-
--- ACL audit log
-create table if not exists acl_audit (
-    id integer primary key,
-    timestamp text default (datetime('now')),
-    operation_by text,
-    operation text check (operation in ('added', 'removed')),
-    action_id integer,
-    resource_id integer,
-    group_id integer,
-    actor_id text,
-    foreign key (group_id) references acl_groups(id),
-    foreign key (resource_id) references acl_resources(id),
-    foreign key (action_id) references acl_actions(id)
-)
-"""
-
 ACL_RESOURCE_PAIR_SQL = """
-with actor_groups as (
+with direct_groups as (
   select group_id
   from acl_actor_groups
   where actor_id = :actor_id
+  and group_id not in (
+    select id from acl_groups
+    where name in (select value from json_each(:exclude_groups))
+  )
+  union
+  select id as group_id
+  from acl_groups
+  where name in (select value from json_each(:include_groups))
+),
+-- Every group containing one of those, through any depth of nesting
+actor_groups as (
+  select ancestor_id as group_id
+  from acl_group_closure
+  where descendant_id in (select group_id from direct_groups)
 ),
 target_resource as (
   select id
   from acl_resources
   where database = :database and resource = :resource
+  union all
+  select id
+  from acl_resources
+  where database = :database and resource is null and glob is null
+  union all
+  select id
+  from acl_resources
+  where database = :database and glob is not null
+  and :resource glob acl_resources.glob
 ),
 target_action as (
   select id
@@ -107,10 +78,50 @@ combined_permissions as (
 )
 select count(*)
   from combined_permissions
-  where resource_id = (select id from target_resource)
+  where resource_id in (select id from target_resource)
   and action_id = (select id from target_action)
 """
 
+ACL_DATABASE_SQL = """
+with direct_groups as (
+  select group_id
+  from acl_actor_groups
+  where actor_id = :actor_id
+  and group_id not in (
+    select id from acl_groups
+    where name in (select value from json_each(:exclude_groups))
+  )
+  union
+  select id as group_id
+  from acl_groups
+  where name in (select value from json_each(:include_groups))
+),
+actor_groups as (
+  select ancestor_id as group_id
+  from acl_group_closure
+  where descendant_id in (select group_id from direct_groups)
+),
+-- Separate lookups, so each can use the index on actor_id or group_id
+combined_permissions as (
+    select resource_id, action_id
+    from acl
+    where actor_id = :actor_id
+  union all
+    select resource_id, action_id
+    from acl
+    where group_id in (select group_id from actor_groups)
+)
+select distinct
+  acl_resources.database,
+  acl_resources.resource,
+  acl_resources.glob,
+  acl_actions.name as action_name
+from combined_permissions
+join acl_resources on combined_permissions.resource_id = acl_resources.id
+join acl_actions on combined_permissions.action_id = acl_actions.id
+where acl_resources.database = :database
+"""
+
 EXPECTED_GROUPS_SQL = """
 with expected_groups as (
   select value as group_name
@@ -145,12 +156,23 @@ select
 from actual_groups
 """
 
+DYNAMIC_GROUP_AUDIT_SQL = """
+insert into acl_groups_audit (
+    operation_by, operation, group_id, actor_id
+) values (
+    null,
+    :operation,
+    :group_id,
+    :actor_id
+)
+"""
+
 
 @hookimpl
 def startup(datasette):
     async def inner():
         db = datasette.get_internal_database()
-        await db.execute_write_script(CREATE_TABLES_SQL)
+        await run_migrations(db)
         # Ensure permissions are in the DB
         await db.execute_write_many(
             """
@@ -166,125 +188,181 @@ def startup(datasette):
                 "insert or ignore into acl_groups (name) values (:name)",
                 [{"name": name} for name in groups.keys()],
             )
+        await get_id_maps(datasette).load(db)
+        if retention_config(datasette):
+            run_in_background(audit_retention_loop(datasette))
 
     return inner
 
 
-class OneSecondCache:
-    def __init__(self):
-        self.cache = {}
+def actor_fingerprint(actor, groups):
+    """
+    Stable hash of an actor and the dynamic groups configuration - dynamic
+    group membership can only change if this changes
+    """
+    return hashlib.sha256(
+        json.dumps([actor, groups], sort_keys=True, default=repr).encode("utf-8")
+    ).hexdigest()
+
+
+def matching_dynamic_groups(datasette, actor, groups):
+    """
+    Names of the dynamic groups whose allow blocks match this actor, cached
+    against the actor's fingerprint
+    """
+    cache = get_cache(datasette, "dynamic-group-matches")
+    fingerprint = actor_fingerprint(actor, groups)
+    cached = cache.get(actor["id"])
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+    matches = set(
+        group_name
+        for group_name, allow_block in groups.items()
+        if actor_matches_allow(actor, allow_block)
+    )
+    cache.set(actor["id"], (fingerprint, matches))
+    return matches
 
-    def set(self, key, value):
-        self.cache[key] = (value, time.monotonic() + 1)
 
-    def get(self, key):
-        if key in self.cache:
-            value, expiration_time = self.cache[key]
-            if time.monotonic() < expiration_time:
-                return value
-            else:
-                del self.cache[key]
-        return None
+async def resolve_dynamic_groups(datasette, actor):
+    """
+    Bring dynamic group membership up to date for a permission check.
+
+    Returns (exclude_groups, include_groups) - sets of group names to remove
+    from and add to the actor's stored memberships. In the default "stored"
+    mode memberships are written to acl_actor_groups and both sets are empty.
+    In "virtual" and "virtual-audited" modes nothing is written here and the
+    membership is computed from the actor instead.
+    """
+    config = datasette.plugin_config("datasette-acl") or {}
+    groups = config.get("dynamic-groups")
+    mode = config.get("dynamic-groups-mode") or "stored"
+    skip_cache = hasattr(sys, "_pytest_running")
+    if not groups or mode == "stored":
+        await update_dynamic_groups(datasette, actor, skip_cache=skip_cache)
+        return set(), set()
+    if mode == "virtual-audited" and (
+        skip_cache or not dynamic_groups_synced(datasette, actor, groups)
+    ):
+        # Record membership changes without holding up this check
+        run_in_background(
+            update_dynamic_groups(datasette, actor, skip_cache=skip_cache, queued=True)
+        )
+    return set(groups), matching_dynamic_groups(datasette, actor, groups)
 
-    def clear_expired(self):
-        current_time = time.monotonic()
-        self.cache = {k: v for k, v in self.cache.items() if v[1] > current_time}
+
+def _synced_cache(datasette):
+    config = datasette.plugin_config("datasette-acl") or {}
+    return get_cache(
+        datasette, "dynamic-groups", ttl=config.get("dynamic-groups-cache-ttl")
+    )
 
 
-one_second_cache = OneSecondCache()
+def dynamic_groups_synced(datasette, actor, groups):
+    "Has this actor's stored membership been synced since they last changed?"
+    synced = _synced_cache(datasette).get(actor["id"])
+    return synced == actor_fingerprint(actor, groups)
 
 
-async def update_dynamic_groups(datasette, actor, skip_cache=False):
+async def update_dynamic_groups(datasette, actor, skip_cache=False, queued=False):
+    """
+    Write any changes to this actor's dynamic group memberships, with audit
+    rows. If queued is true the changes are batched with others using the
+    write queue.
+    """
     if not actor or not actor.get("id"):
         return
-    if (not skip_cache) and one_second_cache.get(actor["id"]):
-        # Don't do this more than once a second per actor
-        return
-    one_second_cache.set(actor["id"], 1)
     config = datasette.plugin_config("datasette-acl") or {}
     groups = config.get("dynamic-groups")
     if not groups:
         return
+    stats = get_stats(datasette)
+    if (not skip_cache) and dynamic_groups_synced(datasette, actor, groups):
+        # Nothing about this actor or the dynamic groups has changed
+        stats.increment("dynamic_group_syncs_total", result="cached")
+        return
     # Figure out the groups the user should be in
-    should_have_groups = set(
-        group_name
-        for group_name, allow_block in groups.items()
-        if actor_matches_allow(actor, allow_block)
-    )
+    should_have_groups = matching_dynamic_groups(datasette, actor, groups)
+    params = {
+        "actor_id": actor["id"],
+        "expected_groups_json": json.dumps(list(should_have_groups)),
+        "dynamic_groups": json.dumps(list(groups.keys())),
+    }
     db = datasette.get_internal_database()
-    result = await db.execute(
-        EXPECTED_GROUPS_SQL,
-        {
-            "actor_id": actor["id"],
-            "expected_groups_json": json.dumps(list(should_have_groups)),
-            "dynamic_groups": json.dumps(list(groups.keys())),
-        },
+    id_maps = get_id_maps(datasette)
+    should_add, should_remove = _group_changes(
+        (await db.execute(EXPECTED_GROUPS_SQL, params)).rows
     )
-    should_add = []
-    should_remove = []
-    for row in result.rows:
-        if row["status"] == "should-add":
-            should_add.append(row["group_name"])
-        elif row["status"] == "should-remove":
-            should_remove.append(row["group_name"])
-    # Add/remove groups as needed
-    for group_name in should_add:
-        # Make sure the group exists
-        await db.execute_write(
-            "insert or ignore into acl_groups (name) VALUES (:name);",
-            {"name": group_name},
+    if not should_add and not should_remove:
+        stats.increment("dynamic_group_syncs_total", result="unchanged")
+        _synced_cache(datasette).set(actor["id"], actor_fingerprint(actor, groups))
+        return
+
+    def apply_changes(conn):
+        # Diff again inside the transaction in case another check got here first
+        should_add, should_remove = _group_changes(
+            conn.execute(EXPECTED_GROUPS_SQL, params).fetchall()
         )
-        await db.execute_write(
+        # Creating any groups that do not exist yet
+        group_ids = id_maps.ensure_group_ids(conn, should_add + should_remove)
+        added = [
+            {"actor_id": actor["id"], "group_id": group_ids[g]} for g in should_add
+        ]
+        removed = [
+            {"actor_id": actor["id"], "group_id": group_ids[g]} for g in should_remove
+        ]
+        conn.executemany(
             """
             insert into acl_actor_groups (
                 actor_id, group_id
             ) values (
                 :actor_id,
-                (select id from acl_groups where name = :group_name)
+                :group_id
             )""",
-            {"actor_id": actor["id"], "group_name": group_name},
-        )
-        await db.execute_write(
-            """
-            insert into acl_groups_audit (
-                operation_by, operation, group_id, actor_id
-            ) values (
-                null,
-                'added',
-                (select id from acl_groups where name = :group_name),
-                :actor_id
-            )
-        """,
-            {
-                "group_name": group_name,
-                "actor_id": actor["id"],
-            },
+            added,
         )
-    for group_name in should_remove:
-        await db.execute_write(
+        conn.executemany(
             """
             delete from acl_actor_groups
             where actor_id = :actor_id
-            and group_id = (select id from acl_groups where name = :group_name)
+            and group_id = :group_id
             """,
-            {"actor_id": actor["id"], "group_name": group_name},
+            removed,
         )
-        await db.execute_write(
-            """
-            insert into acl_groups_audit (
-                operation_by, operation, group_id, actor_id
-            ) values (
-                null,
-                'removed',
-                (select id from acl_groups where name = :group_name),
-                :actor_id
-            )
-        """,
-            {
-                "group_name": group_name,
-                "actor_id": actor["id"],
-            },
+        audit_rows = [
+            (DYNAMIC_GROUP_AUDIT_SQL, dict(row, operation="added")) for row in added
+        ] + [
+            (DYNAMIC_GROUP_AUDIT_SQL, dict(row, operation="removed")) for row in removed
+        ]
+        return (should_add, should_remove, group_ids), audit_rows
+
+    if queued:
+        should_add, should_remove, group_ids = await get_write_queue(datasette).submit(
+            apply_changes
+        )
+    else:
+        should_add, should_remove, group_ids = await execute_acl_write_fn(
+            datasette, with_audit(apply_changes), source="dynamic_groups"
         )
+    id_maps.groups.update(group_ids)
+    stats.increment("dynamic_group_syncs_total", result="changed")
+    _synced_cache(datasette).set(actor["id"], actor_fingerprint(actor, groups))
+    index = get_permission_index(datasette)
+    for group_name in should_add:
+        index.member_added(actor["id"], group_name)
+    for group_name in should_remove:
+        index.member_removed(actor["id"], group_name)
+
+
+def _group_changes(rows):
+    should_add = []
+    should_remove = []
+    for row in rows:
+        if row["status"] == "should-add":
+            should_add.append(row["group_name"])
+        elif row["status"] == "should-remove":
+            should_remove.append(row["group_name"])
+    return should_add, should_remove
 
 
 @hookimpl
@@ -295,22 +373,137 @@ def permission_allowed(datasette, actor, action, resource):
     async def inner():
         if not actor or not actor.get("id"):
             return None
-        await update_dynamic_groups(
-            datasette, actor, skip_cache=hasattr(sys, "_pytest_running")
-        )
+        start = time.perf_counter()
         db = datasette.get_internal_database()
+        config = datasette.plugin_config("datasette-acl") or {}
+        if not await has_acl_state(datasette, actor, resource[0], resource[1]):
+            # Nobody has permissions on this table, or this actor has none
+            path = "short_circuit"
+            allowed = False
+        else:
+            exclude_groups, include_groups = await resolve_dynamic_groups(
+                datasette, actor
+            )
+            if config.get("permission-index", True):
+                index = get_permission_index(datasette)
+                # Was the actor already in the index, or loaded from the database?
+                path = "index_hit" if actor["id"] in index.actors else "index_load"
+                allowed = await index.allowed(
+                    db,
+                    actor["id"],
+                    resource[0],
+                    resource[1],
+                    action,
+                    exclude_groups=exclude_groups,
+                    include_groups=include_groups,
+                )
+            else:
+                path = "sql"
+                allowed = await _allowed_sql(
+                    db, actor, action, resource, exclude_groups, include_groups
+                )
+        stats = get_stats(datasette)
+        stats.observe(
+            "permission_check_seconds", time.perf_counter() - start, path=path
+        )
+        stats.increment(
+            "permission_checks_total", path=path, allowed=str(bool(allowed)).lower()
+        )
+        return allowed or None
+
+    return inner
+
+
+async def has_acl_state(datasette, actor, database, table=None) -> bool:
+    """
+    Could any grant apply to this actor, and to this table if one is given?
+    If not the check can be answered without resolving dynamic groups or
+    querying the ACL tables.
+    """
+    index = get_permission_index(datasette)
+    presence = await index.get_presence(datasette.get_internal_database())
+    if table is not None and not presence.covers(database, table):
+        return False
+    if actor["id"] in presence.actors:
+        return True
+    config = datasette.plugin_config("datasette-acl") or {}
+    groups = config.get("dynamic-groups")
+    return bool(groups) and bool(matching_dynamic_groups(datasette, actor, groups))
+
+
+async def _allowed_sql(db, actor, action, resource, exclude_groups, include_groups):
+    result = await db.execute(
+        ACL_RESOURCE_PAIR_SQL,
+        {
+            "actor_id": actor["id"],
+            "database": resource[0],
+            "resource": resource[1],
+            "action": action,
+            "exclude_groups": json.dumps(list(exclude_groups)),
+            "include_groups": json.dumps(list(include_groups)),
+        },
+    )
+    return result.single_value()
+
+
+async def allowed_table_actions(datasette, actor, database, actions=None):
+    """
+    Resolve permissions for every table in a database at once.
+
+    Returns a dictionary mapping table names to the set of actions the actor
+    has been granted on that table, optionally limited to the given actions.
+    Tables with no grants for this actor are omitted.
+    """
+    if not actor or not actor.get("id"):
+        return {}
+    if not await has_acl_state(datasette, actor, database):
+        return {}
+    exclude_groups, include_groups = await resolve_dynamic_groups(datasette, actor)
+    db = datasette.get_internal_database()
+    config = datasette.plugin_config("datasette-acl") or {}
+    if config.get("permission-index", True):
+        grants = await get_permission_index(datasette).actor_grants(
+            db,
+            actor["id"],
+            exclude_groups=exclude_groups,
+            include_groups=include_groups,
+        )
+    else:
         result = await db.execute(
-            ACL_RESOURCE_PAIR_SQL,
+            ACL_DATABASE_SQL,
             {
                 "actor_id": actor["id"],
-                "database": resource[0],
-                "resource": resource[1],
-                "action": action,
+                "database": database,
+                "exclude_groups": json.dumps(list(exclude_groups)),
+                "include_groups": json.dumps(list(include_groups)),
             },
         )
-        return result.single_value() or None
-
-    return inner
+        grants = {grant_from_row(row) for row in result}
+    tables = {}
+    table_names = None
+    for grant_database, resource, action in grants:
+        if grant_database != database:
+            continue
+        if actions is not None and action not in actions:
+            continue
+        if isinstance(resource, str):
+            tables.setdefault(resource, set()).add(action)
+            continue
+        # Database and glob grants apply to the tables that exist right now
+        if table_names is None:
+            table_names = await _table_names(datasette, database)
+        for table in table_names:
+            if resource is None or resource.matches(table):
+                tables.setdefault(table, set()).add(action)
+    return tables
+
+
+async def _table_names(datasette, database):
+    try:
+        db = datasette.get_database(database)
+    except KeyError:
+        return []
+    return await db.table_names()
 
 
 @hookimpl
@@ -342,6 +535,21 @@ def table_actions(datasette, actor, database, table):
     return inner
 
 
+@hookimpl
+def database_actions(datasette, actor, database):
+    async def inner():
+        if await can_edit_permissions(datasette, actor):
+            return [
+                {
+                    "href": datasette.urls.database(database) + "/-/acl",
+                    "label": "Manage database permissions",
+                    "description": "Grant permissions on every table, or tables matching a pattern",
+                }
+            ]
+
+    return inner
+
+
 @hookimpl
 def track_event(datasette, event):
     async def inner():
@@ -354,40 +562,68 @@ def track_event(datasette, event):
             return
         # Add ACLs for the user who created the table
         db = datasette.get_internal_database()
-        # Ensure resource exists for table
-        await db.execute_write(
-            "INSERT OR IGNORE INTO acl_resources (database, resource) VALUES (?, ?);",
-            [event.database, event.table],
-        )
-        resource_id = (
-            await db.execute(
-                "SELECT id FROM acl_resources WHERE database = ? AND resource = ?",
-                [event.database, event.table],
+        id_maps = get_id_maps(datasette)
+        resource_key = (event.database, event.table, None)
+        action_ids = [
+            await id_maps.action_id(db, action_name)
+            for action_name in config["table-creator-permissions"]
+        ]
+
+        def add_acls(conn):
+            # Ensure resource exists for table
+            resource_id = id_maps.ensure_resource_id(conn, resource_key)
+            conn.executemany(
+                """
+                INSERT INTO acl (actor_id, group_id, resource_id, action_id)
+                VALUES (:actor_id, null, :resource_id, :action_id)
+                """,
+                [
+                    {
+                        "actor_id": event.actor["id"],
+                        "action_id": action_id,
+                        "resource_id": resource_id,
+                    }
+                    for action_id in action_ids
+                ],
             )
-        ).single_value()
-        await db.execute_write_many(
-            """
-            INSERT INTO acl (actor_id, group_id, resource_id, action_id)
-            VALUES (
-                :actor_id,
-                null,
-                :resource_id,
-                (SELECT id FROM acl_actions WHERE name = :action_name)
-            )
-            """,
-            [
-                {
-                    "actor_id": event.actor["id"],
-                    "action_name": action_name,
-                    "resource_id": resource_id,
-                }
-                for action_name in config["table-creator-permissions"]
-            ],
+            return resource_id
+
+        id_maps.resources[resource_key] = await execute_acl_write_fn(
+            datasette, add_acls, source="track_event"
         )
+        index = get_permission_index(datasette)
+        for action_name in config["table-creator-permissions"]:
+            index.grant_added(
+                actor_id=event.actor["id"],
+                database=event.database,
+                resource=event.table,
+                action=action_name,
+            )
 
     return inner
 
 
+@hookimpl
+def asgi_wrapper(datasette):
+    def wrap(app):
+        async def flush_on_shutdown(scope, receive, send):
+            if scope["type"] != "lifespan":
+                return await app(scope, receive, send)
+
+            async def receive_and_flush():
+                message = await receive()
+                if message["type"] == "lifespan.shutdown":
+                    # Write anything still waiting in the write queue
+                    await get_write_queue(datasette).close()
+                return message
+
+            await app(scope, receive_and_flush, send)
+
+        return flush_on_shutdown
+
+    return wrap
+
+
 @hookimpl
 def menu_links(datasette, actor):
     async def inner():
@@ -406,6 +642,22 @@ def menu_links(datasette, actor):
 def register_routes():
     return [
         ("^/(?P<database>[^/]+)/(?P<table>[^/]+)/-/acl$", manage_table_acls),
+        (
+            "^/(?P<database>[^/]+)/(?P<table>[^/]+)/-/acl/audit\\.json$",
+            table_acl_audit_json,
+        ),
+        # Database pages use the same views, with ?glob= for table patterns
+        ("^/(?P<database>[^/]+)/-/acl$", manage_table_acls),
+        ("^/(?P<database>[^/]+)/-/acl/audit\\.json$", table_acl_audit_json),
         ("^/-/acl/groups$", manage_groups),
         ("^/-/acl/groups/(?P<name>[^/]+)$", manage_group),
+        ("^/-/acl/groups/(?P<name>[^/]+)/audit\\.json$", group_audit_json),
+        ("^/-/acl/actors\\.json$", actors_json),
+        ("^/-/acl/export\\.json$", export_json),
+        ("^/-/acl/import\\.json$", import_json),
+        (
+            "^/-/acl/(?P<log>audit|groups-audit)\\.(?P<format>ndjson|csv)$",
+            audit_export,
+        ),
+        ("^/-/acl/stats(?P<format>\\.json|\\.txt)?$", acl_stats),
     ]
@@ -0,0 +1,60 @@
+from bisect import bisect_left
+from typing import Dict, List, Set, Tuple
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class ActorSearchIndex:
+    """
+    Case-insensitive search over actor IDs and display names.
+
+    Prefix matches come from a sorted list of terms using bisect, then
+    substring matches from a trigram index. Queries shorter than three
+    characters fall back to scanning every actor for substring matches.
+    """
+
+    def __init__(self, actors: Dict[str, str]):
+        self.actors: List[Tuple[str, str]] = list(actors.items())
+        self.terms: List[Tuple[str, int]] = []
+        self.trigrams: Dict[str, Set[int]] = {}
+        for position, (actor_id, display) in enumerate(self.actors):
+            for term in {actor_id.lower(), display.lower()}:
+                self.terms.append((term, position))
+                for trigram in trigrams(term):
+                    self.trigrams.setdefault(trigram, set()).add(position)
+        self.terms.sort()
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, str]]:
+        query = query.strip().lower()
+        if not query:
+            return self.actors[:limit]
+        # Prefix matches first, in alphabetical order
+        positions = {}
+        start = bisect_left(self.terms, (query,))
+        for term, position in self.terms[start:]:
+            if len(positions) >= limit or not term.startswith(query):
+                break
+            positions.setdefault(position, None)
+        # Then other substring matches, in their original order
+        if len(positions) < limit:
+            for position in sorted(self._substring_candidates(query)):
+                if len(positions) >= limit:
+                    break
+                if position in positions:
+                    continue
+                actor_id, display = self.actors[position]
+                if query in actor_id.lower() or query in display.lower():
+                    positions[position] = None
+        return [self.actors[position] for position in positions]
+
+    def _substring_candidates(self, query: str):
+        if len(query) < 3:
+            return range(len(self.actors))
+        # Actors containing every trigram of the query, smallest set first
+        sets = sorted(
+            (self.trigrams.get(trigram, set()) for trigram in trigrams(query)),
+            key=len,
+        )
+        return set.intersection(*sets)
@@ -0,0 +1,305 @@
+from datasette.utils import path_with_replaced_args
+from datasette_acl.migrations import split_statements
+from datasette_acl.utils import log
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import json
+import weakref
+
+AUDIT_PAGE_SIZE = 50
+MAX_AUDIT_PAGE_SIZE = 1000
+# Larger than any id, for the first page
+MAX_ID = 2**63 - 1
+
+
+def audit_page_args(request) -> Tuple[int, int]:
+    """
+    The (next, size) keyset pagination arguments for an audit log page,
+    from the ?_next= and ?_size= query string parameters
+    """
+    try:
+        next_id = int(request.args.get("_next") or MAX_ID)
+    except ValueError:
+        next_id = MAX_ID
+    try:
+        size = int(request.args.get("_size") or AUDIT_PAGE_SIZE)
+    except ValueError:
+        size = AUDIT_PAGE_SIZE
+    return next_id, max(1, min(size, MAX_AUDIT_PAGE_SIZE))
+
+
+async def fetch_audit_page(db, sql, params) -> Tuple[List[dict], Optional[int]]:
+    """
+    Run an audit log query that filters on "id < :next", orders by
+    "id desc" and uses "limit :size + 1", returning the rows for this page
+    and the _next value for the following page, or None if it is the last
+    """
+    rows = [dict(row) for row in await db.execute(sql, params)]
+    size = params["size"]
+    if len(rows) > size:
+        return rows[:size], rows[size - 1]["id"]
+    return rows, None
+
+
+def audit_json(request, audit_log, audit_next) -> dict:
+    return {
+        "audit_log": audit_log,
+        "next": audit_next,
+        "next_url": (
+            path_with_replaced_args(request, {"_next": audit_next})
+            if audit_next is not None
+            else None
+        ),
+    }
+
+
+DEFAULT_RETENTION_BATCH_SIZE = 1000
+DEFAULT_RETENTION_INTERVAL = 3600
+
+# Archived rows store names rather than ids, so they still make sense
+# after the groups, resources and actions they refer to are changed. Ids in
+# the live tables can be reused once retention has emptied them, so the
+# archive has its own id and keeps the original as source_id.
+CREATE_ARCHIVE_SQL = """
+create table if not exists acl_archive.acl_audit (
+    id integer primary key,
+    source_id integer,
+    timestamp text,
+    operation_by text,
+    operation text,
+    database_name text,
+    resource_name text,
+    group_name text,
+    actor_id text,
+    action_name text
+);
+create table if not exists acl_archive.acl_groups_audit (
+    id integer primary key,
+    source_id integer,
+    timestamp text,
+    operation_by text,
+    operation text,
+    group_name text,
+    actor_id text,
+    member_group_name text
+);
+"""
+
+# Columns missing from archives created by earlier versions, with the
+# statements that add them
+UPGRADE_ARCHIVE_SQL = {
+    # Before groups could contain groups
+    ("acl_groups_audit", "member_group_name"): """
+        alter table acl_archive.acl_groups_audit add column member_group_name text
+    """,
+    # Before archives had their own ids - the id was the original id
+    ("acl_audit", "source_id"): """
+        alter table acl_archive.acl_audit add column source_id integer;
+        update acl_archive.acl_audit set source_id = id;
+    """,
+    ("acl_groups_audit", "source_id"): """
+        alter table acl_archive.acl_groups_audit add column source_id integer;
+        update acl_archive.acl_groups_audit set source_id = id;
+    """,
+}
+
+ARCHIVE_SQL = {
+    "acl_audit": """
+        insert into acl_archive.acl_audit (
+            source_id,
+            timestamp,
+            operation_by,
+            operation,
+            database_name,
+            resource_name,
+            group_name,
+            actor_id,
+            action_name
+        )
+        select
+            acl_audit.id,
+            acl_audit.timestamp,
+            acl_audit.operation_by,
+            acl_audit.operation,
+            acl_resources.database,
+            acl_resources.resource,
+            acl_groups.name,
+            acl_audit.actor_id,
+            acl_actions.name
+        from main.acl_audit
+        left join main.acl_resources on acl_audit.resource_id = acl_resources.id
+        left join main.acl_groups on acl_audit.group_id = acl_groups.id
+        left join main.acl_actions on acl_audit.action_id = acl_actions.id
+        where acl_audit.id in (select value from json_each(:ids))
+    """,
+    "acl_groups_audit": """
+        insert into acl_archive.acl_groups_audit (
+            source_id,
+            timestamp,
+            operation_by,
+            operation,
+            group_name,
+            actor_id,
+            member_group_name
+        )
+        select
+            acl_groups_audit.id,
+            acl_groups_audit.timestamp,
+            acl_groups_audit.operation_by,
+            acl_groups_audit.operation,
+            acl_groups.name,
+            acl_groups_audit.actor_id,
+            member_groups.name
+        from main.acl_groups_audit
+        left join main.acl_groups on acl_groups_audit.group_id = acl_groups.id
+        left join main.acl_groups member_groups
+            on acl_groups_audit.member_group_id = member_groups.id
+        where acl_groups_audit.id in (select value from json_each(:ids))
+    """,
+}
+
+
+def retention_config(datasette) -> Optional[dict]:
+    config = datasette.plugin_config("datasette-acl") or {}
+    return config.get("audit-retention")
+
+
+def _expired_ids(conn, table, cutoff, over_id, batch_size) -> List[int]:
+    # Rows are archived oldest first, so only the oldest batch_size rows
+    # need to be checked - if they are not all expired the rest are not
+    return [
+        row[0]
+        for row in conn.execute(
+            f"""
+            select id from main.{table}
+            where id in (select id from main.{table} order by id limit :batch_size)
+            and (timestamp < :cutoff or id <= :over_id)
+            """,
+            {"batch_size": batch_size, "cutoff": cutoff, "over_id": over_id},
+        )
+    ]
+
+
+def _create_archive(conn):
+    for statement in split_statements(CREATE_ARCHIVE_SQL):
+        conn.execute(statement)
+    for (table, column), sql in UPGRADE_ARCHIVE_SQL.items():
+        columns = {
+            row[1] for row in conn.execute(f"pragma acl_archive.table_info({table})")
+        }
+        if column not in columns:
+            for statement in split_statements(sql):
+                conn.execute(statement)
+
+
+def _archive_batch(conn, table, archive, cutoff, over_id, batch_size) -> int:
+    "Move one batch of expired rows to the archive in a single transaction"
+    if archive:
+        conn.execute("attach database ? as acl_archive", [archive])
+    try:
+        conn.execute("begin immediate")
+        try:
+            ids = _expired_ids(conn, table, cutoff, over_id, batch_size)
+            if ids:
+                if archive:
+                    _create_archive(conn)
+                    conn.execute(ARCHIVE_SQL[table], {"ids": json.dumps(ids)})
+                conn.execute(
+                    f"delete from main.{table} where id in (select value from json_each(?))",
+                    [json.dumps(ids)],
+                )
+            conn.execute("commit")
+        except Exception:
+            conn.execute("rollback")
+            raise
+    finally:
+        if archive:
+            conn.execute("detach database acl_archive")
+    return len(ids)
+
+
+def _vacuum(conn, full) -> bool:
+    "Free the space used by deleted rows, returning False if it was not freed"
+    # 2 is incremental, see https://www.sqlite.org/pragma.html#pragma_auto_vacuum
+    # - without it incremental_vacuum does nothing
+    if conn.execute("pragma auto_vacuum").fetchone()[0] == 2:
+        conn.execute("pragma incremental_vacuum").fetchall()
+    elif full:
+        conn.execute("vacuum")
+    else:
+        return False
+    return True
+
+
+# Instances that have been told their space is not being freed
+_vacuum_warned = weakref.WeakSet()
+
+
+async def archive_audit_logs(datasette) -> Dict[str, int]:
+    """
+    Apply the audit-retention settings, moving audit log rows that are
+    older than max-age-days or beyond the most recent max-rows to the
+    archive database (or deleting them if no archive is configured), then
+    reclaiming the space they used. Returns the number of rows moved from
+    each table.
+    """
+    config = retention_config(datasette) or {}
+    db = datasette.get_internal_database()
+    batch_size = config.get("batch-size", DEFAULT_RETENTION_BATCH_SIZE)
+    archive = config.get("archive")
+    max_age_days = config.get("max-age-days")
+    max_rows = config.get("max-rows")
+    cutoff = ""
+    if max_age_days is not None:
+        cutoff = (
+            await db.execute(
+                "select datetime('now', :age)",
+                {"age": "-{} days".format(max_age_days)},
+            )
+        ).single_value()
+    moved = {}
+    for table in ARCHIVE_SQL:
+        over_id = 0
+        if max_rows is not None:
+            row = (
+                await db.execute(
+                    f"select id from {table} order by id desc limit 1 offset ?",
+                    [max_rows],
+                )
+            ).first()
+            over_id = row[0] if row else 0
+        moved[table] = 0
+        while True:
+            count = await db.execute_write_fn(
+                lambda conn: _archive_batch(
+                    conn, table, archive, cutoff, over_id, batch_size
+                ),
+                transaction=False,
+            )
+            moved[table] += count
+            if count < batch_size:
+                break
+    if any(moved.values()):
+        vacuumed = await db.execute_write_fn(
+            lambda conn: _vacuum(conn, config.get("vacuum", False)),
+            transaction=False,
+        )
+        if not vacuumed and datasette not in _vacuum_warned:
+            _vacuum_warned.add(datasette)
+            log(
+                "audit retention cannot free space as the internal database "
+                "does not use incremental auto-vacuum - see the README, or set "
+                "vacuum: true"
+            )
+    return moved
+
+
+async def audit_retention_loop(datasette):
+    "Run archive_audit_logs() every interval seconds"
+    while True:
+        try:
+            await archive_audit_logs(datasette)
+        except Exception as ex:
+            log("audit retention failed: {!r}".format(ex))
+        config = retention_config(datasette) or {}
+        await asyncio.sleep(config.get("interval", DEFAULT_RETENTION_INTERVAL))
@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+import time
+import weakref
+
+DEFAULT_CACHE_SIZE = 10000
+
+_missing = object()
+
+
+class LRUCache:
+    """
+    Dictionary-like cache holding at most maxsize items, evicting the least
+    recently used item when full. If ttl is set, items expire that many
+    seconds after they were stored.
+
+    Hits, misses and evictions are counted for reporting.
+    """
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (value, expires_at or None)
+        self._items: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._items.get(key, _missing)
+        if item is not _missing:
+            value, expires_at = item
+            if expires_at is None or time.monotonic() < expires_at:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._items[key]
+        self.misses += 1
+        return default
+
+    def peek(self, key, default=None):
+        "Like get() but without counting a hit or miss or updating recency"
+        item = self._items.get(key, _missing)
+        if item is _missing or (item[1] is not None and time.monotonic() >= item[1]):
+            return default
+        return item[0]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, _missing)
+        return default if item is _missing else item[0]
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __contains__(self, key):
+        return self.peek(key, _missing) is not _missing
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return len(self._items)
+
+
+_instance_caches = weakref.WeakKeyDictionary()
+
+
+def get_caches(datasette) -> Dict[str, LRUCache]:
+    "All of the named caches created so far for this Datasette instance"
+    return dict(_instance_caches.get(datasette, {}))
+
+
+def get_cache(datasette, name, ttl=None) -> LRUCache:
+    """
+    Return the named LRUCache for this Datasette instance, creating it the
+    first time it is requested with a size bound from the cache-size setting
+    """
+    caches = _instance_caches.setdefault(datasette, {})
+    cache = caches.get(name)
+    if cache is None:
+        config = datasette.plugin_config("datasette-acl") or {}
+        cache = caches[name] = LRUCache(
+            maxsize=config.get("cache-size", DEFAULT_CACHE_SIZE), ttl=ttl
+        )
+    return cache
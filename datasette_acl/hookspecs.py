@@ -13,3 +13,22 @@ def datasette_acl_valid_actors(datasette):
     - A list of dictionaries with "id" and "display" keys
     - A function or awaitable function that returns one of the above
     """
+
+
+@hookspec
+def datasette_acl_search_actors(datasette, query, limit):
+    """
+    Up to limit actors with an ID or display name matching query, for
+    autocomplete. An empty query should return any actors.
+
+    Return values are the same as for datasette_acl_valid_actors.
+    """
+
+
+@hookspec
+def datasette_acl_validate_actors(datasette, actor_ids):
+    """
+    Return the actor IDs from the actor_ids list that are valid
+
+    Can also return a function or awaitable function that returns them.
+    """
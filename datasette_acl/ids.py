@@ -0,0 +1,119 @@
+from typing import Dict, Iterable, Optional, Tuple
+import weakref
+
+# (database, resource, glob), matching the columns of acl_resources. Table
+# resources have a null glob, database resources a null resource and glob,
+# glob resources a null resource
+ResourceKey = Tuple[str, Optional[str], Optional[str]]
+
+RESOURCE_ID_SQL = """
+select id from acl_resources
+where database = :database and resource is :resource and glob is :glob
+"""
+
+INSERT_RESOURCE_SQL = """
+insert or ignore into acl_resources (database, resource, glob)
+values (:database, :resource, :glob)
+"""
+
+
+class IdMaps:
+    """
+    Interned integer ids for resources, actions and groups, so statements
+    against the ACL tables can bind ids instead of looking up names.
+
+    Rows in acl_resources, acl_actions and acl_groups are never renamed or
+    deleted - deleted groups keep their row - so an id stays correct once it
+    is known. Names missing from the maps, for example because another
+    process created them, are looked up in the database and then remembered.
+
+    Ids created inside a write transaction should only be added to the maps
+    after that transaction has committed.
+    """
+
+    def __init__(self):
+        self.resources: Dict[ResourceKey, int] = {}
+        self.actions: Dict[str, int] = {}
+        self.groups: Dict[str, int] = {}
+
+    async def load(self, db):
+        "Load every id from the internal database"
+        for row in await db.execute(
+            "select id, database, resource, glob from acl_resources"
+        ):
+            key = (row["database"], row["resource"], row["glob"])
+            self.resources[key] = row["id"]
+        for row in await db.execute("select id, name from acl_actions"):
+            self.actions[row["name"]] = row["id"]
+        for row in await db.execute("select id, name from acl_groups"):
+            self.groups[row["name"]] = row["id"]
+
+    async def resource_id(
+        self, db, database, resource=None, glob=None
+    ) -> Optional[int]:
+        "The id for this resource, or None if it has never been created"
+        key = (database, resource, glob)
+        if key not in self.resources:
+            row = (
+                await db.execute(
+                    RESOURCE_ID_SQL,
+                    {"database": database, "resource": resource, "glob": glob},
+                )
+            ).first()
+            if row is None:
+                return None
+            self.resources[key] = row["id"]
+        return self.resources[key]
+
+    async def action_id(self, db, name) -> Optional[int]:
+        if name not in self.actions:
+            row = (
+                await db.execute("select id from acl_actions where name = ?", [name])
+            ).first()
+            if row is None:
+                return None
+            self.actions[name] = row["id"]
+        return self.actions[name]
+
+    async def group_id(self, db, name) -> Optional[int]:
+        if name not in self.groups:
+            row = (
+                await db.execute("select id from acl_groups where name = ?", [name])
+            ).first()
+            if row is None:
+                return None
+            self.groups[name] = row["id"]
+        return self.groups[name]
+
+    def ensure_resource_id(self, conn, key: ResourceKey) -> int:
+        "For use inside a write transaction - creates the resource if needed"
+        if key in self.resources:
+            return self.resources[key]
+        database, resource, glob = key
+        params = {"database": database, "resource": resource, "glob": glob}
+        conn.execute(INSERT_RESOURCE_SQL, params)
+        return conn.execute(RESOURCE_ID_SQL, params).fetchone()[0]
+
+    def ensure_group_ids(self, conn, names: Iterable[str]) -> Dict[str, int]:
+        "For use inside a write transaction - creates any missing groups"
+        ids = {}
+        for name in names:
+            if name in self.groups:
+                ids[name] = self.groups[name]
+                continue
+            conn.execute("insert or ignore into acl_groups (name) values (?)", [name])
+            ids[name] = conn.execute(
+                "select id from acl_groups where name = ?", [name]
+            ).fetchone()[0]
+        return ids
+
+
+_id_maps = weakref.WeakKeyDictionary()
+
+
+def get_id_maps(datasette) -> IdMaps:
+    "Return the IdMaps for this Datasette instance"
+    id_maps = _id_maps.get(datasette)
+    if id_maps is None:
+        id_maps = _id_maps[datasette] = IdMaps()
+    return id_maps
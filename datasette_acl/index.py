@@ -0,0 +1,531 @@
+from dataclasses import dataclass, field
+from datasette_acl.cache import DEFAULT_CACHE_SIZE, LRUCache
+from datasette_acl.stats import get_stats
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Pattern, Set, Tuple, Union
+import json
+import re
+import time
+import weakref
+
+
+@dataclass(frozen=True)
+class Glob:
+    "A table name pattern using SQLite GLOB syntax, for grants on many tables"
+
+    pattern: str
+
+    def matches(self, table: str) -> bool:
+        return bool(_compile_glob(self.pattern).fullmatch(table))
+
+
+# Matches nothing, used for empty character classes and unterminated patterns
+NEVER = "(?!)"
+
+
+@lru_cache(maxsize=1024)
+def _compile_glob(pattern: str) -> Pattern:
+    """
+    Translate a GLOB pattern to a regular expression, following the rules of
+    SQLite's patternCompare(): only [^...] negates a class, a ] straight after
+    [ or [^ is a literal, and - makes a range only between two characters
+    that are not already part of a range. There is no escape character.
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            parts.append(".*")
+        elif c == "?":
+            parts.append(".")
+        elif c == "[":
+            items, negate, i = _glob_class(pattern, i)
+            if items is None:
+                # SQLite never matches a pattern with an unterminated class
+                return re.compile(NEVER)
+            if items:
+                parts.append("[{}{}]".format("^" if negate else "", "".join(items)))
+            else:
+                parts.append("." if negate else NEVER)
+        else:
+            parts.append(re.escape(c))
+    return re.compile("".join(parts), re.DOTALL)
+
+
+def _glob_class(pattern: str, i: int):
+    """
+    Parse the character class starting after the [ at pattern[i - 1],
+    returning (regex items, negate, index after the closing ]). items is
+    None if the class is never closed.
+    """
+    items = []
+    negate = False
+    if pattern[i : i + 1] == "^":
+        negate = True
+        i += 1
+    if pattern[i : i + 1] == "]":
+        items.append(re.escape("]"))
+        i += 1
+    # The previous character, if it could start a range
+    prior = None
+    while i < len(pattern) and pattern[i] != "]":
+        c = pattern[i]
+        i += 1
+        if c == "-" and prior is not None and pattern[i : i + 1] not in ("]", ""):
+            end = pattern[i]
+            i += 1
+            # prior has already been added on its own, so a reversed range
+            # matches just that character
+            if prior <= end:
+                items.append("{}-{}".format(re.escape(prior), re.escape(end)))
+            prior = None
+        else:
+            items.append(re.escape(c))
+            prior = c
+    if i >= len(pattern):
+        return None, negate, i
+    return items, negate, i + 1
+
+
+# (database, resource, action_name) - resource is a table name, None for a
+# grant on the whole database or a Glob for tables matching a pattern
+Grant = Tuple[str, Union[str, Glob, None], str]
+
+
+def resource_from_row(row) -> Union[str, Glob, None]:
+    if row["glob"] is not None:
+        return Glob(row["glob"])
+    return row["resource"]
+
+
+def grant_from_row(row) -> Grant:
+    return (row["database"], resource_from_row(row), row["action_name"])
+
+
+class GrantSet:
+    """
+    The grants held by an actor or group. Globs are also kept by database
+    and action so checks only try the patterns that could apply.
+    """
+
+    def __init__(self, grants: Iterable[Grant] = ()):
+        self.grants: Set[Grant] = set()
+        self.globs: Dict[Tuple[str, str], Set[Glob]] = {}
+        for grant in grants:
+            self.add(grant)
+
+    def add(self, grant: Grant):
+        self.grants.add(grant)
+        database, resource, action = grant
+        if isinstance(resource, Glob):
+            self.globs.setdefault((database, action), set()).add(resource)
+
+    def discard(self, grant: Grant):
+        self.grants.discard(grant)
+        database, resource, action = grant
+        if isinstance(resource, Glob):
+            globs = self.globs.get((database, action))
+            if globs is not None:
+                globs.discard(resource)
+                if not globs:
+                    del self.globs[(database, action)]
+
+    def matches(self, database, resource, action) -> bool:
+        "Does any grant in this set cover this table?"
+        if (database, resource, action) in self.grants:
+            return True
+        if (database, None, action) in self.grants:
+            return True
+        globs = self.globs.get((database, action))
+        return bool(globs) and any(glob.matches(resource) for glob in globs)
+
+    def __iter__(self):
+        return iter(self.grants)
+
+    def __len__(self):
+        return len(self.grants)
+
+    def __contains__(self, grant):
+        return grant in self.grants
+
+    def __eq__(self, other):
+        if isinstance(other, GrantSet):
+            return self.grants == other.grants
+        return self.grants == other
+
+    def __repr__(self):
+        return "GrantSet({!r})".format(self.grants)
+
+
+ACTOR_PERMISSIONS_SQL = """
+select
+  'group' as kind,
+  acl_groups.name as group_name,
+  null as database,
+  null as resource,
+  null as glob,
+  null as action_name
+from acl_actor_groups
+join acl_groups on acl_groups.id = acl_actor_groups.group_id
+where acl_actor_groups.actor_id = :actor_id
+  union all
+select
+  'grant' as kind,
+  null as group_name,
+  acl_resources.database,
+  acl_resources.resource,
+  acl_resources.glob,
+  acl_actions.name as action_name
+from acl
+join acl_resources on acl.resource_id = acl_resources.id
+join acl_actions on acl.action_id = acl_actions.id
+where acl.actor_id = :actor_id
+"""
+
+GENERATION_SQL = "select generation from acl_generation where id = 1"
+
+GROUP_PERMISSIONS_SQL = """
+select
+  acl_groups.name as group_name,
+  acl_resources.database,
+  acl_resources.resource,
+  acl_resources.glob,
+  acl_actions.name as action_name
+from acl_groups
+left join acl on acl.group_id = acl_groups.id
+left join acl_resources on acl.resource_id = acl_resources.id
+left join acl_actions on acl.action_id = acl_actions.id
+where acl_groups.name in (select value from json_each(:group_names))
+"""
+
+
+# Each group with every group that contains it, including itself
+GROUP_ANCESTORS_SQL = """
+select
+  descendant.name as group_name,
+  ancestor.name as ancestor_name
+from acl_group_closure
+join acl_groups descendant on descendant.id = acl_group_closure.descendant_id
+join acl_groups ancestor on ancestor.id = acl_group_closure.ancestor_id
+where descendant.name in (select value from json_each(:group_names))
+"""
+
+
+# Every resource with at least one grant, and every actor with a direct
+# grant or group membership
+PRESENCE_SQL = """
+select distinct
+  'resource' as kind,
+  acl_resources.database,
+  acl_resources.resource,
+  acl_resources.glob,
+  null as actor_id
+from acl
+join acl_resources on acl.resource_id = acl_resources.id
+  union all
+select distinct 'actor', null, null, null, actor_id
+from acl
+where actor_id is not null
+  union all
+select distinct 'actor', null, null, null, actor_id
+from acl_actor_groups
+"""
+
+
+class Presence:
+    """
+    Which tables and actors have any ACL state at all, so checks for
+    everything else can be answered without a query.
+
+    Removing a grant or membership does not remove anything from these sets
+    since others may remain - they are rebuilt when the index is cleared.
+    """
+
+    def __init__(self):
+        self.tables: Set[Tuple[str, str]] = set()
+        self.databases: Set[str] = set()
+        self.globs: Dict[str, Set[Glob]] = {}
+        self.actors: Set[str] = set()
+
+    def add_resource(self, database, resource):
+        if resource is None:
+            self.databases.add(database)
+        elif isinstance(resource, Glob):
+            self.globs.setdefault(database, set()).add(resource)
+        else:
+            self.tables.add((database, resource))
+
+    def covers(self, database, table) -> bool:
+        "Could any grant apply to this table?"
+        if (database, table) in self.tables or database in self.databases:
+            return True
+        globs = self.globs.get(database)
+        return bool(globs) and any(glob.matches(table) for glob in globs)
+
+
+@dataclass
+class ActorEntry:
+    groups: Set[str] = field(default_factory=set)
+    grants: GrantSet = field(default_factory=GrantSet)
+
+
+class PermissionIndex:
+    """
+    In-memory index of the (database, resource, action) grants held by each
+    actor, either directly or through the groups they belong to.
+
+    Entries are loaded from the internal database the first time an actor or
+    group is seen, then kept up to date by the code that writes to the acl
+    and acl_actor_groups tables. The groups containing each group, from
+    acl_group_closure, are cached until group nesting next changes.
+
+    Writes made by other processes are detected by polling the acl_generation
+    row at most once every check_interval seconds - the whole index is
+    dropped if the generation has moved on.
+    """
+
+    def __init__(self, check_interval=1.0, maxsize=DEFAULT_CACHE_SIZE):
+        # Bounded, so memory use does not grow with every actor ever checked
+        self.actors = LRUCache(maxsize=maxsize)
+        self.groups: Dict[str, GrantSet] = {}
+        self.ancestors: Dict[str, Set[str]] = {}
+        self.presence: Optional[Presence] = None
+        self.check_interval = check_interval
+        self.generation: Optional[int] = None
+        self._next_check = 0.0
+        # Incremented on every change, so loads that raced a write are not kept
+        self._version = 0
+
+    async def allowed(
+        self,
+        db,
+        actor_id,
+        database,
+        resource,
+        action,
+        exclude_groups=frozenset(),
+        include_groups=frozenset(),
+    ) -> bool:
+        """
+        Does this actor hold the grant? exclude_groups and include_groups are
+        group names to drop from or add to their stored memberships, used for
+        dynamic groups that are evaluated without being written to the database
+        """
+        await self.check_generation(db)
+        entry = await self.get_actor(db, actor_id)
+        if entry.grants.matches(database, resource, action):
+            return True
+        names = await self._expand_groups(
+            db, (entry.groups - exclude_groups) | include_groups
+        )
+        groups = await self._groups_for(db, names)
+        return any(
+            name in groups and groups[name].matches(database, resource, action)
+            for name in names
+        )
+
+    async def actor_grants(
+        self, db, actor_id, exclude_groups=frozenset(), include_groups=frozenset()
+    ) -> Set[Grant]:
+        "All grants held by this actor, directly or through their groups"
+        await self.check_generation(db)
+        entry = await self.get_actor(db, actor_id)
+        names = await self._expand_groups(
+            db, (entry.groups - exclude_groups) | include_groups
+        )
+        groups = await self._groups_for(db, names)
+        grants = set(entry.grants)
+        for name in names:
+            grants.update(groups.get(name, ()))
+        return grants
+
+    async def get_actor(self, db, actor_id) -> ActorEntry:
+        entry = self.actors.get(actor_id)
+        if entry is not None:
+            return entry
+        version = self._version
+        entry = ActorEntry()
+        for row in await db.execute(ACTOR_PERMISSIONS_SQL, {"actor_id": actor_id}):
+            if row["kind"] == "group":
+                entry.groups.add(row["group_name"])
+            else:
+                entry.grants.add(grant_from_row(row))
+        if version == self._version:
+            self.actors.set(actor_id, entry)
+        return entry
+
+    async def load_groups(self, db, group_names: Iterable[str]) -> Dict[str, GrantSet]:
+        version = self._version
+        loaded = {name: GrantSet() for name in group_names}
+        for row in await db.execute(
+            GROUP_PERMISSIONS_SQL, {"group_names": json.dumps(list(loaded))}
+        ):
+            if row["action_name"] is not None:
+                loaded[row["group_name"]].add(grant_from_row(row))
+        if version == self._version:
+            self.groups.update(loaded)
+        return loaded
+
+    async def load_ancestors(
+        self, db, group_names: Iterable[str]
+    ) -> Dict[str, Set[str]]:
+        version = self._version
+        loaded = {name: {name} for name in group_names}
+        for row in await db.execute(
+            GROUP_ANCESTORS_SQL, {"group_names": json.dumps(list(loaded))}
+        ):
+            loaded[row["group_name"]].add(row["ancestor_name"])
+        if version == self._version:
+            self.ancestors.update(loaded)
+        return loaded
+
+    async def get_presence(self, db) -> Presence:
+        "The Presence sets, checking first for writes by other processes"
+        await self.check_generation(db)
+        if self.presence is not None:
+            return self.presence
+        version = self._version
+        presence = Presence()
+        for row in await db.execute(PRESENCE_SQL):
+            if row["kind"] == "actor":
+                presence.actors.add(row["actor_id"])
+            else:
+                presence.add_resource(row["database"], resource_from_row(row))
+        if version == self._version:
+            self.presence = presence
+        return presence
+
+    def grant_added(
+        self, *, actor_id=None, group_name=None, database, resource, action
+    ):
+        self._version += 1
+        if self.presence is not None:
+            self.presence.add_resource(database, resource)
+            if actor_id is not None:
+                self.presence.actors.add(actor_id)
+        grants = self._grants_for(actor_id, group_name)
+        if grants is not None:
+            grants.add((database, resource, action))
+
+    def grant_removed(
+        self, *, actor_id=None, group_name=None, database, resource, action
+    ):
+        self._version += 1
+        grants = self._grants_for(actor_id, group_name)
+        if grants is not None:
+            grants.discard((database, resource, action))
+
+    def member_added(self, actor_id, group_name):
+        self._version += 1
+        if self.presence is not None:
+            self.presence.actors.add(actor_id)
+        entry = self.actors.peek(actor_id)
+        if entry is not None:
+            entry.groups.add(group_name)
+
+    def member_removed(self, actor_id, group_name):
+        self._version += 1
+        entry = self.actors.peek(actor_id)
+        if entry is not None:
+            entry.groups.discard(group_name)
+
+    def nesting_changed(self):
+        "Call after adding or removing a group from another group"
+        self._version += 1
+        self.ancestors.clear()
+
+    def clear(self):
+        self._version += 1
+        self.actors.clear()
+        self.groups.clear()
+        self.ancestors.clear()
+        self.presence = None
+
+    async def check_generation(self, db):
+        now = time.monotonic()
+        if self.generation is not None and now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        generation = (await db.execute(GENERATION_SQL)).single_value()
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+
+    def advance(self, before: int, after: int):
+        """
+        Record a write that moved the generation from before to after. If
+        anything else wrote since we last looked the index is dropped.
+        """
+        if before != self.generation:
+            self.clear()
+        self.generation = after
+
+    async def _groups_for(self, db, names: Set[str]) -> Dict[str, GrantSet]:
+        groups = self.groups
+        missing = [name for name in names if name not in groups]
+        if missing:
+            groups = {**groups, **await self.load_groups(db, missing)}
+        return groups
+
+    async def _expand_groups(self, db, names: Set[str]) -> Set[str]:
+        "These groups and every group that contains one of them"
+        ancestors = self.ancestors
+        missing = [name for name in names if name not in ancestors]
+        if missing:
+            ancestors = {**ancestors, **await self.load_ancestors(db, missing)}
+        expanded = set()
+        for name in names:
+            expanded |= ancestors.get(name, {name})
+        return expanded
+
+    def _grants_for(self, actor_id, group_name) -> Optional[GrantSet]:
+        if group_name is not None:
+            return self.groups.get(group_name)
+        entry = self.actors.peek(actor_id)
+        return entry.grants if entry is not None else None
+
+
+_indexes = weakref.WeakKeyDictionary()
+
+
+def get_permission_index(datasette) -> PermissionIndex:
+    "Return the PermissionIndex for this Datasette instance"
+    index = _indexes.get(datasette)
+    if index is None:
+        config = datasette.plugin_config("datasette-acl") or {}
+        index = _indexes[datasette] = PermissionIndex(
+            check_interval=config.get("generation-check-interval", 1.0),
+            maxsize=config.get("cache-size", DEFAULT_CACHE_SIZE),
+        )
+    return index
+
+
+async def execute_acl_write_fn(datasette, fn, source="other"):
+    """
+    Run fn(conn) in a write transaction against the internal database,
+    advancing the permission index to the resulting ACL generation.
+
+    source identifies the caller in the writes counted by /-/acl/stats.
+    """
+
+    def inner(conn):
+        before = conn.execute(GENERATION_SQL).fetchone()[0]
+        result = fn(conn)
+        after = conn.execute(GENERATION_SQL).fetchone()[0]
+        return before, after, result
+
+    db = datasette.get_internal_database()
+    stats = get_stats(datasette)
+    stats.increment("writes_total", source=source)
+    with stats.timer("write_seconds", source=source):
+        before, after, result = await db.execute_write_fn(inner)
+    get_permission_index(datasette).advance(before, after)
+    return result
+
+
+async def execute_acl_write(datasette, sql, params=None, source="other"):
+    return await execute_acl_write_fn(
+        datasette, lambda conn: conn.execute(sql, params or []), source=source
+    )
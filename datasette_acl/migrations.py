@@ -0,0 +1,299 @@
+from typing import Iterator
+import sqlite3
+
+# Version 1 is the original schema, which used "if not exists" throughout so
+# that it can be safely applied to databases created before migrations existed
+CREATE_TABLES_SQL = """
+create table if not exists acl_resources (
+    id integer primary key,
+    database text not null,
+    resource text,
+    unique(database, resource)
+);
+
+create table if not exists acl_actions (
+    id integer primary key,
+    name text not null unique
+);
+
+-- new table for groups
+create table if not exists acl_groups (
+    id integer primary key,
+    name text not null unique,
+    deleted integer
+);
+
+-- new table for actor-group relationships
+create table if not exists acl_actor_groups (
+    actor_id text,
+    group_id integer,
+    primary key (actor_id, group_id),
+    foreign key (group_id) references acl_groups(id)
+);
+
+-- Group membership audit log
+create table if not exists acl_groups_audit (
+    id integer primary key,
+    timestamp text default (datetime('now')),
+    operation_by text,
+    operation text check (operation in ('added', 'removed', 'created', 'deleted')),
+    group_id integer,
+    actor_id text,
+    foreign key (group_id) references acl_groups(id)
+);
+
+create table if not exists acl (
+    acl_id integer primary key,
+    actor_id text,
+    group_id integer,
+    resource_id integer,
+    action_id integer,
+    foreign key (group_id) references acl_groups(id),
+    foreign key (resource_id) references acl_resources(id),
+    foreign key (action_id) references acl_actions(id),
+    check ((actor_id is null) != (group_id is null)),
+    unique(actor_id, group_id, resource_id, action_id)
+);
+
+-- ACL audit log
+create table if not exists acl_audit (
+    id integer primary key,
+    timestamp text default (datetime('now')),
+    operation_by text,
+    operation text check (operation in ('added', 'removed')),
+    action_id integer,
+    resource_id integer,
+    group_id integer,
+    actor_id text,
+    foreign key (group_id) references acl_groups(id),
+    foreign key (resource_id) references acl_resources(id),
+    foreign key (action_id) references acl_actions(id)
+)
+"""
+
+CREATE_GENERATION_SQL = """
+-- Bumped on every change to acl, acl_actor_groups or acl_groups, so caches
+-- in other processes sharing this database can tell they are out of date
+create table if not exists acl_generation (
+    id integer primary key check (id = 1),
+    generation integer not null
+);
+
+insert or ignore into acl_generation (id, generation) values (1, 0);
+
+create trigger if not exists acl_insert_generation after insert on acl
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_update_generation after update on acl
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_delete_generation after delete on acl
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_actor_groups_insert_generation after insert on acl_actor_groups
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_actor_groups_update_generation after update on acl_actor_groups
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_actor_groups_delete_generation after delete on acl_actor_groups
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_groups_insert_generation after insert on acl_groups
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_groups_update_generation after update on acl_groups
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_groups_delete_generation after delete on acl_groups
+begin
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+"""
+
+CREATE_INDEXES_SQL = """
+create index if not exists acl_group_resource_action
+    on acl (group_id, resource_id, action_id);
+
+create index if not exists acl_resource on acl (resource_id);
+
+create index if not exists acl_actor_groups_group on acl_actor_groups (group_id);
+
+-- Audit logs are paginated by id, which the rowid at the end of a
+-- single column index provides in order
+create index if not exists acl_audit_resource on acl_audit (resource_id);
+
+create index if not exists acl_groups_audit_group on acl_groups_audit (group_id);
+"""
+
+# A resource with a null resource and glob covers every table in the
+# database, one with a glob covers tables with names matching the pattern
+RESOURCE_GLOBS_SQL = """
+alter table acl_resources add column glob text;
+
+create unique index if not exists acl_resources_database
+    on acl_resources (database) where resource is null and glob is null;
+
+create unique index if not exists acl_resources_glob
+    on acl_resources (database, glob) where glob is not null;
+"""
+
+# Groups can contain other groups. acl_group_closure holds every (ancestor,
+# descendant) pair, including each group with itself, with the number of
+# distinct paths between them so that removing one of several routes from
+# a group to another can be applied incrementally. Cycles are rejected.
+NESTED_GROUPS_SQL = """
+create table if not exists acl_group_groups (
+    parent_id integer not null,
+    child_id integer not null,
+    primary key (parent_id, child_id),
+    foreign key (parent_id) references acl_groups(id),
+    foreign key (child_id) references acl_groups(id)
+);
+
+create index if not exists acl_group_groups_child on acl_group_groups (child_id);
+
+create table if not exists acl_group_closure (
+    ancestor_id integer not null,
+    descendant_id integer not null,
+    paths integer not null,
+    primary key (ancestor_id, descendant_id),
+    foreign key (ancestor_id) references acl_groups(id),
+    foreign key (descendant_id) references acl_groups(id)
+);
+
+create index if not exists acl_group_closure_descendant
+    on acl_group_closure (descendant_id, ancestor_id);
+
+insert or ignore into acl_group_closure (ancestor_id, descendant_id, paths)
+select id, id, 1 from acl_groups;
+
+alter table acl_groups_audit add column member_group_id integer
+    references acl_groups(id);
+
+create trigger if not exists acl_groups_insert_closure after insert on acl_groups
+begin
+    insert or ignore into acl_group_closure (ancestor_id, descendant_id, paths)
+    values (new.id, new.id, 1);
+end;
+
+create trigger if not exists acl_group_groups_check_cycle before insert on acl_group_groups
+begin
+    select raise(abort, 'Group nesting would create a cycle')
+    where exists (
+        select 1 from acl_group_closure
+        where ancestor_id = new.child_id and descendant_id = new.parent_id
+    );
+end;
+
+create trigger if not exists acl_group_groups_insert_closure after insert on acl_group_groups
+begin
+    insert into acl_group_closure (ancestor_id, descendant_id, paths)
+    select above.ancestor_id, below.descendant_id, above.paths * below.paths
+    from acl_group_closure above, acl_group_closure below
+    where above.descendant_id = new.parent_id and below.ancestor_id = new.child_id
+    on conflict (ancestor_id, descendant_id) do update
+    set paths = paths + excluded.paths;
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+
+create trigger if not exists acl_group_groups_delete_closure after delete on acl_group_groups
+begin
+    update acl_group_closure
+    set paths = paths - (
+        select above.paths * below.paths
+        from acl_group_closure above, acl_group_closure below
+        where above.ancestor_id = acl_group_closure.ancestor_id
+        and above.descendant_id = old.parent_id
+        and below.ancestor_id = old.child_id
+        and below.descendant_id = acl_group_closure.descendant_id
+    )
+    where ancestor_id in (
+        select ancestor_id from acl_group_closure where descendant_id = old.parent_id
+    )
+    and descendant_id in (
+        select descendant_id from acl_group_closure where ancestor_id = old.child_id
+    );
+    delete from acl_group_closure where paths = 0;
+    update acl_generation set generation = generation + 1 where id = 1;
+end;
+"""
+
+# Append new migrations to the end of this list, never edit existing ones
+MIGRATIONS = [
+    (1, CREATE_TABLES_SQL),
+    (2, CREATE_GENERATION_SQL),
+    (3, CREATE_INDEXES_SQL),
+    (4, RESOURCE_GLOBS_SQL),
+    (5, NESTED_GROUPS_SQL),
+]
+
+CREATE_MIGRATIONS_TABLE_SQL = """
+create table if not exists acl_migrations (
+    version integer primary key,
+    applied_at text default (datetime('now'))
+)
+"""
+
+
+def split_statements(sql: str) -> Iterator[str]:
+    statement = ""
+    for line in sql.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ""
+    if statement.strip():
+        # The final statement in a script does not need a trailing semicolon
+        yield statement.strip()
+
+
+def apply_migrations(conn):
+    """
+    Apply any migrations that have not yet been recorded in acl_migrations.
+
+    Each migration runs in its own transaction together with the row that
+    records it, so a failed migration leaves the database at the previous
+    version.
+    """
+    conn.execute(CREATE_MIGRATIONS_TABLE_SQL)
+    applied = []
+    for version, sql in MIGRATIONS:
+        conn.execute("begin immediate")
+        try:
+            # Another process may have got here first
+            if conn.execute(
+                "select 1 from acl_migrations where version = ?", [version]
+            ).fetchone():
+                conn.execute("commit")
+                continue
+            for statement in split_statements(sql):
+                conn.execute(statement)
+            conn.execute("insert into acl_migrations (version) values (?)", [version])
+            conn.execute("commit")
+        except Exception:
+            conn.execute("rollback")
+            raise
+        applied.append(version)
+    return applied
+
+
+async def run_migrations(db):
+    "Bring the ACL tables in the internal database up to the latest version"
+    return await db.execute_write_fn(apply_migrations, transaction=False)
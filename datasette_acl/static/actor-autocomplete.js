@@ -0,0 +1,38 @@
+// Attach Choices.js to a select element, fetching matching actors from
+// /-/acl/actors.json as the user types instead of listing them all in the page
+function actorAutocomplete(select, url, options) {
+  options = options || {};
+  const exclude = new Set(options.exclude || []);
+  const choices = new Choices(select, Object.assign({
+    searchChoices: false,
+    shouldSort: false,
+    searchResultLimit: 50,
+    noChoicesText: 'Type to search for users',
+  }, options.choices || {}));
+  let timer = null;
+  let latest = 0;
+  async function search(q) {
+    const current = ++latest;
+    const response = await fetch(url + '?' + new URLSearchParams({q: q, limit: 50}));
+    const data = await response.json();
+    if (current !== latest) {
+      // A newer search has started since this one
+      return;
+    }
+    choices.setChoices(
+      data.actors.filter(actor => !exclude.has(actor.id)).map(actor => ({
+        value: actor.id,
+        label: actor.display,
+      })),
+      'value',
+      'label',
+      true
+    );
+  }
+  select.addEventListener('search', ev => {
+    clearTimeout(timer);
+    timer = setTimeout(() => search(ev.detail.value), 150);
+  });
+  search('');
+  return choices;
+}
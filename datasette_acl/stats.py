@@ -0,0 +1,148 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+import time
+import weakref
+
+# Upper bounds in seconds, following Prometheus histogram conventions
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+PREFIX = "datasette_acl_"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self):
+        # One count per bucket, plus one for values above the largest bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        "(upper bound, count of observations at or below it) pairs"
+        total = 0
+        buckets = []
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            total += count
+            buckets.append((str(bound), total))
+        return buckets
+
+
+class Stats:
+    """
+    Counters and latency histograms for one Datasette instance, identified
+    by a metric name and a set of labels
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        "Observe the duration of a with block in the named histogram"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_json(self) -> dict:
+        return {
+            "counters": [
+                {"name": PREFIX + name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "histograms": [
+                {
+                    "name": PREFIX + name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(histogram.cumulative()),
+                }
+                for (name, labels), histogram in sorted(
+                    self.histograms.items(), key=lambda item: item[0]
+                )
+            ],
+        }
+
+
+def to_prometheus(data: dict) -> str:
+    "Prometheus text exposition format for the output of Stats.to_json()"
+    lines = []
+    typed = set()
+
+    def line(name, labels, value):
+        if labels:
+            label_text = ",".join(
+                '{}="{}"'.format(
+                    key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                )
+                for key, value in labels.items()
+            )
+            lines.append("{}{{{}}} {}".format(name, label_text, value))
+        else:
+            lines.append("{} {}".format(name, value))
+
+    for counter in data["counters"]:
+        if counter["name"] not in typed:
+            typed.add(counter["name"])
+            kind = "counter" if counter["name"].endswith("_total") else "gauge"
+            lines.append("# TYPE {} {}".format(counter["name"], kind))
+        line(counter["name"], counter["labels"], counter["value"])
+    for histogram in data["histograms"]:
+        name = histogram["name"]
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE {} histogram".format(name))
+        for bound, count in histogram["buckets"].items():
+            line(name + "_bucket", dict(histogram["labels"], le=bound), count)
+        line(name + "_sum", histogram["labels"], histogram["sum"])
+        line(name + "_count", histogram["labels"], histogram["count"])
+    return "\n".join(lines) + "\n"
+
+
+_stats = weakref.WeakKeyDictionary()
+
+
+def get_stats(datasette) -> Stats:
+    "Return the Stats for this Datasette instance"
+    stats = _stats.get(datasette)
+    if stats is None:
+        stats = _stats[datasette] = Stats()
+    return stats
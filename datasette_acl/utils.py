@@ -1,12 +1,42 @@
 from datasette.plugins import pm
+from datasette_acl.actor_search import ActorSearchIndex
+from datasette_acl.stats import get_stats
 from datasette.utils import await_me_maybe
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import sys
+import time
+import weakref
+
+# Strong references to running background tasks, so they are not garbage
+# collected before they finish
+_background_tasks = set()
 
 
 async def can_edit_permissions(datasette, actor):
     return await datasette.permission_allowed(actor, "datasette-acl")
 
 
+def run_in_background(coro):
+    "Run a coroutine without waiting for it, logging any exception it raises"
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_task_done)
+    return task
+
+
+def _background_task_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log(task.exception())
+
+
+def log(message):
+    "Write a message to standard error, prefixed with the plugin name"
+    sys.stderr.write("datasette-acl: {}\n".format(message))
+    sys.stderr.flush()
+
+
 def generate_changes_message(changes_made, noun):
     messages = []
     for action, changes in changes_made.items():
@@ -19,22 +49,251 @@ def generate_changes_message(changes_made, noun):
     return message[0].upper() + message[1:]
 
 
+DEFAULT_VALID_ACTORS_TTL = 60
+DEFAULT_ACTOR_HOOK_TIMEOUT = 5.0
+
+# Returned by call_actor_hooks() for plugins that failed or timed out
+HOOK_FAILED = object()
+
+
+def _actor_hook_timeout(datasette, plugin_name) -> float:
+    config = datasette.plugin_config("datasette-acl") or {}
+    timeouts = config.get("actor-hook-timeouts") or {}
+    if plugin_name in timeouts:
+        return timeouts[plugin_name]
+    return config.get("actor-hook-timeout", DEFAULT_ACTOR_HOOK_TIMEOUT)
+
+
+async def call_actor_hooks(datasette, hook_name, **kwargs) -> List[Tuple[str, Any]]:
+    """
+    Call every implementation of one of the actor hooks concurrently,
+    returning a list of (plugin name, result) pairs in the usual pluggy
+    order. Plugins that raise an exception or take longer than their
+    timeout are logged and return HOOK_FAILED instead.
+    """
+    kwargs["datasette"] = datasette
+    stats = get_stats(datasette)
+
+    async def call(hookimpl):
+        timeout = _actor_hook_timeout(datasette, hookimpl.plugin_name)
+        start = time.perf_counter()
+        try:
+            result = hookimpl.function(*[kwargs[arg] for arg in hookimpl.argnames])
+            return await asyncio.wait_for(await_me_maybe(result), timeout)
+        except asyncio.TimeoutError:
+            stats.increment(
+                "actor_hook_failures_total",
+                hook=hook_name,
+                plugin=hookimpl.plugin_name,
+                reason="timeout",
+            )
+            log(
+                "{} from {} timed out after {}s".format(
+                    hook_name, hookimpl.plugin_name, timeout
+                )
+            )
+            return HOOK_FAILED
+        except Exception as ex:
+            stats.increment(
+                "actor_hook_failures_total",
+                hook=hook_name,
+                plugin=hookimpl.plugin_name,
+                reason="error",
+            )
+            log("{} from {} failed: {!r}".format(hook_name, hookimpl.plugin_name, ex))
+            return HOOK_FAILED
+        finally:
+            duration = time.perf_counter() - start
+            stats.observe(
+                "actor_hook_seconds",
+                duration,
+                hook=hook_name,
+                plugin=hookimpl.plugin_name,
+            )
+
+    # Pluggy calls the most recently registered implementation first
+    hookimpls = list(reversed(getattr(pm.hook, hook_name).get_hookimpls()))
+    results = await asyncio.gather(*[call(hookimpl) for hookimpl in hookimpls])
+    return [
+        (hookimpl.plugin_name, result) for hookimpl, result in zip(hookimpls, results)
+    ]
+
+
+class ValidActors:
+    """
+    Cached results of the datasette_acl_valid_actors hooks, as an ordered
+    dictionary of actor ID to display name.
+
+    The hooks are called the first time the actors are needed. After ttl
+    seconds the cached actors continue to be returned while a refresh runs
+    in the background. A ttl of 0 calls the hooks every time.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_VALID_ACTORS_TTL):
+        self.ttl = ttl
+        self.actors: Dict[str, str] = {}
+        # Plugin name -> actors it returned, reused if that plugin fails
+        self.sources: Dict[str, Any] = {}
+        self.loaded_at: Optional[float] = None
+        self._search_index: Optional[ActorSearchIndex] = None
+        self.hookimpls = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._refreshing: Optional[asyncio.Future] = None
+
+    async def get(self, datasette) -> Dict[str, str]:
+        if self.ttl == 0:
+            await self.refresh(datasette)
+            return self.actors
+        if self.loaded_at is None or self.hookimpls != _valid_actors_hookimpls():
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                # Another request may have loaded them while we waited
+                if (
+                    self.loaded_at is None
+                    or self.hookimpls != _valid_actors_hookimpls()
+                ):
+                    await self.refresh(datasette)
+        elif time.monotonic() - self.loaded_at >= self.ttl and self._refreshing is None:
+            self._refreshing = run_in_background(self.refresh(datasette))
+        return self.actors
+
+    async def refresh(self, datasette):
+        hookimpls = _valid_actors_hookimpls()
+        try:
+            self.actors, self.sources = await self.load(datasette)
+            self._search_index = None
+            self.loaded_at = time.monotonic()
+            self.hookimpls = hookimpls
+        finally:
+            self._refreshing = None
+
+    async def load(self, datasette) -> Tuple[Dict[str, str], Dict[str, Any]]:
+        actors = {}
+        sources = {}
+        for plugin_name, result in await call_actor_hooks(
+            datasette, "datasette_acl_valid_actors"
+        ):
+            if result is HOOK_FAILED:
+                # Keep using the actors this plugin returned last time
+                result = self.sources.get(plugin_name, HOOK_FAILED)
+            sources[plugin_name] = result
+            if result is not HOOK_FAILED:
+                _add_actors(actors, result)
+        return actors, sources
+
+    async def search(self, datasette, query: str, limit: int):
+        actors = await self.get(datasette)
+        if self._search_index is None:
+            # Built the first time a search is run after each refresh
+            self._search_index = ActorSearchIndex(actors)
+        return self._search_index.search(query, limit)
+
+    @property
+    def unavailable(self) -> bool:
+        "True if a plugin has failed without ever returning any actors"
+        return any(result is HOOK_FAILED for result in self.sources.values())
+
+    def invalidate(self):
+        "Call the hooks again the next time the actors are needed"
+        self.loaded_at = None
+
+
+_valid_actors = weakref.WeakKeyDictionary()
+
+
+def _valid_actors_hookimpls():
+    # Installing or removing a plugin invalidates the cache
+    return tuple(pm.hook.datasette_acl_valid_actors.get_hookimpls())
+
+
+def get_valid_actors_registry(datasette) -> ValidActors:
+    registry = _valid_actors.get(datasette)
+    if registry is None:
+        config = datasette.plugin_config("datasette-acl") or {}
+        registry = _valid_actors[datasette] = ValidActors(
+            ttl=config.get("valid-actors-ttl", DEFAULT_VALID_ACTORS_TTL)
+        )
+    return registry
+
+
+def invalidate_valid_actors(datasette):
+    """
+    Discard the cached list of valid actors - call this when the actors
+    returned by a datasette_acl_valid_actors hook have changed
+    """
+    get_valid_actors_registry(datasette).invalidate()
+
+
+def _add_actors(all_actors: Dict[str, str], actors):
+    for actor in actors or ():
+        if isinstance(actor, str):
+            all_actors.setdefault(actor, actor)
+        else:
+            all_actors.setdefault(actor["id"], actor["display"])
+
+
+def _has_hookimpls(hook) -> bool:
+    return bool(hook.get_hookimpls())
+
+
 async def get_acl_valid_actors(datasette) -> List[Tuple[str, str]]:
-    all_actors = []
-    for hook in pm.hook.datasette_acl_valid_actors(datasette=datasette):
-        actors = await await_me_maybe(hook)
-        for actor in actors:
-            if isinstance(actor, str):
-                all_actors.append((actor, actor))
-            else:
-                all_actors.append((actor["id"], actor["display"]))
-    return all_actors
+    actors = await get_valid_actors_registry(datasette).get(datasette)
+    return list(actors.items())
 
 
-async def validate_actor_id(datasette, actor_id):
-    actors = await get_acl_valid_actors(datasette)
-    if not actors:
-        # No validation has been configured
+async def has_valid_actors(datasette) -> bool:
+    "True if a plugin has provided valid actors to autocomplete against"
+    if _has_hookimpls(pm.hook.datasette_acl_search_actors):
         return True
-    else:
-        return actor_id in dict(actors)
+    return bool(await get_valid_actors_registry(datasette).get(datasette))
+
+
+async def search_valid_actors(
+    datasette, query: str, limit: int = 20
+) -> List[Tuple[str, str]]:
+    """
+    Valid actors with an ID or display name matching this query, from the
+    datasette_acl_search_actors hooks and then the cached results of the
+    datasette_acl_valid_actors hooks
+    """
+    matches = {}
+    for _, result in await call_actor_hooks(
+        datasette, "datasette_acl_search_actors", query=query, limit=limit
+    ):
+        if result is not HOOK_FAILED:
+            _add_actors(matches, result)
+    if len(matches) < limit and _has_hookimpls(pm.hook.datasette_acl_valid_actors):
+        registry = get_valid_actors_registry(datasette)
+        # Ask for extra in case some were already found by search hooks
+        for actor_id, display in await registry.search(
+            datasette, query, limit + len(matches)
+        ):
+            matches.setdefault(actor_id, display)
+    return list(matches.items())[:limit]
+
+
+async def invalid_actor_ids(datasette, actor_ids) -> List[str]:
+    "Return the actor IDs from this list that are not valid"
+    actor_ids = list(actor_ids)
+    has_validate_hooks = _has_hookimpls(pm.hook.datasette_acl_validate_actors)
+    registry = get_valid_actors_registry(datasette)
+    actors = await registry.get(datasette)
+    if not actors and not has_validate_hooks and not registry.unavailable:
+        # No validation has been configured
+        return []
+    invalid = [actor_id for actor_id in actor_ids if actor_id not in actors]
+    if invalid and has_validate_hooks:
+        valid = set()
+        for _, result in await call_actor_hooks(
+            datasette, "datasette_acl_validate_actors", actor_ids=invalid
+        ):
+            # IDs are not treated as valid if the plugin failed
+            if result is not HOOK_FAILED:
+                valid.update(result or ())
+        invalid = [actor_id for actor_id in invalid if actor_id not in valid]
+    return invalid
+
+
+async def validate_actor_id(datasette, actor_id):
+    return not await invalid_actor_ids(datasette, [actor_id])
@@ -0,0 +1,29 @@
+from datasette import Response, Forbidden
+from datasette_acl.utils import can_edit_permissions, search_valid_actors
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+async def actors_json(request, datasette):
+    "Autocomplete valid actors for the permission editing interfaces"
+    if not await can_edit_permissions(datasette, request.actor):
+        raise Forbidden("You do not have permission to edit permissions")
+    try:
+        limit = int(request.args.get("limit") or DEFAULT_LIMIT)
+    except ValueError:
+        limit = DEFAULT_LIMIT
+    limit = max(1, min(limit, MAX_LIMIT))
+    # Fetch one extra to find out if there are more results
+    actors = await search_valid_actors(
+        datasette, request.args.get("q") or "", limit + 1
+    )
+    return Response.json(
+        {
+            "actors": [
+                {"id": actor_id, "display": display}
+                for actor_id, display in actors[:limit]
+            ],
+            "truncated": len(actors) > limit,
+        }
+    )
@@ -0,0 +1,151 @@
+from datasette import Forbidden
+from datasette.utils.asgi import AsgiStream
+from datasette_acl.utils import can_edit_permissions
+import csv
+import io
+import json
+
+EXPORT_CHUNK_SIZE = 1000
+
+TABLE_AUDIT_EXPORT_SQL = """
+select
+    acl_audit.id,
+    acl_audit.timestamp,
+    acl_audit.operation_by,
+    acl_audit.operation,
+    acl_resources.database,
+    acl_resources.resource as "table",
+    acl_resources.glob,
+    acl_groups.name as group_name,
+    acl_audit.actor_id,
+    acl_actions.name as action_name
+from acl_audit
+left join acl_resources on acl_resources.id = acl_audit.resource_id
+left join acl_groups on acl_groups.id = acl_audit.group_id
+left join acl_actions on acl_actions.id = acl_audit.action_id
+where acl_audit.id > :after{extra_where}
+order by acl_audit.id
+limit :limit
+"""
+
+GROUPS_AUDIT_EXPORT_SQL = """
+select
+    acl_groups_audit.id,
+    acl_groups_audit.timestamp,
+    acl_groups_audit.operation_by,
+    acl_groups_audit.operation,
+    acl_groups.name as group_name,
+    acl_groups_audit.actor_id,
+    member_groups.name as member_group
+from acl_groups_audit
+left join acl_groups on acl_groups.id = acl_groups_audit.group_id
+left join acl_groups member_groups
+    on member_groups.id = acl_groups_audit.member_group_id
+where acl_groups_audit.id > :after{extra_where}
+order by acl_groups_audit.id
+limit :limit
+"""
+
+# Query string filters for each log, as SQL that can use the indexes on
+# resource_id and group_id
+FILTERS = {
+    "audit": {
+        "since": "acl_audit.timestamp >= :since",
+        "until": "acl_audit.timestamp < :until",
+        "database": (
+            "acl_audit.resource_id in "
+            "(select id from acl_resources where database = :database)"
+        ),
+        "table": (
+            "acl_audit.resource_id in "
+            "(select id from acl_resources where resource = :table)"
+        ),
+        "group": (
+            "acl_audit.group_id in (select id from acl_groups where name = :group)"
+        ),
+        "actor_id": "acl_audit.actor_id = :actor_id",
+    },
+    "groups-audit": {
+        "since": "acl_groups_audit.timestamp >= :since",
+        "until": "acl_groups_audit.timestamp < :until",
+        "group": (
+            "acl_groups_audit.group_id in "
+            "(select id from acl_groups where name = :group)"
+        ),
+        "actor_id": "acl_groups_audit.actor_id = :actor_id",
+    },
+}
+
+EXPORT_SQL = {
+    "audit": TABLE_AUDIT_EXPORT_SQL,
+    "groups-audit": GROUPS_AUDIT_EXPORT_SQL,
+}
+
+
+def audit_export_query(log, args):
+    "The SQL and parameters for an audit export, with filters from args"
+    params = {}
+    clauses = []
+    for key, clause in FILTERS[log].items():
+        value = (args.get(key) or "").strip()
+        if value:
+            if key in ("since", "until"):
+                # Timestamps are stored as "YYYY-MM-DD HH:MM:SS"
+                value = value.replace("T", " ")
+            params[key] = value
+            clauses.append(clause)
+    extra_where = "".join("\nand " + clause for clause in clauses)
+    return EXPORT_SQL[log].format(extra_where=extra_where), params
+
+
+async def audit_export(request, datasette):
+    """
+    Stream the whole of an audit log as newline-delimited JSON or CSV,
+    oldest first, reading it in chunks
+    """
+    if not await can_edit_permissions(datasette, request.actor):
+        raise Forbidden("You do not have permission to edit permissions")
+    log = request.url_vars["log"]
+    export_format = request.url_vars["format"]
+    sql, params = audit_export_query(log, request.args)
+    internal_db = datasette.get_internal_database()
+
+    async def stream(r):
+        after = 0
+        columns = None
+        while True:
+            results = await internal_db.execute(
+                sql, dict(params, after=after, limit=EXPORT_CHUNK_SIZE)
+            )
+            if export_format == "csv" and columns is None:
+                columns = results.columns
+                await r.write(csv_rows([columns]))
+            if not results.rows:
+                return
+            if export_format == "csv":
+                await r.write(csv_rows(results.rows))
+            else:
+                await r.write(
+                    "".join(json.dumps(dict(row)) + "\n" for row in results.rows)
+                )
+            after = results.rows[-1]["id"]
+
+    if export_format == "csv":
+        content_type = "text/csv; charset=utf-8"
+    else:
+        content_type = "application/x-ndjson; charset=utf-8"
+    return AsgiStream(
+        stream,
+        content_type=content_type,
+        headers={
+            "content-disposition": 'attachment; filename="acl-{}.{}"'.format(
+                log, export_format
+            )
+        },
+    )
+
+
+def csv_rows(rows) -> str:
+    output = io.StringIO()
+    csv.writer(output).writerows(rows)
+    return output.getvalue()
@@ -0,0 +1,435 @@
+from datasette import Response, Forbidden
+from datasette.utils.asgi import AsgiStream
+from datasette_acl.index import execute_acl_write_fn, get_permission_index
+from datasette_acl.utils import can_edit_permissions, invalid_actor_ids
+from datasette_acl.views.groups import (
+    NESTED_GROUP_AUDIT_SQL,
+    get_dynamic_groups,
+    is_valid_group_name,
+)
+from typing import Dict, List, Optional, Tuple
+import json
+import sqlite3
+
+EXPORT_CHUNK_SIZE = 1000
+
+# Non-deleted groups with their members and the groups directly inside them
+EXPORT_GROUPS_SQL = """
+select
+    acl_groups.id,
+    acl_groups.name,
+    (
+        select json_group_array(actor_id) from (
+            select actor_id from acl_actor_groups
+            where group_id = acl_groups.id
+            order by actor_id
+        )
+    ) as members,
+    (
+        select json_group_array(name) from (
+            select child.name from acl_group_groups
+            join acl_groups child on child.id = acl_group_groups.child_id
+            where acl_group_groups.parent_id = acl_groups.id
+            order by child.name
+        )
+    ) as groups
+from acl_groups
+where acl_groups.deleted is null and acl_groups.id > :after
+order by acl_groups.id
+limit :limit
+"""
+
+EXPORT_GRANTS_SQL = """
+select
+    acl.acl_id,
+    acl_resources.database,
+    acl_resources.resource as "table",
+    acl_resources.glob,
+    acl_actions.name as action,
+    acl_groups.name as "group",
+    acl.actor_id as actor
+from acl
+join acl_resources on acl_resources.id = acl.resource_id
+join acl_actions on acl_actions.id = acl.action_id
+left join acl_groups on acl_groups.id = acl.group_id
+where acl.acl_id > :after
+-- Deleted groups keep their grants, but are not exported
+and (acl.group_id is null or acl_groups.deleted is null)
+order by acl.acl_id
+limit :limit
+"""
+
+# Grants held by deleted groups are left alone, as they are not exported
+CURRENT_GRANTS_SQL = """
+select
+    acl.acl_id,
+    acl_resources.database,
+    acl_resources.resource,
+    acl_resources.glob,
+    acl_actions.name,
+    acl.group_id,
+    acl.actor_id
+from acl
+join acl_resources on acl_resources.id = acl.resource_id
+join acl_actions on acl_actions.id = acl.action_id
+left join acl_groups on acl_groups.id = acl.group_id
+where acl.group_id is null or acl_groups.deleted is null
+"""
+
+# (database, table, glob, action, group, actor)
+ImportGrant = Tuple[
+    str, Optional[str], Optional[str], str, Optional[str], Optional[str]
+]
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+async def export_json(request, datasette):
+    """
+    Every group, membership and grant as one JSON document, in the format
+    accepted by /-/acl/import.json. Rows are read and sent in chunks.
+    """
+    if not await can_edit_permissions(datasette, request.actor):
+        raise Forbidden("You do not have permission to edit permissions")
+    internal_db = datasette.get_internal_database()
+    dynamic_groups = get_dynamic_groups(datasette)
+
+    async def chunks(sql):
+        after = 0
+        while True:
+            rows = (
+                await internal_db.execute(
+                    sql, {"after": after, "limit": EXPORT_CHUNK_SIZE}
+                )
+            ).rows
+            if not rows:
+                return
+            yield rows
+            after = rows[-1][0]
+
+    async def stream(r):
+        await r.write('{"groups": [')
+        first = True
+        async for rows in chunks(EXPORT_GROUPS_SQL):
+            groups = []
+            for row in rows:
+                group = {"name": row["name"]}
+                if row["name"] in dynamic_groups:
+                    # Dynamic group members come from the actor, not the import
+                    group["dynamic"] = True
+                else:
+                    group["members"] = json.loads(row["members"])
+                group["groups"] = json.loads(row["groups"])
+                groups.append(json.dumps(group))
+            await r.write(("" if first else ",\n") + ",\n".join(groups))
+            first = False
+        await r.write('],\n"grants": [')
+        first = True
+        async for rows in chunks(EXPORT_GRANTS_SQL):
+            grants = [
+                json.dumps({key: row[key] for key in row.keys() if key != "acl_id"})
+                for row in rows
+            ]
+            await r.write(("" if first else ",\n") + ",\n".join(grants))
+            first = False
+        await r.write("]}\n")
+
+    return AsgiStream(stream, content_type="application/json; charset=utf-8")
+
+
+def parse_import(data, dynamic_groups) -> Tuple[dict, List[ImportGrant], bool]:
+    """
+    Validate an import document, returning (groups, grants, replace) where
+    groups maps each group name to {"members": set or None, "groups": set or
+    None} - None meaning that part of the group should be left unchanged -
+    and grants is a de-duplicated list in document order
+    """
+    if not isinstance(data, dict):
+        raise InvalidImport("Body must be a JSON object")
+    groups = {}
+    for group in data.get("groups") or []:
+        if not isinstance(group, dict) or not isinstance(group.get("name"), str):
+            raise InvalidImport("Each group must be an object with a name")
+        name = group["name"]
+        if not is_valid_group_name(name):
+            raise InvalidImport("Invalid group name: {}".format(name))
+        parsed = {}
+        for key in ("members", "groups"):
+            value = group.get(key)
+            if value is not None and not (
+                isinstance(value, list) and all(isinstance(v, str) for v in value)
+            ):
+                raise InvalidImport(
+                    "{} for {} must be a list of strings".format(key, name)
+                )
+            parsed[key] = set(value) if value is not None else None
+        if parsed["members"] is not None and name in dynamic_groups:
+            raise InvalidImport(
+                "Dynamic group members cannot be imported: {}".format(name)
+            )
+        groups[name] = parsed
+    grants = {}
+    for grant in data.get("grants") or []:
+        if not isinstance(grant, dict):
+            raise InvalidImport("Each grant must be an object")
+        values = tuple(
+            grant.get(key)
+            for key in ("database", "table", "glob", "action", "group", "actor")
+        )
+        if not all(value is None or isinstance(value, str) for value in values):
+            raise InvalidImport("Grant values must be strings or null")
+        database, table, glob, action, group, actor = values
+        if not database or not action:
+            raise InvalidImport("Each grant needs a database and an action")
+        if table is not None and glob is not None:
+            raise InvalidImport("A grant can have a table or a glob, not both")
+        if (group is None) == (actor is None):
+            raise InvalidImport("Each grant needs exactly one of group or actor")
+        grants[values] = None
+    return groups, list(grants), bool(data.get("replace"))
+
+
+def _ids(conn, sql, params=()) -> Dict:
+    return {row[0]: row[1] for row in conn.execute(sql, params)}
+
+
+def apply_import(conn, groups, grants, replace, dynamic_groups, operation_by) -> dict:
+    """
+    Diff an import against the current state and write only the changes,
+    with audit rows. Runs inside a single write transaction.
+    """
+    counts = {
+        key: {"added": 0, "removed": 0}
+        for key in ("groups", "members", "member_groups", "grants")
+    }
+    group_audit = []
+    live = {
+        name
+        for name, deleted in conn.execute("select name, deleted from acl_groups")
+        if not deleted
+    }
+
+    # Create or restore groups in the import, delete the rest if replacing
+    to_create = [name for name in groups if name not in live]
+    to_delete = []
+    if replace:
+        to_delete = sorted(live - set(groups) - set(dynamic_groups))
+    conn.executemany(
+        "insert or ignore into acl_groups (name) values (?)",
+        [(name,) for name in to_create],
+    )
+    conn.executemany(
+        "update acl_groups set deleted = ? where name = ?",
+        [(None, name) for name in to_create] + [(1, name) for name in to_delete],
+    )
+    group_ids = _ids(conn, "select name, id from acl_groups")
+    group_names = {group_id: name for name, group_id in group_ids.items()}
+    group_audit += [("created", group_ids[name], None) for name in to_create]
+    group_audit += [("deleted", group_ids[name], None) for name in to_delete]
+    counts["groups"]["added"] = len(to_create)
+    counts["groups"]["removed"] = len(to_delete)
+    live = (live | set(to_create)) - set(to_delete)
+
+    # Members - deleted groups lose all of theirs
+    desired_members = {
+        (group_ids[name], actor_id)
+        for name, group in groups.items()
+        if group["members"] is not None
+        for actor_id in group["members"]
+    }
+    synced = {
+        group_ids[name]
+        for name, group in groups.items()
+        if group["members"] is not None
+    }
+    synced |= {group_ids[name] for name in to_delete}
+    current_members = {
+        (group_id, actor_id)
+        for actor_id, group_id in conn.execute(
+            "select actor_id, group_id from acl_actor_groups"
+        )
+        if group_id in synced
+    }
+    removed_members = sorted(current_members - desired_members)
+    added_members = sorted(desired_members - current_members)
+    conn.executemany(
+        "delete from acl_actor_groups where group_id = ? and actor_id = ?",
+        removed_members,
+    )
+    conn.executemany(
+        "insert into acl_actor_groups (group_id, actor_id) values (?, ?)",
+        added_members,
+    )
+    group_audit += [
+        ("removed", group_id, actor_id) for group_id, actor_id in removed_members
+    ]
+    group_audit += [
+        ("added", group_id, actor_id) for group_id, actor_id in added_members
+    ]
+    counts["members"]["added"] = len(added_members)
+    counts["members"]["removed"] = len(removed_members)
+
+    # Groups inside groups, removing before adding so a reorganised
+    # hierarchy does not look like a cycle part way through
+    desired_nesting = set()
+    for name, group in groups.items():
+        for child in group["groups"] or ():
+            if child not in live:
+                raise InvalidImport("Unknown group: {}".format(child))
+            desired_nesting.add((group_ids[name], group_ids[child]))
+    deleted_ids = {group_ids[name] for name in to_delete}
+    synced = {
+        group_ids[name] for name, group in groups.items() if group["groups"] is not None
+    }
+    current_nesting = {
+        (parent_id, child_id)
+        for parent_id, child_id in conn.execute(
+            "select parent_id, child_id from acl_group_groups"
+        )
+        if parent_id in synced or parent_id in deleted_ids or child_id in deleted_ids
+    }
+    removed_nesting = sorted(current_nesting - desired_nesting)
+    added_nesting = sorted(desired_nesting - current_nesting)
+    conn.executemany(
+        "delete from acl_group_groups where parent_id = ? and child_id = ?",
+        removed_nesting,
+    )
+    try:
+        conn.executemany(
+            "insert into acl_group_groups (parent_id, child_id) values (?, ?)",
+            added_nesting,
+        )
+    except sqlite3.IntegrityError as ex:
+        raise InvalidImport(str(ex))
+    conn.executemany(
+        NESTED_GROUP_AUDIT_SQL,
+        [(operation_by, "removed", p, c) for p, c in removed_nesting]
+        + [(operation_by, "added", p, c) for p, c in added_nesting],
+    )
+    counts["member_groups"]["added"] = len(added_nesting)
+    counts["member_groups"]["removed"] = len(removed_nesting)
+
+    conn.executemany(
+        """
+        insert into acl_groups_audit (
+            operation_by, operation, group_id, actor_id
+        ) values (?, ?, ?, ?)
+        """,
+        [
+            (operation_by, operation, group_id, actor_id)
+            for operation, group_id, actor_id in group_audit
+        ],
+    )
+
+    # Grants, compared by (database, table, glob, action, group, actor)
+    action_ids = _ids(conn, "select name, id from acl_actions")
+    for database, table, glob, action, group, actor in grants:
+        if action not in action_ids:
+            raise InvalidImport("Unknown action: {}".format(action))
+        if group is not None and group not in live:
+            raise InvalidImport("Unknown group: {}".format(group))
+    conn.executemany(
+        "insert or ignore into acl_resources (database, resource, glob) values (?, ?, ?)",
+        {(grant[0], grant[1], grant[2]) for grant in grants},
+    )
+    resource_ids = {
+        (row[1], row[2], row[3]): row[0]
+        for row in conn.execute(
+            "select id, database, resource, glob from acl_resources"
+        )
+    }
+    wanted = set(grants)
+    imported_resources = {grant[:3] for grant in grants}
+    current_grants = {}
+    for row in conn.execute(CURRENT_GRANTS_SQL):
+        acl_id, database, table, glob, action, group_id, actor_id = row
+        # Without replace, only resources mentioned in the import are synced
+        if replace or (database, table, glob) in imported_resources:
+            grant = (database, table, glob, action, group_names.get(group_id), actor_id)
+            current_grants[grant] = acl_id
+    removed_grants = [
+        (acl_id, grant)
+        for grant, acl_id in current_grants.items()
+        if grant not in wanted
+    ]
+    added_grants = [grant for grant in grants if grant not in current_grants]
+
+    def audit_params(operation, grant):
+        database, table, glob, action, group, actor = grant
+        return (
+            operation,
+            actor,
+            group_ids[group] if group is not None else None,
+            resource_ids[(database, table, glob)],
+            action_ids[action],
+            operation_by,
+        )
+
+    conn.executemany(
+        "delete from acl where acl_id = ?", [(acl_id,) for acl_id, _ in removed_grants]
+    )
+    conn.executemany(
+        """
+        insert into acl (actor_id, group_id, resource_id, action_id)
+        values (?, ?, ?, ?)
+        """,
+        [audit_params("added", grant)[1:5] for grant in added_grants],
+    )
+    conn.executemany(
+        """
+        insert into acl_audit (
+            operation, actor_id, group_id, resource_id, action_id, operation_by
+        ) values (?, ?, ?, ?, ?, ?)
+        """,
+        [audit_params("removed", grant) for _, grant in removed_grants]
+        + [audit_params("added", grant) for grant in added_grants],
+    )
+    counts["grants"]["added"] = len(added_grants)
+    counts["grants"]["removed"] = len(removed_grants)
+    return counts
+
+
+async def import_json(request, datasette):
+    """
+    Bring groups, memberships and grants in line with a JSON document in the
+    /-/acl/export.json format, in a single transaction
+    """
+    if not await can_edit_permissions(datasette, request.actor):
+        raise Forbidden("You do not have permission to edit permissions")
+    if request.method != "POST":
+        return Response.json(
+            {"ok": False, "error": "POST a JSON document to import"}, status=405
+        )
+    dynamic_groups = get_dynamic_groups(datasette)
+    try:
+        data = json.loads(await request.post_body())
+    except ValueError:
+        return Response.json({"ok": False, "error": "Invalid JSON"}, status=400)
+    try:
+        groups, grants, replace = parse_import(data, dynamic_groups)
+    except InvalidImport as ex:
+        return Response.json({"ok": False, "error": str(ex)}, status=400)
+    actor_ids = {grant[5] for grant in grants if grant[5] is not None}
+    for group in groups.values():
+        actor_ids |= group["members"] or set()
+    invalid = await invalid_actor_ids(datasette, sorted(actor_ids))
+    if invalid:
+        return Response.json(
+            {"ok": False, "error": "Invalid actor IDs", "invalid": invalid},
+            status=400,
+        )
+    try:
+        counts = await execute_acl_write_fn(
+            datasette,
+            lambda conn: apply_import(
+                conn, groups, grants, replace, dynamic_groups, request.actor["id"]
+            ),
+            source="import",
+        )
+    except InvalidImport as ex:
+        return Response.json({"ok": False, "error": str(ex)}, status=400)
+    # Too many changes to apply one at a time
+    get_permission_index(datasette).clear()
+    return Response.json({"ok": True, **counts})
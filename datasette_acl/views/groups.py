@@ -1,9 +1,18 @@
 from datasette import Response, Forbidden, NotFound
+from datasette_acl.audit import audit_json, audit_page_args, fetch_audit_page
+from datasette_acl.index import (
+    execute_acl_write_fn,
+    get_permission_index,
+)
 from datasette_acl.utils import (
     can_edit_permissions,
-    get_acl_valid_actors,
+    has_valid_actors,
+    invalid_actor_ids,
     validate_actor_id,
 )
+from typing import List
+import csv
+import io
 import json
 import re
 
@@ -31,11 +40,50 @@ order by
 """
 
 
+NESTED_GROUP_AUDIT_SQL = """
+insert into acl_groups_audit (
+    operation_by, operation, group_id, member_group_id
+) values (?, ?, ?, ?)
+"""
+
+# Groups directly inside this one, and groups this one is directly inside
+NESTED_GROUPS_SQL = """
+select 'member' as relation, acl_groups.name
+from acl_group_groups
+join acl_groups on acl_groups.id = acl_group_groups.child_id
+where acl_group_groups.parent_id = :group_id
+  union all
+select 'parent' as relation, acl_groups.name
+from acl_group_groups
+join acl_groups on acl_groups.id = acl_group_groups.parent_id
+where acl_group_groups.child_id = :group_id
+order by name
+"""
+
+# Groups that could be added to this one without creating a cycle
+AVAILABLE_MEMBER_GROUPS_SQL = """
+select name from acl_groups
+where deleted is null
+and id not in (
+    select ancestor_id from acl_group_closure where descendant_id = :group_id
+)
+and id not in (
+    select child_id from acl_group_groups where parent_id = :group_id
+)
+order by name
+"""
+
+
 def get_dynamic_groups(datasette):
-    config = datasette.plugin_config("datasette-acl")
+    config = datasette.plugin_config("datasette-acl") or {}
     return config.get("dynamic-groups") or {}
 
 
+def get_dynamic_groups_mode(datasette):
+    config = datasette.plugin_config("datasette-acl") or {}
+    return config.get("dynamic-groups-mode") or "stored"
+
+
 _group_name_re = re.compile(r"^[a-zA-Z0-9_-]+$")
 
 
@@ -43,6 +91,257 @@ def is_valid_group_name(new_group):
     return bool(_group_name_re.match(new_group))
 
 
+def parse_actor_ids(text: str) -> List[str]:
+    """
+    Actor IDs from pasted text or CSV - one per line and/or comma separated.
+    If the first row has an "id" or "actor_id" column header, only that
+    column is used.
+    """
+    rows = [
+        [cell.strip() for cell in row]
+        for row in csv.reader(io.StringIO(text.strip()))
+        if any(cell.strip() for cell in row)
+    ]
+    if not rows:
+        return []
+    header = [cell.lower() for cell in rows[0]]
+    for column in ("actor_id", "id"):
+        if column in header:
+            position = header.index(column)
+            actor_ids = [row[position] for row in rows[1:] if len(row) > position]
+            break
+    else:
+        actor_ids = [cell for row in rows for cell in row]
+    # De-duplicate, preserving order
+    return list(dict.fromkeys(actor_id for actor_id in actor_ids if actor_id))
+
+
+async def change_group_members(
+    datasette,
+    *,
+    group_id,
+    group_name,
+    operation_by,
+    add=(),
+    remove=(),
+    delete_group=False,
+):
+    """
+    Add and remove group members in a single transaction, writing an audit
+    row for each change. IDs that are already members (for add) or are not
+    members (for remove) are skipped. Returns (added, removed) lists.
+    """
+
+    def apply_changes(conn):
+        current = {
+            row[0]
+            for row in conn.execute(
+                "select actor_id from acl_actor_groups where group_id = ?",
+                [group_id],
+            )
+        }
+        removed = [actor_id for actor_id in remove if actor_id in current]
+        added = [actor_id for actor_id in add if actor_id not in current]
+        conn.executemany(
+            "delete from acl_actor_groups where actor_id = ? and group_id = ?",
+            [(actor_id, group_id) for actor_id in removed],
+        )
+        conn.executemany(
+            "insert into acl_actor_groups (actor_id, group_id) values (?, ?)",
+            [(actor_id, group_id) for actor_id in added],
+        )
+        audit_rows = [("removed", actor_id) for actor_id in removed] + [
+            ("added", actor_id) for actor_id in added
+        ]
+        nested = []
+        if delete_group:
+            conn.execute("update acl_groups set deleted = 1 where id = ?", [group_id])
+            audit_rows.append(("deleted", None))
+            # A deleted group no longer contains, or is contained by, any group
+            nested = conn.execute(
+                """
+                select parent_id, child_id from acl_group_groups
+                where parent_id = :group_id or child_id = :group_id
+                """,
+                {"group_id": group_id},
+            ).fetchall()
+            conn.executemany(
+                "delete from acl_group_groups where parent_id = ? and child_id = ?",
+                nested,
+            )
+        conn.executemany(
+            """
+            insert into acl_groups_audit (
+                operation_by, operation, group_id, actor_id
+            ) values (?, ?, ?, ?)
+            """,
+            [
+                (operation_by, operation, group_id, actor_id)
+                for operation, actor_id in audit_rows
+            ],
+        )
+        conn.executemany(
+            NESTED_GROUP_AUDIT_SQL,
+            [
+                (operation_by, "removed", parent_id, child_id)
+                for parent_id, child_id in nested
+            ],
+        )
+        return added, removed, bool(nested)
+
+    added, removed, nesting_changed = await execute_acl_write_fn(
+        datasette, apply_changes, source="manage_group"
+    )
+    index = get_permission_index(datasette)
+    if nesting_changed:
+        index.nesting_changed()
+    for actor_id in removed:
+        index.member_removed(actor_id, group_name)
+    for actor_id in added:
+        index.member_added(actor_id, group_name)
+    return added, removed
+
+
+async def change_member_groups(datasette, *, group_id, operation_by, add=(), remove=()):
+    """
+    Add and remove groups nested inside this group in a single transaction,
+    writing an audit row for each change. Returns (added, removed) lists of
+    group names. Raises sqlite3.IntegrityError if a group to add already
+    contains this group.
+    """
+
+    def apply_changes(conn):
+        group_ids = dict(
+            conn.execute(
+                """
+                select name, id from acl_groups
+                where name in (select value from json_each(?))
+                """,
+                [json.dumps(list(add) + list(remove))],
+            ).fetchall()
+        )
+        current = {
+            row[0]
+            for row in conn.execute(
+                "select child_id from acl_group_groups where parent_id = ?",
+                [group_id],
+            )
+        }
+        removed = [name for name in remove if group_ids.get(name) in current]
+        added = [
+            name for name in add if name in group_ids and group_ids[name] not in current
+        ]
+        # The closure table is maintained by triggers on acl_group_groups
+        conn.executemany(
+            "delete from acl_group_groups where parent_id = ? and child_id = ?",
+            [(group_id, group_ids[name]) for name in removed],
+        )
+        conn.executemany(
+            "insert into acl_group_groups (parent_id, child_id) values (?, ?)",
+            [(group_id, group_ids[name]) for name in added],
+        )
+        conn.executemany(
+            NESTED_GROUP_AUDIT_SQL,
+            [(operation_by, "removed", group_id, group_ids[name]) for name in removed]
+            + [(operation_by, "added", group_id, group_ids[name]) for name in added],
+        )
+        return added, removed
+
+    added, removed = await execute_acl_write_fn(
+        datasette, apply_changes, source="manage_group"
+    )
+    if added or removed:
+        get_permission_index(datasette).nesting_changed()
+    return added, removed
+
+
+async def bulk_change_members(
+    datasette, *, group_id, group_name, operation_by, add, remove
+):
+    "Validate and apply a bulk membership change, returning a summary"
+    invalid = await invalid_actor_ids(datasette, add)
+    invalid_set = set(invalid)
+    added, removed = await change_group_members(
+        datasette,
+        group_id=group_id,
+        group_name=group_name,
+        operation_by=operation_by,
+        add=[actor_id for actor_id in add if actor_id not in invalid_set],
+        remove=remove,
+    )
+    changed = set(added) | set(removed)
+    return {
+        "added": added,
+        "removed": removed,
+        "invalid": invalid,
+        "unchanged": [
+            actor_id
+            for actor_id in list(dict.fromkeys(add + remove))
+            if actor_id not in changed and actor_id not in invalid_set
+        ],
+    }
+
+
+def summary_message(summary):
+    messages = []
+    for key, label in (
+        ("added", "Added"),
+        ("removed", "Removed"),
+        ("unchanged", "Unchanged"),
+        ("invalid", "Invalid user IDs"),
+    ):
+        if summary[key]:
+            messages.append(
+                "{} {}: {}".format(label, len(summary[key]), ", ".join(summary[key]))
+            )
+    return "; ".join(messages) or "No changes"
+
+
+async def bulk_change_members_api(
+    request, datasette, content_type, group_id, group_name, dynamic_config
+):
+    """
+    Bulk membership changes as JSON {"add": [...], "remove": [...]} or as a
+    CSV of actor IDs to add, returning a JSON summary
+    """
+    if dynamic_config:
+        return Response.json(
+            {"ok": False, "error": "Dynamic group members cannot be edited"},
+            status=400,
+        )
+    body = (await request.post_body()).decode("utf-8")
+    if content_type == "text/csv":
+        add, remove = parse_actor_ids(body), []
+    else:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not all(
+            isinstance(data.get(key, []), list) for key in ("add", "remove")
+        ):
+            return Response.json(
+                {
+                    "ok": False,
+                    "error": 'Body must be JSON: {"add": [...], "remove": [...]}',
+                },
+                status=400,
+            )
+        add = list(dict.fromkeys(str(actor_id) for actor_id in data.get("add", [])))
+        remove = list(
+            dict.fromkeys(str(actor_id) for actor_id in data.get("remove", []))
+        )
+    summary = await bulk_change_members(
+        datasette,
+        group_id=group_id,
+        group_name=group_name,
+        operation_by=request.actor["id"],
+        add=add,
+        remove=remove,
+    )
+    return Response.json({"ok": True, **summary})
+
+
 async def manage_groups(request, datasette):
     if not await can_edit_permissions(datasette, request.actor):
         raise Forbidden("You do not have permission to edit permissions")
@@ -78,28 +377,35 @@ async def manage_groups(request, datasette):
                 )
                 return Response.redirect(datasette.urls.path("/-/acl/groups"))
             else:
-                # Create group if it does not exist
-                await internal_db.execute_write(
-                    "insert or ignore into acl_groups (name) values (:name)",
-                    {"name": new_group},
-                )
-                # Ensure it is not marked as deleted
-                await internal_db.execute_write(
-                    "update acl_groups set deleted = null where name = :name",
-                    {"name": new_group},
-                )
-                # Audit log record
-                await internal_db.execute_write(
-                    """
-                    insert into acl_groups_audit (
-                        operation_by, operation, group_id
-                    ) values (
-                        :operation_by,
-                        'created',
-                        (select id from acl_groups where name = :group_name)
+                params = {"name": new_group, "operation_by": request.actor["id"]}
+
+                def create_group(conn):
+                    # Create group if it does not exist
+                    conn.execute(
+                        "insert or ignore into acl_groups (name) values (:name)",
+                        params,
                     )
-                """,
-                    {"operation_by": request.actor["id"], "group_name": new_group},
+                    # Ensure it is not marked as deleted
+                    conn.execute(
+                        "update acl_groups set deleted = null where name = :name",
+                        params,
+                    )
+                    # Audit log record, in the same transaction
+                    conn.execute(
+                        """
+                        insert into acl_groups_audit (
+                            operation_by, operation, group_id
+                        ) values (
+                            :operation_by,
+                            'created',
+                            (select id from acl_groups where name = :name)
+                        )
+                        """,
+                        params,
+                    )
+
+                await execute_acl_write_fn(
+                    datasette, create_group, source="manage_groups"
                 )
                 datasette.add_message(request, f"Group created: {new_group}")
                 return Response.redirect(
@@ -119,6 +425,43 @@ async def manage_groups(request, datasette):
     )
 
 
+GROUP_AUDIT_SQL = """
+select
+    acl_groups_audit.id,
+    acl_groups_audit.timestamp,
+    acl_groups_audit.operation_by,
+    acl_groups_audit.operation,
+    acl_groups_audit.actor_id,
+    member_groups.name as member_group
+from acl_groups_audit
+left join acl_groups member_groups
+    on member_groups.id = acl_groups_audit.member_group_id
+where acl_groups_audit.group_id = :group_id and acl_groups_audit.id < :next
+order by acl_groups_audit.id desc
+limit :size + 1
+"""
+
+
+async def group_audit_json(request, datasette):
+    if not await can_edit_permissions(datasette, request.actor):
+        raise Forbidden("You do not have permission to edit permissions")
+    internal_db = datasette.get_internal_database()
+    group = (
+        await internal_db.execute(
+            "select id from acl_groups where name = ?", [request.url_vars["name"]]
+        )
+    ).first()
+    if not group:
+        raise NotFound("Group does not exist")
+    next_id, size = audit_page_args(request)
+    audit_log, audit_next = await fetch_audit_page(
+        internal_db,
+        GROUP_AUDIT_SQL,
+        {"group_id": group["id"], "next": next_id, "size": size},
+    )
+    return Response.json(audit_json(request, audit_log, audit_next))
+
+
 async def manage_group(request, datasette):
     if not await can_edit_permissions(datasette, request.actor):
         raise Forbidden("You do not have permission to edit permissions")
@@ -139,56 +482,78 @@ async def manage_group(request, datasette):
     dynamic_config = dynamic_groups.get(name)
     actor_ids = json.loads(group["actor_ids"])
 
-    async def audit_log(*, operation, actor_id=None):
-        await internal_db.execute_write(
-            f"""
-            insert into acl_groups_audit (
-                operation_by, operation, group_id, actor_id
-            ) values (
-                :operation_by,
-                :operation,
-                :group_id,
-                {':actor_id' if actor_id else 'null'}
+    if request.method == "POST":
+        content_type = request.headers.get("content-type", "").split(";")[0].strip()
+        if content_type in ("application/json", "text/csv"):
+            return await bulk_change_members_api(
+                request, datasette, content_type, group_id, name, dynamic_config
             )
-        """,
-            {
-                "operation_by": request.actor["id"],
-                "operation": operation,
-                "group_id": group_id,
-                "actor_id": actor_id,
-            },
-        )
-
-    async def remove_member(actor_id):
-        await internal_db.execute_write(
-            """
-            delete from acl_actor_groups
-            where actor_id = :actor_id
-            and group_id = :group_id
-        """,
-            {"actor_id": actor_id, "group_id": group_id},
-        )
-        await audit_log(operation="removed", actor_id=actor_id)
 
     if request.method == "POST" and not dynamic_config:
         post_vars = await request.post_vars()
         to_add = post_vars.get("add")
         to_remove = post_vars.get("remove")
+        add_group = post_vars.get("add_group")
+        remove_group = post_vars.get("remove_group")
 
         should_delete = post_vars.get("delete_group")
         if should_delete:
-            # First remove all the members
-            for actor_id in actor_ids:
-                await remove_member(actor_id)
-            # Now mark the group as deleted and record
-            await internal_db.execute_write(
-                "update acl_groups set deleted = 1 where id = :group_id",
-                {"group_id": group_id},
+            # Remove all the members and mark the group as deleted
+            await change_group_members(
+                datasette,
+                group_id=group_id,
+                group_name=name,
+                operation_by=request.actor["id"],
+                remove=actor_ids,
+                delete_group=True,
             )
-            await audit_log(operation="deleted")
             datasette.add_message(request, f"Group deleted: {name}")
             return Response.redirect(datasette.urls.path("/-/acl/groups"))
 
+        bulk_add = parse_actor_ids(post_vars.get("bulk_add") or "")
+        bulk_remove = parse_actor_ids(post_vars.get("bulk_remove") or "")
+        if bulk_add or bulk_remove:
+            summary = await bulk_change_members(
+                datasette,
+                group_id=group_id,
+                group_name=name,
+                operation_by=request.actor["id"],
+                add=bulk_add,
+                remove=bulk_remove,
+            )
+            datasette.add_message(
+                request,
+                summary_message(summary),
+                datasette.ERROR if summary["invalid"] else datasette.INFO,
+            )
+            return Response.redirect(request.path)
+
+        if add_group or remove_group:
+            if add_group and add_group not in [
+                row["name"]
+                for row in await internal_db.execute(
+                    AVAILABLE_MEMBER_GROUPS_SQL, {"group_id": group_id}
+                )
+            ]:
+                datasette.add_message(
+                    request,
+                    "That group cannot be added to this group",
+                    datasette.ERROR,
+                )
+                return Response.redirect(request.path)
+            added, removed = await change_member_groups(
+                datasette,
+                group_id=group_id,
+                operation_by=request.actor["id"],
+                add=[add_group] if add_group else [],
+                remove=[remove_group] if remove_group else [],
+            )
+            for group_name in added:
+                datasette.add_message(request, f"Added group {group_name}")
+            for group_name in removed:
+                datasette.add_message(request, f"Removed group {group_name}")
+            return Response.redirect(request.path)
+
         fragment = ""
         if to_remove:
             if to_remove not in actor_ids:
@@ -196,7 +561,13 @@ async def manage_group(request, datasette):
                     request, "That user is not in the group", datasette.ERROR
                 )
             else:
-                await remove_member(to_remove)
+                await change_group_members(
+                    datasette,
+                    group_id=group_id,
+                    group_name=name,
+                    operation_by=request.actor["id"],
+                    remove=[to_remove],
+                )
                 datasette.add_message(request, f"Removed {to_remove}")
         if to_add:
             if to_add in actor_ids:
@@ -210,18 +581,24 @@ async def manage_group(request, datasette):
                         request, "That user ID is not valid", datasette.ERROR
                     )
                     return Response.redirect(request.path)
-                await internal_db.execute_write(
-                    """
-                    insert into acl_actor_groups (actor_id, group_id)
-                    values (:actor_id, :group_id)
-                """,
-                    {"actor_id": to_add, "group_id": group_id},
+                await change_group_members(
+                    datasette,
+                    group_id=group_id,
+                    group_name=name,
+                    operation_by=request.actor["id"],
+                    add=[to_add],
                 )
                 datasette.add_message(request, f"Added {to_add}")
-                await audit_log(operation="added", actor_id=to_add)
                 fragment = "#focus-add"
         return Response.redirect(request.path + fragment)
 
+    next_id, size = audit_page_args(request)
+    audit_log, audit_next = await fetch_audit_page(
+        internal_db,
+        GROUP_AUDIT_SQL,
+        {"group_id": group_id, "next": next_id, "size": size},
+    )
+    nested = await internal_db.execute(NESTED_GROUPS_SQL, {"group_id": group_id})
     return Response.html(
         await datasette.render_template(
             "manage_acl_group.html",
@@ -230,21 +607,24 @@ async def manage_group(request, datasette):
                 "size": group["size"],
                 "is_deleted": group["deleted"],
                 "members": actor_ids,
-                "dynamic_config": dynamic_config,
-                "audit_log": [
-                    dict(r)
-                    for r in await internal_db.execute(
-                        """
-                        select
-                            timestamp, operation_by, operation, actor_id
-                        from acl_groups_audit
-                        where group_id = ?
-                        order by id desc
-                    """,
-                        [group_id],
+                "member_groups": [
+                    row["name"] for row in nested if row["relation"] == "member"
+                ],
+                "parent_groups": [
+                    row["name"] for row in nested if row["relation"] == "parent"
+                ],
+                "available_groups": [
+                    row["name"]
+                    for row in await internal_db.execute(
+                        AVAILABLE_MEMBER_GROUPS_SQL, {"group_id": group_id}
                     )
                 ],
-                "valid_actors": await get_acl_valid_actors(datasette),
+                "dynamic_config": dynamic_config,
+                "dynamic_mode": get_dynamic_groups_mode(datasette),
+                "audit_log": audit_log,
+                "audit_next": audit_next,
+                # Actors are loaded from /-/acl/actors.json as the user types
+                "actor_autocomplete": await has_valid_actors(datasette),
             },
             request=request,
         )
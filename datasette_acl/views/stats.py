@@ -0,0 +1,42 @@
+from datasette import Response, Forbidden
+from datasette_acl.cache import get_caches
+from datasette_acl.index import get_permission_index
+from datasette_acl.stats import PREFIX, get_stats, to_prometheus
+from datasette_acl.utils import can_edit_permissions
+
+
+def cache_stats(datasette):
+    caches = {"permission-index": get_permission_index(datasette).actors.stats()}
+    for name, cache in get_caches(datasette).items():
+        caches[name] = cache.stats()
+    return caches
+
+
+async def acl_stats(request, datasette):
+    "Counters and latency histograms, as JSON or Prometheus text with .txt"
+    if not await can_edit_permissions(datasette, request.actor):
+        raise Forbidden("You do not have permission to view these statistics")
+    data = get_stats(datasette).to_json()
+    data["caches"] = cache_stats(datasette)
+    for key, metric in (
+        ("hits", "cache_hits_total"),
+        ("misses", "cache_misses_total"),
+        ("evictions", "cache_evictions_total"),
+        ("size", "cache_size"),
+    ):
+        for name, stats in data["caches"].items():
+            data["counters"].append(
+                {
+                    "name": PREFIX + metric,
+                    "labels": {"cache": name},
+                    "value": stats[key],
+                }
+            )
+    # The Prometheus format needs all of a metric's samples in one group
+    data["counters"].sort(key=lambda counter: counter["name"])
+    if request.url_vars.get("format") == ".txt":
+        return Response(
+            to_prometheus(data),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+    return Response.json(data)
@@ -1,55 +1,160 @@
 from datasette import Response, Forbidden
 from datasette.utils import MultiParams
+from datasette_acl.audit import audit_json, audit_page_args, fetch_audit_page
+from datasette_acl.ids import get_id_maps
+from datasette_acl.index import Glob, execute_acl_write_fn, get_permission_index
 from datasette_acl.utils import (
     can_edit_permissions,
     generate_changes_message,
-    get_acl_valid_actors,
+    has_valid_actors,
     validate_actor_id,
 )
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, urlencode
+
+TABLE_ACTIONS = [
+    "insert-row",
+    "delete-row",
+    "update-row",
+    "alter-table",
+    "drop-table",
+]
+
+# Group changes have a null actor_id, user changes a null group_id
+INSERT_ACL_SQL = """
+insert into acl (actor_id, group_id, resource_id, action_id)
+values (:actor_id, :group_id, :resource_id, :action_id)
+"""
+
+DELETE_ACL_SQL = """
+delete from acl
+where actor_id is :actor_id
+and group_id is :group_id
+and resource_id = :resource_id
+and action_id = :action_id
+"""
+
+INSERT_AUDIT_SQL = """
+insert into acl_audit (
+    operation,
+    actor_id,
+    group_id,
+    resource_id,
+    action_id,
+    operation_by
+) values (
+    :operation,
+    :actor_id,
+    :group_id,
+    :resource_id,
+    :action_id,
+    :operation_by
+)
+"""
+
+DATABASE_GLOBS_SQL = """
+select distinct acl_resources.glob
+from acl_resources
+join acl on acl.resource_id = acl_resources.id
+where acl_resources.database = :database and acl_resources.glob is not null
+order by acl_resources.glob
+"""
+
+TABLE_AUDIT_SQL = """
+select
+    acl_audit.id,
+    acl_audit.timestamp,
+    acl_audit.operation_by,
+    acl_audit.operation,
+    acl_audit.actor_id,
+    acl_groups.name as group_name,
+    acl_actions.name as action_name
+from acl_audit
+left join acl_groups on acl_audit.group_id = acl_groups.id
+join acl_actions on acl_audit.action_id = acl_actions.id
+where acl_audit.resource_id = :resource_id and acl_audit.id < :next
+order by acl_audit.id desc
+limit :size + 1
+"""
+
+
+def resource_args(request):
+    """
+    (database, resource, glob) for a table or database permissions page. A
+    database page with ?glob= manages grants for tables matching the pattern.
+    """
+    database = request.url_vars["database"]
+    table = request.url_vars.get("table")
+    if table is not None:
+        return database, table, None
+    glob = (request.args.get("glob") or "").strip() or None
+    return database, None, glob
+
+
+async def table_acl_audit_json(request, datasette):
+    if not await can_edit_permissions(datasette, request.actor):
+        raise Forbidden("You do not have permission to edit permissions")
+    internal_db = datasette.get_internal_database()
+    database, table, glob = resource_args(request)
+    # No resource row means no permissions have been edited for this table
+    resource_id = await get_id_maps(datasette).resource_id(
+        internal_db, database, table, glob
+    )
+    next_id, size = audit_page_args(request)
+    audit_log, audit_next = await fetch_audit_page(
+        internal_db,
+        TABLE_AUDIT_SQL,
+        {"resource_id": resource_id, "next": next_id, "size": size},
+    )
+    return Response.json(audit_json(request, audit_log, audit_next))
 
 
 async def manage_table_acls(request, datasette):
+    """
+    Manage permissions for a table, for every table in a database or, with
+    ?glob=, for tables with names matching a pattern
+    """
     if not await can_edit_permissions(datasette, request.actor):
         raise Forbidden("You do not have permission to edit permissions")
-    table = request.url_vars["table"]
-    database = request.url_vars["database"]
+    database, table, glob = resource_args(request)
     internal_db = datasette.get_internal_database()
-    groups = [
-        g["name"]
-        for g in await datasette.get_internal_database().execute(
-            "select name from acl_groups where deleted is null"
-        )
-    ]
+    index = get_permission_index(datasette)
+    id_maps = get_id_maps(datasette)
+    groups = []
+    for g in await internal_db.execute(
+        "select id, name from acl_groups where deleted is null"
+    ):
+        groups.append(g["name"])
+        id_maps.groups[g["name"]] = g["id"]
+    # The key for this resource in the permission index
+    index_resource = Glob(glob) if glob is not None else table
+    # Form submissions redirect back here, keeping the ?glob=
+    page_path = request.path
+    if glob is not None:
+        page_path += "?" + urlencode({"glob": glob})
 
-    # Ensure we have a resource_id for this table
-    await internal_db.execute_write(
-        "INSERT OR IGNORE INTO acl_resources (database, resource) VALUES (?, ?);",
-        [database, table],
-    )
-    resource_id = (
-        await internal_db.execute(
-            "SELECT id FROM acl_resources WHERE database = ? AND resource = ?",
-            [database, table],
-        )
-    ).single_value()
+    # None if no permissions have been edited here - the resource row is
+    # created by the first change, so viewing this page does not write
+    resource_key = (database, table, glob)
+    resource_id = await id_maps.resource_id(internal_db, *resource_key)
 
     current_group_permissions = {}
     current_user_permissions = {}
-    acl_rows = await internal_db.execute(
-        """
-        select
-          acl_groups.name as group_name,
-          acl.actor_id,
-          acl_actions.name as action_name
-        from acl
-        left join acl_groups on acl.group_id = acl_groups.id
-        join acl_actions on acl.action_id = acl_actions.id
-        where acl.resource_id = ? and acl_groups.deleted is null
-        """,
-        [resource_id],
-    )
-    for row in acl_rows.rows:
+    acl_rows = []
+    if resource_id is not None:
+        acl_rows = await internal_db.execute(
+            """
+            select
+              acl_groups.name as group_name,
+              acl.actor_id,
+              acl_actions.name as action_name
+            from acl
+            left join acl_groups on acl.group_id = acl_groups.id
+            join acl_actions on acl.action_id = acl_actions.id
+            where acl.resource_id = ? and acl_groups.deleted is null
+            """,
+            [resource_id],
+        )
+    for row in acl_rows:
         group_name = row["group_name"]
         actor_id = row["actor_id"]
         action_name = row["action_name"]
@@ -61,214 +166,139 @@ async def manage_table_acls(request, datasette):
             current_user_permissions.setdefault(actor_id, {})[action_name] = True
 
     if request.method == "POST":
-        group_changes_made = {"added": [], "removed": []}
         body = await request.post_body()
         post_vars = MultiParams(
             parse_qs(qs=body.decode("utf-8"), keep_blank_values=True)
         )
+        user_selections = {
+            actor_id: post_vars.getlist(f"user_permissions_{actor_id}")
+            for actor_id in current_user_permissions
+        }
+        # This is the special case for new_user_{{ action }}
+        new_actor_id = (post_vars.get("new_actor_id") or "").strip()
+        if new_actor_id:
+            if not await validate_actor_id(datasette, new_actor_id):
+                datasette.add_message(
+                    request, "That user ID is not valid", datasette.ERROR
+                )
+                return Response.redirect(page_path)
+            user_selections.setdefault(new_actor_id, []).extend(
+                post_vars.getlist("new_user_actions")
+            )
+
+        # Work out every change before writing any of them
+        changes = []
         for group_name in groups:
             selected_group_actions = post_vars.getlist(
                 f"group_permissions_{group_name}"
             )
-            for action_name in [
-                "insert-row",
-                "delete-row",
-                "update-row",
-                "alter-table",
-                "drop-table",
-            ]:
+            for action_name in TABLE_ACTIONS:
                 new_value = action_name in selected_group_actions
                 current_value = bool(
                     current_group_permissions.get(group_name, {}).get(action_name)
                 )
                 if new_value != current_value:
-                    if new_value:
-                        # They added it, add the record
-                        await internal_db.execute_write(
-                            """
-                            INSERT INTO acl (actor_id, group_id, resource_id, action_id)
-                            VALUES (
-                                null,
-                                (SELECT id FROM acl_groups WHERE name = :group_name),
-                                :resource_id,
-                                (SELECT id FROM acl_actions WHERE name = :action_name)
-                            )
-                            """,
-                            {
-                                "group_name": group_name,
-                                "action_name": action_name,
-                                "resource_id": resource_id,
-                            },
-                        )
-                        operation = "added"
-                        group_changes_made["added"].append((group_name, action_name))
-                    else:
-                        # They removed it
-                        await internal_db.execute_write(
-                            """
-                            delete from acl where
-                                actor_id is null and 
-                                group_id = (SELECT id FROM acl_groups WHERE name = :group_name)
-                                and resource_id = :resource_id
-                                and action_id = (SELECT id FROM acl_actions WHERE name = :action_name)
-                            """,
-                            {
-                                "group_name": group_name,
-                                "action_name": action_name,
-                                "resource_id": resource_id,
-                            },
-                        )
-                        operation = "removed"
-                        group_changes_made["removed"].append((group_name, action_name))
-                    await internal_db.execute_write(
-                        """
-                        insert into acl_audit (
-                            operation,
-                            actor_id,
-                            group_id,
-                            resource_id,
-                            action_id,
-                            operation_by
-                        ) values (
-                            :operation,
-                            null,
-                            (SELECT id FROM acl_groups WHERE name = :group_name),
-                            :resource_id,
-                            (SELECT id FROM acl_actions WHERE name = :action_name),
-                            :operation_by
-                        )
-                        """,
+                    changes.append(
                         {
-                            "operation": operation,
+                            "operation": "added" if new_value else "removed",
                             "group_name": group_name,
-                            "resource_id": resource_id,
+                            "actor_id": None,
                             "action_name": action_name,
-                            "operation_by": request.actor["id"],
-                        },
+                        }
                     )
-        user_changes_made = {"added": [], "removed": []}
-        for actor_id in list(current_user_permissions) + [None]:
-            if actor_id is None:
-                # This is the special case for new_user_{{ action }}
-                actor_id = (post_vars.get("new_actor_id") or "").strip()
-                if not actor_id:
-                    continue
-                if not await validate_actor_id(datasette, actor_id):
-                    datasette.add_message(
-                        request, "That user ID is not valid", datasette.ERROR
-                    )
-                    return Response.redirect(request.path)
-                user_actions_key = "new_user_actions"
-            else:
-                user_actions_key = f"user_permissions_{actor_id}"
-
-            selected_user_actions = post_vars.getlist(user_actions_key)
-
-            for action_name in [
-                "insert-row",
-                "delete-row",
-                "update-row",
-                "alter-table",
-                "drop-table",
-            ]:
+        for actor_id, selected_user_actions in user_selections.items():
+            for action_name in TABLE_ACTIONS:
                 new_value = action_name in selected_user_actions
                 current_value = bool(
                     current_user_permissions.get(actor_id, {}).get(action_name)
                 )
                 if new_value != current_value:
-                    if new_value:
-                        # They added the permission
-                        await internal_db.execute_write(
-                            """
-                            insert into acl (actor_id, group_id, resource_id, action_id)
-                            values (
-                                :actor_id,
-                                null,
-                                :resource_id,
-                                (select id from acl_actions where name = :action_name)
-                            )
-                            """,
-                            {
-                                "actor_id": actor_id,
-                                "action_name": action_name,
-                                "resource_id": resource_id,
-                            },
-                        )
-                        operation = "added"
-                        user_changes_made["added"].append((actor_id, action_name))
-                    else:
-                        # They removed the permission
-                        await internal_db.execute_write(
-                            """
-                            delete from acl where
-                                actor_id = :actor_id
-                                and group_id is null
-                                and resource_id = :resource_id
-                                and action_id = (select id from acl_actions where name = :action_name)
-                            """,
-                            {
-                                "actor_id": actor_id,
-                                "action_name": action_name,
-                                "resource_id": resource_id,
-                            },
-                        )
-                        operation = "removed"
-                        user_changes_made["removed"].append((actor_id, action_name))
-                    await internal_db.execute_write(
-                        """
-                        insert into acl_audit (
-                            operation,
-                            actor_id,
-                            group_id,
-                            resource_id,
-                            action_id,
-                            operation_by
-                        ) values (
-                            :operation,
-                            :actor_id,
-                            null,
-                            :resource_id,
-                            (SELECT id FROM acl_actions WHERE name = :action_name),
-                            :operation_by
-                        )
-                        """,
+                    changes.append(
                         {
-                            "operation": operation,
+                            "operation": "added" if new_value else "removed",
+                            "group_name": None,
                             "actor_id": actor_id,
-                            "resource_id": resource_id,
                             "action_name": action_name,
-                            "operation_by": request.actor["id"],
-                        },
+                        }
                     )
 
-        if group_changes_made or user_changes_made:
-            group_message = generate_changes_message(group_changes_made, "group")
-            if group_message:
-                datasette.add_message(request, group_message)
-            user_message = generate_changes_message(user_changes_made, "user")
-            if user_message:
-                datasette.add_message(request, user_message)
+        if changes:
+            action_ids = {
+                action_name: await id_maps.action_id(internal_db, action_name)
+                for action_name in TABLE_ACTIONS
+            }
+            params = [
+                {
+                    "operation": change["operation"],
+                    "actor_id": change["actor_id"],
+                    "group_id": (
+                        id_maps.groups[change["group_name"]]
+                        if change["group_name"]
+                        else None
+                    ),
+                    "action_id": action_ids[change["action_name"]],
+                    "operation_by": request.actor["id"],
+                }
+                for change in changes
+            ]
+
+            def apply_changes(conn):
+                resource_id = id_maps.ensure_resource_id(conn, resource_key)
+                for p in params:
+                    p["resource_id"] = resource_id
+                conn.executemany(
+                    DELETE_ACL_SQL, [p for p in params if p["operation"] == "removed"]
+                )
+                conn.executemany(
+                    INSERT_ACL_SQL, [p for p in params if p["operation"] == "added"]
+                )
+                conn.executemany(INSERT_AUDIT_SQL, params)
+                return resource_id
 
-        return Response.redirect(request.path)
+            id_maps.resources[resource_key] = await execute_acl_write_fn(
+                datasette, apply_changes, source="manage_table_acls"
+            )
 
-    audit_log = await internal_db.execute(
-        """
-        select
-            acl_audit.timestamp,
-            acl_audit.operation_by,
-            acl_audit.operation,
-            acl_audit.actor_id,
-            acl_groups.name as group_name,
-            acl_actions.name as action_name
-        from acl_audit
-        left join acl_groups on acl_audit.group_id = acl_groups.id
-        join acl_actions on acl_audit.action_id = acl_actions.id
-        where acl_audit.resource_id = ?
-        order by acl_audit.timestamp desc
-        limit 50
-        """,
-        [resource_id],
-    )
+        group_changes_made = {"added": [], "removed": []}
+        user_changes_made = {"added": [], "removed": []}
+        for change in changes:
+            grant = dict(
+                actor_id=change["actor_id"],
+                group_name=change["group_name"],
+                database=database,
+                resource=index_resource,
+                action=change["action_name"],
+            )
+            if change["operation"] == "added":
+                index.grant_added(**grant)
+            else:
+                index.grant_removed(**grant)
+            if change["group_name"]:
+                group_changes_made[change["operation"]].append(
+                    (change["group_name"], change["action_name"])
+                )
+            else:
+                user_changes_made[change["operation"]].append(
+                    (change["actor_id"], change["action_name"])
+                )
+
+        group_message = generate_changes_message(group_changes_made, "group")
+        if group_message:
+            datasette.add_message(request, group_message)
+        user_message = generate_changes_message(user_changes_made, "user")
+        if user_message:
+            datasette.add_message(request, user_message)
+
+        return Response.redirect(page_path)
+
+    audit_log, audit_next = [], None
+    if resource_id is not None:
+        next_id, size = audit_page_args(request)
+        audit_log, audit_next = await fetch_audit_page(
+            internal_db,
+            TABLE_AUDIT_SQL,
+            {"resource_id": resource_id, "next": next_id, "size": size},
+        )
 
     # group_sizes dictionary for displaying their sizes
     group_sizes = {
@@ -290,25 +320,34 @@ async def manage_table_acls(request, datasette):
         )
     }
 
+    # Database pages link to the glob grants already made for the database
+    database_globs = []
+    if table is None and glob is None:
+        database_globs = [
+            row["glob"]
+            for row in await internal_db.execute(
+                DATABASE_GLOBS_SQL, {"database": database}
+            )
+        ]
+
     return Response.html(
         await datasette.render_template(
             "manage_table_acls.html",
             {
-                "database_name": request.url_vars["database"],
-                "table_name": request.url_vars["table"],
-                "actions": [
-                    "insert-row",
-                    "delete-row",
-                    "update-row",
-                    "alter-table",
-                    "drop-table",
-                ],
+                "database_name": database,
+                "table_name": table,
+                "glob": glob,
+                "database_globs": database_globs,
+                "page_path": page_path,
+                "actions": TABLE_ACTIONS,
                 "groups": groups,
                 "group_sizes": group_sizes,
                 "group_permissions": current_group_permissions,
                 "user_permissions": current_user_permissions,
-                "audit_log": audit_log.rows,
-                "valid_actors": await get_acl_valid_actors(datasette),
+                "audit_log": audit_log,
+                "audit_next": audit_next,
+                # Actors are loaded from /-/acl/actors.json as the user types
+                "actor_autocomplete": await has_valid_actors(datasette),
             },
             request=request,
         )
@@ -0,0 +1,137 @@
+from datasette_acl.index import execute_acl_write_fn
+from datasette_acl.utils import run_in_background
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import weakref
+
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_FLUSH_SIZE = 500
+
+# A queued write is called with the write connection and returns a
+# (result, audit_rows) pair, where audit_rows is a list of (sql, params)
+QueuedWrite = Callable[..., Tuple[object, List[Tuple[str, dict]]]]
+
+
+def write_audit_rows(conn, audit_rows: List[Tuple[str, dict]]):
+    "Insert audit rows using one executemany() per distinct SQL statement"
+    by_sql: Dict[str, List[dict]] = {}
+    for sql, params in audit_rows:
+        by_sql.setdefault(sql, []).append(params)
+    for sql, params_list in by_sql.items():
+        conn.executemany(sql, params_list)
+
+
+def with_audit(fn: QueuedWrite):
+    "Turn a queued write into a function for execute_acl_write_fn()"
+
+    def write(conn):
+        result, audit_rows = fn(conn)
+        write_audit_rows(conn, audit_rows)
+        return result
+
+    return write
+
+
+class WriteQueue:
+    """
+    Group commit for writes that do not need to finish before a response is
+    returned, such as dynamic group memberships recorded in the background.
+
+    Queued writes are collected for up to interval seconds, or until size
+    are waiting, then run in a single transaction. Each write's data changes
+    and audit rows commit together, with the audit rows for the whole batch
+    inserted using executemany().
+    """
+
+    def __init__(
+        self,
+        datasette,
+        interval: float = DEFAULT_FLUSH_INTERVAL,
+        size: int = DEFAULT_FLUSH_SIZE,
+    ):
+        self.datasette = datasette
+        self.interval = interval
+        self.size = size
+        self.pending: List[Tuple[QueuedWrite, asyncio.Future]] = []
+        self.flushes = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing = set()
+
+    def submit(self, fn: QueuedWrite) -> asyncio.Future:
+        "Queue a write, returning a future for its result"
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((fn, future))
+        if len(self.pending) >= self.size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self._start_flush)
+        return future
+
+    def _start_flush(self):
+        task = run_in_background(self.flush())
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def flush(self):
+        "Write everything that is currently queued"
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        def write_batch(conn):
+            results = []
+            audit_rows = []
+            for fn, _ in batch:
+                result, rows = fn(conn)
+                results.append(result)
+                audit_rows.extend(rows)
+            write_audit_rows(conn, audit_rows)
+            return results
+
+        self.flushes += 1
+        try:
+            results = await execute_acl_write_fn(
+                self.datasette, write_batch, source="write_queue"
+            )
+        except Exception as ex:
+            if len(batch) == 1:
+                batch[0][1].set_exception(ex)
+                return
+            # Retry one at a time so a single failure does not lose the rest
+            for fn, future in batch:
+                try:
+                    future.set_result(
+                        await execute_acl_write_fn(
+                            self.datasette, with_audit(fn), source="write_queue"
+                        )
+                    )
+                except Exception as ex:
+                    future.set_exception(ex)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    async def close(self):
+        "Flush anything queued and wait for flushes in progress to finish"
+        await self.flush()
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+
+
+_write_queues = weakref.WeakKeyDictionary()
+
+
+def get_write_queue(datasette) -> WriteQueue:
+    queue = _write_queues.get(datasette)
+    if queue is None:
+        config = datasette.plugin_config("datasette-acl") or {}
+        queue = _write_queues[datasette] = WriteQueue(
+            datasette,
+            interval=config.get("write-queue-interval", DEFAULT_FLUSH_INTERVAL),
+            size=config.get("write-queue-size", DEFAULT_FLUSH_SIZE),
+        )
+    return queue
@@ -0,0 +1,73 @@
+from datasette import hookimpl
+from datasette.plugins import pm
+from datasette_acl.actor_search import ActorSearchIndex
+import pytest
+
+ACTORS = {
+    "simon": "Simon Willison",
+    "alex": "Alex Garcia",
+    "simonw2": "Another Simon",
+    "paulo": "Paulo",
+    "asimov": "Isaac Asimov",
+}
+
+
+@pytest.mark.parametrize(
+    "query,limit,expected",
+    (
+        ("", 2, ["simon", "alex"]),
+        # Prefix matches first, then substring matches
+        ("sim", 10, ["simon", "simonw2", "asimov"]),
+        ("SIM", 1, ["simon"]),
+        ("another", 10, ["simonw2"]),
+        ("garc", 10, ["alex"]),
+        ("ac", 10, ["asimov"]),
+        ("a", 10, ["alex", "simonw2", "asimov", "paulo"]),
+        ("xyz", 10, []),
+        ("on w", 10, ["simon"]),
+    ),
+)
+def test_actor_search_index(query, limit, expected):
+    index = ActorSearchIndex(ACTORS)
+    assert [actor_id for actor_id, _ in index.search(query, limit)] == expected
+
+
+@pytest.mark.asyncio
+async def test_actors_json(ds):
+    class ActorsPlugin:
+        __name__ = "ActorsPlugin"
+
+        @hookimpl
+        def datasette_acl_valid_actors(self, datasette):
+            return [{"id": key, "display": value} for key, value in ACTORS.items()]
+
+    pm.register(ActorsPlugin(), name="actors")
+    try:
+        response = await ds.client.get(
+            "/-/acl/actors.json?q=sim&limit=2",
+            cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+        )
+        assert response.status_code == 200
+        assert response.json() == {
+            "actors": [
+                {"id": "simon", "display": "Simon Willison"},
+                {"id": "simonw2", "display": "Another Simon"},
+            ],
+            "truncated": True,
+        }
+        # Actors are not embedded in the page
+        page = await ds.client.get(
+            "/db/t/-/acl",
+            cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+        )
+        assert "actor-autocomplete" in page.text
+        assert "Simon Willison" not in page.text
+    finally:
+        pm.unregister(name="actors")
+
+    # Requires permission to edit permissions
+    response = await ds.client.get(
+        "/-/acl/actors.json",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "paulo"})},
+    )
+    assert response.status_code == 403
@@ -0,0 +1,265 @@
+from datasette_acl import audit as audit_module
+from datasette_acl.audit import archive_audit_logs, audit_retention_loop
+from datasette_acl.views import audit
+import asyncio
+import csv
+import io
+import json
+import pytest
+import sqlite3
+
+
+@pytest.mark.asyncio
+async def test_archive_audit_logs(ds, tmp_path):
+    archive = str(tmp_path / "archive.db")
+    ds.config["plugins"]["datasette-acl"]["audit-retention"] = {
+        "max-age-days": 30,
+        "archive": archive,
+        "batch-size": 7,
+    }
+    internal_db = ds.get_internal_database()
+    await internal_db.execute_write(
+        "insert into acl_resources (database, resource) values ('db', 't')"
+    )
+    group_id = (
+        await internal_db.execute("select id from acl_groups where name = 'dev'")
+    ).single_value()
+    await internal_db.execute_write_many(
+        """
+        insert into acl_groups_audit (timestamp, operation_by, operation, group_id, actor_id)
+        values (datetime('now', :age), 'root', 'added', :group_id, :actor_id)
+        """,
+        [
+            {
+                "age": "-{} days".format(100 - i),
+                "group_id": group_id,
+                "actor_id": "user{}".format(i),
+            }
+            for i in range(100)
+        ],
+    )
+    await internal_db.execute_write_many(
+        """
+        insert into acl_audit (timestamp, operation_by, operation, action_id, resource_id, actor_id)
+        values (
+            datetime('now', :age), 'root', 'added',
+            (select id from acl_actions where name = 'insert-row'),
+            (select id from acl_resources where database = 'db' and resource = 't'),
+            'user'
+        )
+        """,
+        [{"age": "-{} days".format(age)} for age in (60, 40, 10, 0)],
+    )
+
+    # Rows older than 30 days are moved to the archive
+    assert await archive_audit_logs(ds) == {"acl_audit": 2, "acl_groups_audit": 70}
+    assert (
+        await internal_db.execute("select count(*) from acl_groups_audit")
+    ).single_value() == 30
+    assert (
+        await internal_db.execute("select count(*) from acl_audit")
+    ).single_value() == 2
+    conn = sqlite3.connect(archive)
+    conn.row_factory = sqlite3.Row
+    archived = conn.execute(
+        "select * from acl_groups_audit order by id limit 1"
+    ).fetchone()
+    assert archived["actor_id"] == "user0"
+    assert archived["group_name"] == "dev"
+    archived = dict(conn.execute("select * from acl_audit limit 1").fetchone())
+    assert archived["database_name"] == "db"
+    assert archived["resource_name"] == "t"
+    assert archived["action_name"] == "insert-row"
+    conn.close()
+
+    # Running again has nothing to do
+    assert await archive_audit_logs(ds) == {"acl_audit": 0, "acl_groups_audit": 0}
+
+    # Without an archive rows beyond max-rows are deleted
+    ds.config["plugins"]["datasette-acl"]["audit-retention"] = {"max-rows": 5}
+    assert await archive_audit_logs(ds) == {"acl_audit": 0, "acl_groups_audit": 25}
+    remaining = [
+        row[0]
+        for row in await internal_db.execute(
+            "select actor_id from acl_groups_audit order by id"
+        )
+    ]
+    assert remaining == ["user95", "user96", "user97", "user98", "user99"]
+
+
+async def add_groups_audit_rows(internal_db, actor_ids):
+    await internal_db.execute_write_many(
+        """
+        insert into acl_groups_audit (operation_by, operation, group_id, actor_id)
+        values ('root', 'added', (select id from acl_groups where name = 'dev'), ?)
+        """,
+        [(actor_id,) for actor_id in actor_ids],
+    )
+
+
+@pytest.mark.asyncio
+async def test_archive_after_ids_are_reused(ds, tmp_path, capsys):
+    archive = str(tmp_path / "archive.db")
+    # An archive written before archives had their own ids
+    conn = sqlite3.connect(archive)
+    conn.executescript(
+        """
+        create table acl_groups_audit (
+            id integer primary key,
+            timestamp text,
+            operation_by text,
+            operation text,
+            group_name text,
+            actor_id text
+        );
+        insert into acl_groups_audit (id, actor_id) values (1, 'old');
+        """
+    )
+    conn.close()
+    ds.config["plugins"]["datasette-acl"]["audit-retention"] = {
+        "max-rows": 0,
+        "archive": archive,
+    }
+    internal_db = ds.get_internal_database()
+    await add_groups_audit_rows(internal_db, ["a", "b"])
+    assert await archive_audit_logs(ds) == {"acl_audit": 0, "acl_groups_audit": 2}
+    # The emptied table starts its ids from 1 again
+    await add_groups_audit_rows(internal_db, ["c", "d"])
+    assert [
+        row[0] for row in await internal_db.execute("select id from acl_groups_audit")
+    ] == [1, 2]
+    assert await archive_audit_logs(ds) == {"acl_audit": 0, "acl_groups_audit": 2}
+    conn = sqlite3.connect(archive)
+    # The in-memory internal database does not use incremental auto-vacuum,
+    # which is reported once
+    assert capsys.readouterr().err == (
+        "datasette-acl: audit retention cannot free space as the internal "
+        "database does not use incremental auto-vacuum - see the README, or set "
+        "vacuum: true\n"
+    )
+    assert conn.execute(
+        "select id, source_id, actor_id, member_group_name from acl_groups_audit "
+        "order by id"
+    ).fetchall() == [
+        (1, 1, "old", None),
+        (2, 1, "a", None),
+        (3, 2, "b", None),
+        (4, 1, "c", None),
+        (5, 2, "d", None),
+    ]
+    conn.close()
+
+
+@pytest.mark.asyncio
+async def test_audit_retention_loop_logs_errors(ds, capsys, monkeypatch):
+    async def fail(datasette):
+        raise ValueError("broken")
+
+    async def stop(seconds):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(audit_module, "archive_audit_logs", fail)
+    monkeypatch.setattr(asyncio, "sleep", stop)
+    with pytest.raises(asyncio.CancelledError):
+        await audit_retention_loop(ds)
+    assert capsys.readouterr().err == (
+        "datasette-acl: audit retention failed: ValueError('broken')\n"
+    )
+
+
+@pytest.mark.asyncio
+async def test_audit_export(ds, csrftoken, monkeypatch):
+    # Small chunks, to check the pages join up
+    monkeypatch.setattr(audit, "EXPORT_CHUNK_SIZE", 2)
+    cookies = {
+        "ds_actor": ds.client.actor_cookie({"id": "root"}),
+        "ds_csrftoken": csrftoken,
+    }
+    internal_db = ds.get_internal_database()
+    await ds.get_database("db").execute_write("create table t2 (id primary key)")
+    for table in ("t", "t2"):
+        await ds.client.post(
+            "/db/{}/-/acl".format(table),
+            data={
+                "group_permissions_dev": ["insert-row", "update-row"],
+                "new_actor_id": "simon",
+                "new_user_actions": "drop-table",
+                "csrftoken": csrftoken,
+            },
+            cookies=cookies,
+        )
+    await ds.client.post(
+        "/-/acl/groups/dev",
+        data={"bulk_add": "alex,paulo", "csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    # An old entry, for the time range filter
+    await internal_db.execute_write(
+        "update acl_audit set timestamp = '2020-01-01 00:00:00' where id = 1"
+    )
+
+    response = await ds.client.get("/-/acl/audit.ndjson", cookies=cookies)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson; charset=utf-8"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 6
+    assert [row["id"] for row in rows] == [1, 2, 3, 4, 5, 6]
+    assert {
+        key: value for key, value in rows[0].items() if key not in ("id", "timestamp")
+    } == {
+        "operation_by": "root",
+        "operation": "added",
+        "database": "db",
+        "table": "t",
+        "glob": None,
+        "group_name": "dev",
+        "actor_id": None,
+        "action_name": "insert-row",
+    }
+
+    # Filters
+    response = await ds.client.get(
+        "/-/acl/audit.ndjson?table=t2&since=2021-01-01", cookies=cookies
+    )
+    assert [json.loads(line)["table"] for line in response.text.splitlines()] == [
+        "t2"
+    ] * 3
+    response = await ds.client.get(
+        "/-/acl/audit.ndjson?until=2021-01-01T00:00:00", cookies=cookies
+    )
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == [1]
+    response = await ds.client.get(
+        "/-/acl/audit.ndjson?database=db&actor_id=simon", cookies=cookies
+    )
+    assert [json.loads(line)["action_name"] for line in response.text.splitlines()] == [
+        "drop-table",
+        "drop-table",
+    ]
+
+    response = await ds.client.get("/-/acl/groups-audit.csv?group=dev", cookies=cookies)
+    assert response.headers["content-type"] == "text/csv; charset=utf-8"
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [(row["group_name"], row["actor_id"]) for row in rows] == [
+        ("dev", "alex"),
+        ("dev", "paulo"),
+    ]
+    assert list(rows[0].keys()) == [
+        "id",
+        "timestamp",
+        "operation_by",
+        "operation",
+        "group_name",
+        "actor_id",
+        "member_group",
+    ]
+
+    # An empty export still has a CSV header
+    response = await ds.client.get("/-/acl/audit.csv?database=missing", cookies=cookies)
+    assert response.text.startswith("id,timestamp,")
+    assert len(response.text.splitlines()) == 1
+
+    response = await ds.client.get(
+        "/-/acl/audit.ndjson",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "other"})},
+    )
+    assert response.status_code == 403
@@ -0,0 +1,284 @@
+import pytest
+
+IMPORT = {
+    "groups": [
+        {"name": "engineering", "members": ["simon"], "groups": ["platform"]},
+        {"name": "platform", "members": ["paulo", "rohan"]},
+    ],
+    "grants": [
+        {
+            "database": "db",
+            "table": "t",
+            "action": "insert-row",
+            "group": "engineering",
+        },
+        {"database": "db", "glob": "sales_*", "action": "update-row", "actor": "alex"},
+        {"database": "db", "action": "delete-row", "actor": "alex"},
+    ],
+}
+
+NO_CHANGES = {
+    "groups": {"added": 0, "removed": 0},
+    "members": {"added": 0, "removed": 0},
+    "member_groups": {"added": 0, "removed": 0},
+    "grants": {"added": 0, "removed": 0},
+}
+
+
+async def import_json(ds, csrftoken, data):
+    return await ds.client.post(
+        "/-/acl/import.json",
+        json=data,
+        headers={"x-csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+
+
+@pytest.mark.asyncio
+async def test_import_and_export(ds, csrftoken):
+    internal_db = ds.get_internal_database()
+    write_calls = []
+    original_execute_write_fn = internal_db.execute_write_fn
+
+    async def counting_execute_write_fn(fn, *args, **kwargs):
+        write_calls.append(fn)
+        return await original_execute_write_fn(fn, *args, **kwargs)
+
+    internal_db.execute_write_fn = counting_execute_write_fn
+    try:
+        response = await import_json(ds, csrftoken, IMPORT)
+    finally:
+        internal_db.execute_write_fn = original_execute_write_fn
+    assert response.status_code == 200
+    assert response.json() == {
+        "ok": True,
+        "groups": {"added": 2, "removed": 0},
+        "members": {"added": 3, "removed": 0},
+        "member_groups": {"added": 1, "removed": 0},
+        "grants": {"added": 3, "removed": 0},
+    }
+    assert len(write_calls) == 1
+
+    # Grants apply through nested groups, database and glob resources
+    assert await ds.permission_allowed({"id": "paulo"}, "insert-row", ["db", "t"])
+    assert not await ds.permission_allowed({"id": "paulo"}, "update-row", ["db", "t"])
+    alex = {"id": "alex"}
+    assert await ds.permission_allowed(alex, "update-row", ["db", "sales_1"])
+    assert await ds.permission_allowed(alex, "delete-row", ["db", "t"])
+    assert (
+        await internal_db.execute("select count(*) from acl_audit")
+    ).single_value() == 3
+    assert (
+        await internal_db.execute(
+            "select count(*) from acl_groups_audit where operation_by = 'root'"
+        )
+    ).single_value() == 6
+
+    # Importing the same thing again changes nothing
+    response = await import_json(ds, csrftoken, IMPORT)
+    assert response.json() == {"ok": True, **NO_CHANGES}
+
+    # Export, then import that with replace: true, is also a no-op
+    response = await ds.client.get(
+        "/-/acl/export.json",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert response.status_code == 200
+    exported = response.json()
+    assert {group["name"]: group for group in exported["groups"]} == {
+        "staff": {"name": "staff", "dynamic": True, "groups": []},
+        "dev": {"name": "dev", "members": [], "groups": []},
+        "engineering": {
+            "name": "engineering",
+            "members": ["simon"],
+            "groups": ["platform"],
+        },
+        "platform": {"name": "platform", "members": ["paulo", "rohan"], "groups": []},
+    }
+    assert exported["grants"] == [
+        {
+            "database": "db",
+            "table": "t",
+            "glob": None,
+            "action": "insert-row",
+            "group": "engineering",
+            "actor": None,
+        },
+        {
+            "database": "db",
+            "table": None,
+            "glob": "sales_*",
+            "action": "update-row",
+            "group": None,
+            "actor": "alex",
+        },
+        {
+            "database": "db",
+            "table": None,
+            "glob": None,
+            "action": "delete-row",
+            "group": None,
+            "actor": "alex",
+        },
+    ]
+    response = await import_json(ds, csrftoken, dict(exported, replace=True))
+    assert response.json() == {"ok": True, **NO_CHANGES}
+
+    # Without replace, only the groups and resources mentioned are changed
+    response = await import_json(
+        ds,
+        csrftoken,
+        {
+            "groups": [{"name": "platform", "members": ["paulo"]}],
+            "grants": [
+                {
+                    "database": "db",
+                    "table": "t",
+                    "action": "drop-table",
+                    "actor": "rohan",
+                }
+            ],
+        },
+    )
+    assert response.json() == {
+        "ok": True,
+        "groups": {"added": 0, "removed": 0},
+        "members": {"added": 0, "removed": 1},
+        "member_groups": {"added": 0, "removed": 0},
+        "grants": {"added": 1, "removed": 1},
+    }
+    assert not await ds.permission_allowed({"id": "paulo"}, "insert-row", ["db", "t"])
+    assert await ds.permission_allowed(alex, "update-row", ["db", "sales_1"])
+
+    # replace: true removes everything not in the document
+    response = await import_json(
+        ds, csrftoken, {"groups": [{"name": "dev"}], "replace": True}
+    )
+    assert response.json() == {
+        "ok": True,
+        "groups": {"added": 0, "removed": 2},
+        "members": {"added": 0, "removed": 2},
+        "member_groups": {"added": 0, "removed": 1},
+        "grants": {"added": 0, "removed": 3},
+    }
+    assert not await ds.permission_allowed(alex, "update-row", ["db", "sales_1"])
+    assert (await internal_db.execute("select count(*) from acl")).single_value() == 0
+    assert [
+        row["name"]
+        for row in await internal_db.execute(
+            "select name from acl_groups where deleted is null order by name"
+        )
+    ] == ["dev", "staff"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "data,error",
+    (
+        ([], "Body must be a JSON object"),
+        ({"groups": [{"name": "bad name"}]}, "Invalid group name: bad name"),
+        (
+            {"groups": [{"name": "staff", "members": ["simon"]}]},
+            "Dynamic group members cannot be imported: staff",
+        ),
+        (
+            {"grants": [{"database": "db", "table": "t", "action": "insert-row"}]},
+            "Each grant needs exactly one of group or actor",
+        ),
+        (
+            {"grants": [{"database": "db", "action": "fly", "actor": "simon"}]},
+            "Unknown action: fly",
+        ),
+        (
+            {"grants": [{"database": "db", "action": "insert-row", "group": "nope"}]},
+            "Unknown group: nope",
+        ),
+        (
+            {
+                "groups": [
+                    {"name": "a", "groups": ["b"]},
+                    {"name": "b", "groups": ["a"]},
+                ]
+            },
+            "Group nesting would create a cycle",
+        ),
+    ),
+)
+async def test_import_errors(ds, csrftoken, data, error):
+    response = await import_json(ds, csrftoken, data)
+    assert response.status_code == 400
+    assert response.json() == {"ok": False, "error": error}
+    # Nothing was written
+    internal_db = ds.get_internal_database()
+    assert (
+        await internal_db.execute("select count(*) from acl_groups")
+    ).single_value() == 2
+    assert (await internal_db.execute("select count(*) from acl")).single_value() == 0
+
+
+@pytest.mark.asyncio
+async def test_import_export_require_permission(ds, csrftoken):
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "other"})}
+    response = await ds.client.get("/-/acl/export.json", cookies=cookies)
+    assert response.status_code == 403
+    response = await ds.client.post(
+        "/-/acl/import.json",
+        json=IMPORT,
+        headers={"x-csrftoken": csrftoken},
+        cookies=dict(cookies, ds_csrftoken=csrftoken),
+    )
+    assert response.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_export_skips_grants_of_deleted_groups(ds, csrftoken):
+    cookies = {
+        "ds_actor": ds.client.actor_cookie({"id": "root"}),
+        "ds_csrftoken": csrftoken,
+    }
+    await ds.client.post(
+        "/-/acl/groups",
+        data={"new_group": "gone", "csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    await ds.client.post(
+        "/db/t/-/acl",
+        data={
+            "group_permissions_gone": "insert-row",
+            "group_permissions_dev": "update-row",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    await ds.client.post(
+        "/-/acl/groups/gone",
+        data={"delete_group": "1", "csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    response = await ds.client.get("/-/acl/export.json", cookies=cookies)
+    exported = response.json()
+    assert [grant["group"] for grant in exported["grants"]] == ["dev"]
+
+    # The export can be imported again, changing nothing
+    for replace in (False, True):
+        response = await import_json(ds, csrftoken, dict(exported, replace=replace))
+        assert response.status_code == 200
+        assert response.json() == {"ok": True, **NO_CHANGES}
+
+
+@pytest.mark.asyncio
+async def test_import_export_without_plugin_config(ds, csrftoken):
+    del ds.config["plugins"]["datasette-acl"]
+    response = await ds.client.get(
+        "/-/acl/export.json",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert response.status_code == 200
+    response = await import_json(
+        ds, csrftoken, {"groups": [{"name": "dev", "members": ["simon"]}]}
+    )
+    assert response.status_code == 200
+    assert response.json()["members"] == {"added": 1, "removed": 0}
@@ -0,0 +1,56 @@
+from datasette.app import Datasette
+from datasette_acl.cache import LRUCache, get_cache
+import time
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # Reading a makes b the least recently used
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+    assert cache.stats() == {
+        "size": 2,
+        "maxsize": 2,
+        "ttl": None,
+        "hits": 3,
+        "misses": 0,
+        "evictions": 1,
+    }
+
+
+def test_ttl_expiry(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = LRUCache(maxsize=10, ttl=1)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    now[0] += 1.5
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert cache.get("a", "default") == "default"
+    assert (cache.hits, cache.misses) == (1, 2)
+    # Expired items are removed rather than kept around
+    assert len(cache) == 0
+
+
+def test_peek_does_not_count():
+    cache = LRUCache(maxsize=10)
+    cache.set("a", 1)
+    assert cache.peek("a") == 1
+    assert cache.peek("b") is None
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_get_cache_per_instance():
+    ds1 = Datasette(config={"plugins": {"datasette-acl": {"cache-size": 5}}})
+    ds2 = Datasette()
+    cache1 = get_cache(ds1, "example", ttl=2)
+    assert get_cache(ds1, "example") is cache1
+    assert (cache1.maxsize, cache1.ttl) == (5, 2)
+    assert get_cache(ds2, "example") is not cache1
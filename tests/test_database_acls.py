@@ -0,0 +1,166 @@
+from datasette_acl import allowed_table_actions
+from datasette_acl.index import Glob, GrantSet
+import pytest
+import sqlite3
+
+
+@pytest.mark.parametrize(
+    "pattern,table,expected",
+    (
+        ("sales_*", "sales_2024", True),
+        ("sales_*", "Sales_2024", False),
+        ("sales_*", "old_sales_2024", False),
+        ("t?", "t2", True),
+        ("t?", "t22", False),
+        ("[ab]*", "beta", True),
+        ("[^ab]*", "beta", False),
+        ("[^ab]*", "gamma", True),
+    ),
+)
+def test_glob_matches(pattern, table, expected):
+    assert Glob(pattern).matches(table) is expected
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    (
+        "t[!a]",
+        "[]]",
+        "[]a]",
+        "[^]]",
+        "[]-a]",
+        "[a-]",
+        "[c-a]",
+        "[a-c-e]",
+        "[^^]",
+        "[",
+        "t[a",
+        "*[*]*",
+        "a.b+",
+    ),
+)
+def test_glob_matches_sqlite(pattern):
+    # The index must agree with the GLOB operator used by the SQL path
+    conn = sqlite3.connect(":memory:")
+    for table in ("tb", "ta", "t!", "]", "a", "b", "c", "d", "-", "^", "*", "a.b+"):
+        expected = bool(conn.execute("select ? glob ?", [table, pattern]).fetchone()[0])
+        assert Glob(pattern).matches(table) is expected, (pattern, table)
+
+
+def test_grant_set_matches():
+    grants = GrantSet(
+        [
+            ("db", "t", "insert-row"),
+            ("db", None, "update-row"),
+            ("db", Glob("sales_*"), "delete-row"),
+        ]
+    )
+    assert grants.matches("db", "t", "insert-row")
+    assert not grants.matches("db", "t2", "insert-row")
+    assert grants.matches("db", "anything", "update-row")
+    assert not grants.matches("other", "anything", "update-row")
+    assert grants.matches("db", "sales_2024", "delete-row")
+    assert not grants.matches("db", "t", "delete-row")
+    grants.discard(("db", Glob("sales_*"), "delete-row"))
+    assert not grants.matches("db", "sales_2024", "delete-row")
+    assert grants.globs == {}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_index", (True, False))
+async def test_database_and_glob_grants(ds, csrftoken, use_index):
+    ds.config["plugins"]["datasette-acl"]["permission-index"] = use_index
+    db = ds.get_database("db")
+    await db.execute_write("create table sales_2024 (id primary key)")
+    cookies = {
+        "ds_actor": ds.client.actor_cookie({"id": "root"}),
+        "ds_csrftoken": csrftoken,
+    }
+    staff = {"id": "simon", "is_staff": True}
+    other = {"id": "alex"}
+    assert not await ds.permission_allowed(staff, "insert-row", ["db", "t"])
+
+    # Database-level grant for the staff group
+    response = await ds.client.post(
+        "/db/-/acl",
+        data={"group_permissions_staff": "insert-row", "csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    assert response.status_code == 302
+    assert response.headers["location"] == "/db/-/acl"
+    # Glob grant for a single user
+    response = await ds.client.post(
+        "/db/-/acl?glob=sales_*",
+        data={
+            "new_actor_id": "alex",
+            "new_user_actions": "update-row",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    assert response.status_code == 302
+    assert response.headers["location"] == "/db/-/acl?glob=sales_%2A"
+
+    # Applies to tables created after the grant was made
+    await db.execute_write("create table sales_2025 (id primary key)")
+    for table in ("t", "sales_2024", "sales_2025"):
+        assert await ds.permission_allowed(staff, "insert-row", ["db", table])
+        assert not await ds.permission_allowed(staff, "update-row", ["db", table])
+    assert not await ds.permission_allowed(staff, "insert-row", ["other", "t"])
+    assert await ds.permission_allowed(other, "update-row", ["db", "sales_2024"])
+    assert await ds.permission_allowed(other, "update-row", ["db", "sales_2025"])
+    assert not await ds.permission_allowed(other, "update-row", ["db", "t"])
+    assert not await ds.permission_allowed(other, "insert-row", ["db", "sales_2024"])
+
+    assert await allowed_table_actions(ds, staff, "db") == {
+        "t": {"insert-row"},
+        "sales_2024": {"insert-row"},
+        "sales_2025": {"insert-row"},
+    }
+    assert await allowed_table_actions(ds, other, "db") == {
+        "sales_2024": {"update-row"},
+        "sales_2025": {"update-row"},
+    }
+
+    # The database page links to patterns with grants
+    response = await ds.client.get("/db/-/acl", cookies=cookies)
+    assert response.status_code == 200
+    assert "<h1>Permissions for db</h1>" in response.text
+    assert (
+        '<a href="/db/-/acl?glob=sales_%2A"><code>sales_*</code></a>' in response.text
+    )
+    response = await ds.client.get("/db/-/acl?glob=sales_*", cookies=cookies)
+    assert "matching <code>sales_*</code>" in response.text
+    response = await ds.client.get("/db/-/acl/audit.json?glob=sales_*", cookies=cookies)
+    assert [
+        (row["operation"], row["actor_id"], row["action_name"])
+        for row in response.json()["audit_log"]
+    ] == [("added", "alex", "update-row")]
+
+    # Removing the glob grant takes effect immediately
+    response = await ds.client.post(
+        "/db/-/acl?glob=sales_*",
+        data={"csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    assert response.status_code == 302
+    assert not await ds.permission_allowed(other, "update-row", ["db", "sales_2024"])
+    assert await allowed_table_actions(ds, other, "db") == {}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("should_work", (True, False))
+async def test_database_actions(ds, should_work):
+    response = await ds.client.get(
+        "/db",
+        cookies={
+            "ds_actor": ds.client.actor_cookie(
+                {"id": "root" if should_work else "other"}
+            ),
+        },
+    )
+    fragment = '<a href="/db/-/acl">Manage database permissions'
+    if should_work:
+        assert fragment in response.text
+    else:
+        assert fragment not in response.text
@@ -1,7 +1,16 @@
 from datasette import hookimpl
-from datasette_acl.utils import get_acl_valid_actors
+from datasette_acl.stats import get_stats
+from datasette_acl.utils import (
+    _background_tasks,
+    get_acl_valid_actors,
+    get_valid_actors_registry,
+    invalidate_valid_actors,
+    validate_actor_id,
+)
 from datasette.plugins import pm
+import asyncio
 import pytest
+import time
 
 
 @pytest.fixture
@@ -93,3 +102,177 @@ async def test_datasette_acl_valid_actors(ds, csrftoken, register_plugin):
             assert messages[0][1] == ds.INFO
         else:
             assert messages[0] == ["That user ID is not valid", ds.ERROR]
+
+    # Bulk additions skip and report invalid IDs
+    response = await ds.client.post(
+        "/-/acl/groups/dev",
+        json={"add": ["two", "three", "four"]},
+        headers={"x-csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    assert response.json() == {
+        "ok": True,
+        "added": ["two"],
+        "removed": [],
+        "invalid": ["three", "four"],
+        "unchanged": [],
+    }
+
+
+@pytest.mark.asyncio
+async def test_valid_actors_are_cached(ds):
+    calls = []
+
+    class CountingPlugin:
+        __name__ = "CountingPlugin"
+
+        @hookimpl
+        def datasette_acl_valid_actors(self, datasette):
+            calls.append(1)
+            return ["actor{}".format(i) for i in range(len(calls))]
+
+    pm.register(CountingPlugin(), name="counting")
+    try:
+        assert await get_acl_valid_actors(ds) == [("actor0", "actor0")]
+        assert await validate_actor_id(ds, "actor0")
+        assert not await validate_actor_id(ds, "actor1")
+        assert len(calls) == 1
+
+        # Explicit invalidation calls the hook again
+        invalidate_valid_actors(ds)
+        assert await validate_actor_id(ds, "actor1")
+        assert len(calls) == 2
+
+        # Stale results are returned while refreshing in the background
+        registry = get_valid_actors_registry(ds)
+        registry.loaded_at -= registry.ttl
+        assert not await validate_actor_id(ds, "actor2")
+        await asyncio.gather(*_background_tasks)
+        assert len(calls) == 3
+        assert await validate_actor_id(ds, "actor2")
+    finally:
+        pm.unregister(name="counting")
+    # Removing the plugin invalidates the cache
+    assert await get_acl_valid_actors(ds) == []
+
+
+@pytest.mark.asyncio
+async def test_search_and_validate_hooks(ds, csrftoken):
+    users = ["ana", "anton", "bob"]
+    validate_calls = []
+
+    class SearchPlugin:
+        __name__ = "SearchPlugin"
+
+        @hookimpl
+        def datasette_acl_search_actors(self, datasette, query, limit):
+            async def inner():
+                return [
+                    {"id": user, "display": user.title()}
+                    for user in users
+                    if user.startswith(query)
+                ][:limit]
+
+            return inner
+
+        @hookimpl
+        def datasette_acl_validate_actors(self, datasette, actor_ids):
+            validate_calls.append(actor_ids)
+            return [actor_id for actor_id in actor_ids if actor_id in users]
+
+    pm.register(SearchPlugin(), name="search")
+    try:
+        response = await ds.client.get(
+            "/-/acl/actors.json?q=an",
+            cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+        )
+        assert response.json()["actors"] == [
+            {"id": "ana", "display": "Ana"},
+            {"id": "anton", "display": "Anton"},
+        ]
+        # Autocomplete is enabled even without datasette_acl_valid_actors
+        page = await ds.client.get(
+            "/-/acl/groups/dev",
+            cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+        )
+        assert "select-choice" in page.text
+
+        response = await ds.client.post(
+            "/-/acl/groups/dev",
+            json={"add": ["ana", "bob", "carl"]},
+            headers={"x-csrftoken": csrftoken},
+            cookies={
+                "ds_actor": ds.client.actor_cookie({"id": "root"}),
+                "ds_csrftoken": csrftoken,
+            },
+        )
+        assert response.json()["added"] == ["ana", "bob"]
+        assert response.json()["invalid"] == ["carl"]
+        # All three were validated in a single call
+        assert validate_calls == [["ana", "bob", "carl"]]
+    finally:
+        pm.unregister(name="search")
+
+
+@pytest.mark.asyncio
+async def test_valid_actors_hooks_run_concurrently(ds):
+    ds.config["plugins"]["datasette-acl"].update(
+        {
+            "valid-actors-ttl": 0,
+            "actor-hook-timeout": 0.5,
+            "actor-hook-timeouts": {"stuck": 0.1},
+        }
+    )
+
+    def make_plugin(name, delay, actors=None, error=None):
+        class SlowPlugin:
+            __name__ = name
+
+            @hookimpl
+            def datasette_acl_valid_actors(self, datasette):
+                async def inner():
+                    await asyncio.sleep(delay)
+                    if error:
+                        raise error
+                    return actors
+
+                return inner
+
+        return SlowPlugin()
+
+    plugins = {
+        "slow1": make_plugin("slow1", 0.2, ["one"]),
+        "slow2": make_plugin("slow2", 0.2, ["two"]),
+        "stuck": make_plugin("stuck", 10, ["three"]),
+        "broken": make_plugin("broken", 0, error=ValueError("broken")),
+    }
+    for name, plugin in plugins.items():
+        pm.register(plugin, name=name)
+    try:
+        start = time.perf_counter()
+        actors = await get_acl_valid_actors(ds)
+        duration = time.perf_counter() - start
+    finally:
+        for name in plugins:
+            pm.unregister(name=name)
+    assert sorted(actors) == [("one", "one"), ("two", "two")]
+    # Run concurrently, and the stuck plugin timed out
+    assert duration < 0.35
+    # Failures and durations are recorded for each plugin in /-/acl/stats
+    data = get_stats(ds).to_json()
+    failures = {
+        (counter["labels"]["plugin"], counter["labels"]["reason"]): counter["value"]
+        for counter in data["counters"]
+        if counter["name"] == "datasette_acl_actor_hook_failures_total"
+    }
+    assert failures == {("stuck", "timeout"): 1, ("broken", "error"): 1}
+    durations = {
+        histogram["labels"]["plugin"]: histogram
+        for histogram in data["histograms"]
+        if histogram["name"] == "datasette_acl_actor_hook_seconds"
+    }
+    assert durations["slow1"]["count"] == 1
+    assert durations["slow1"]["sum"] >= 0.2
@@ -1,4 +1,5 @@
 from collections import namedtuple
+from datasette_acl.views.groups import GROUP_AUDIT_SQL, parse_actor_ids
 import pytest
 
 ManageGroupTest = namedtuple(
@@ -269,3 +270,172 @@ async def test_create_delete_group(ds, csrftoken):
         {"operation_by": "root", "operation": "added", "actor_id": "sally"},
         {"operation_by": "root", "operation": "created", "actor_id": None},
     ]
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    (
+        ("", []),
+        ("one\ntwo\n\nthree", ["one", "two", "three"]),
+        ("one, two,three\none", ["one", "two", "three"]),
+        ("name,id\nOne,one\nTwo,two", ["one", "two"]),
+        ("actor_id\n one \ntwo", ["one", "two"]),
+    ),
+)
+def test_parse_actor_ids(text, expected):
+    assert parse_actor_ids(text) == expected
+
+
+@pytest.mark.asyncio
+async def test_bulk_group_membership(ds, csrftoken):
+    internal_db = ds.get_internal_database()
+    cookies = {
+        "ds_actor": ds.client.actor_cookie({"id": "root"}),
+        "ds_csrftoken": csrftoken,
+    }
+    write_calls = []
+    original_execute_write_fn = internal_db.execute_write_fn
+
+    async def counting_execute_write_fn(fn, *args, **kwargs):
+        write_calls.append(fn)
+        return await original_execute_write_fn(fn, *args, **kwargs)
+
+    internal_db.execute_write_fn = counting_execute_write_fn
+    try:
+        response = await ds.client.post(
+            "/-/acl/groups/dev",
+            data={
+                "bulk_add": "\n".join("user{}".format(i) for i in range(50)),
+                "csrftoken": csrftoken,
+            },
+            cookies=cookies,
+        )
+    finally:
+        internal_db.execute_write_fn = original_execute_write_fn
+    assert response.status_code == 302
+    assert len(write_calls) == 1
+    messages = ds.unsign(response.cookies["ds_messages"], "messages")
+    assert messages[0][0].startswith("Added 50: user0, user1")
+    assert await get_group_members(internal_db, "dev") == {
+        "user{}".format(i) for i in range(50)
+    }
+    assert (
+        await internal_db.execute(
+            "select count(*) from acl_groups_audit where operation = 'added'"
+        )
+    ).single_value() == 50
+
+    # Remove some using the form
+    response = await ds.client.post(
+        "/-/acl/groups/dev",
+        data={
+            "bulk_remove": "user0,user1,not-a-member",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    messages = ds.unsign(response.cookies["ds_messages"], "messages")
+    assert messages[0] == [
+        "Removed 2: user0, user1; Unchanged 1: not-a-member",
+        ds.INFO,
+    ]
+    assert len(await get_group_members(internal_db, "dev")) == 48
+
+    # JSON API
+    response = await ds.client.post(
+        "/-/acl/groups/dev",
+        json={"add": ["user0", "user2"], "remove": ["user3", "user4"]},
+        headers={"x-csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    assert response.json() == {
+        "ok": True,
+        "added": ["user0"],
+        "removed": ["user3", "user4"],
+        "invalid": [],
+        "unchanged": ["user2"],
+    }
+
+    # CSV body adds members
+    response = await ds.client.post(
+        "/-/acl/groups/dev",
+        content="id,name\nuser3,User 3\nuser4,User 4\n",
+        headers={"x-csrftoken": csrftoken, "content-type": "text/csv"},
+        cookies=cookies,
+    )
+    assert response.status_code == 200
+    assert response.json()["added"] == ["user3", "user4"]
+    assert len(await get_group_members(internal_db, "dev")) == 49
+
+    # Invalid JSON
+    response = await ds.client.post(
+        "/-/acl/groups/dev",
+        content="[]",
+        headers={"x-csrftoken": csrftoken, "content-type": "application/json"},
+        cookies=cookies,
+    )
+    assert response.status_code == 400
+    assert response.json()["ok"] is False
+
+    # Dynamic groups cannot be edited
+    response = await ds.client.post(
+        "/-/acl/groups/staff",
+        json={"add": ["user0"]},
+        headers={"x-csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    assert response.status_code == 400
+    assert await get_group_members(internal_db, "staff") == set()
+
+
+@pytest.mark.asyncio
+async def test_group_audit_log_pagination(ds):
+    internal_db = ds.get_internal_database()
+    group_id = (
+        await internal_db.execute("select id from acl_groups where name = 'dev'")
+    ).single_value()
+    await internal_db.execute_write_many(
+        """
+        insert into acl_groups_audit (operation_by, operation, group_id, actor_id)
+        values ('root', 'added', ?, ?)
+        """,
+        [(group_id, "user{}".format(i)) for i in range(120)],
+    )
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    seen = []
+    url = "/-/acl/groups/dev/audit.json?_size=50"
+    while url:
+        data = (await ds.client.get(url, cookies=cookies)).json()
+        seen.extend(row["actor_id"] for row in data["audit_log"])
+        url = data["next_url"]
+    assert len(seen) == 120
+    assert seen[0] == "user119"
+    assert seen[-1] == "user0"
+
+    # The HTML page shows the first 50 with a link to the next page
+    page = await ds.client.get("/-/acl/groups/dev", cookies=cookies)
+    assert "<td>user119</td>" in page.text
+    assert "<td>user69</td>" not in page.text
+    next_id = (
+        await internal_db.execute(
+            "select id from acl_groups_audit where actor_id = 'user70'"
+        )
+    ).single_value()
+    assert "?_next={}".format(next_id) in page.text
+    page2 = await ds.client.get(
+        "/-/acl/groups/dev?_next={}".format(next_id), cookies=cookies
+    )
+    assert "<td>user69</td>" in page2.text
+    assert "<td>user70</td>" not in page2.text
+
+    # Pages are read from the index without sorting
+    plan = await internal_db.execute(
+        "explain query plan "
+        + GROUP_AUDIT_SQL.replace(":group_id", "1")
+        .replace(":next", "10")
+        .replace(":size", "50")
+    )
+    details = " ".join(row["detail"] for row in plan)
+    assert "acl_groups_audit_group" in details
+    assert "TEMP B-TREE" not in details
@@ -0,0 +1,72 @@
+from datasette_acl.ids import get_id_maps
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_id_maps_loaded_at_startup(ds):
+    internal_db = ds.get_internal_database()
+    id_maps = get_id_maps(ds)
+    assert id_maps.actions == {
+        row["name"]: row["id"]
+        for row in await internal_db.execute("select id, name from acl_actions")
+    }
+    # The dev group is created by the fixture after startup
+    assert set(id_maps.groups) == {"staff"}
+
+    # Rows created by another process are looked up on first use
+    await internal_db.execute_write(
+        "insert into acl_groups (name) values ('elsewhere')"
+    )
+    await internal_db.execute_write(
+        "insert into acl_resources (database, resource) values ('db', 'other')"
+    )
+    group_id = await id_maps.group_id(internal_db, "elsewhere")
+    assert id_maps.groups["elsewhere"] == group_id
+    resource_id = await id_maps.resource_id(internal_db, "db", "other")
+    assert id_maps.resources[("db", "other", None)] == resource_id
+    assert await id_maps.resource_id(internal_db, "db", "missing") is None
+    assert ("db", "missing", None) not in id_maps.resources
+
+
+@pytest.mark.asyncio
+async def test_manage_table_acls_get_does_not_write(ds, csrftoken):
+    internal_db = ds.get_internal_database()
+    cookies = {
+        "ds_actor": ds.client.actor_cookie({"id": "root"}),
+        "ds_csrftoken": csrftoken,
+    }
+    original_execute_write_fn = internal_db.execute_write_fn
+    write_calls = []
+
+    async def execute_write_fn(fn, *args, **kwargs):
+        write_calls.append(fn)
+        return await original_execute_write_fn(fn, *args, **kwargs)
+
+    internal_db.execute_write_fn = execute_write_fn
+    try:
+        for path in ("/db/t/-/acl", "/db/-/acl", "/db/-/acl?glob=sales_*"):
+            response = await ds.client.get(path, cookies=cookies)
+            assert response.status_code == 200
+        assert write_calls == []
+        assert (
+            await internal_db.execute("select count(*) from acl_resources")
+        ).single_value() == 0
+
+        # The resource is created along with the first change
+        response = await ds.client.post(
+            "/db/t/-/acl",
+            data={"group_permissions_dev": "insert-row", "csrftoken": csrftoken},
+            cookies=cookies,
+        )
+        assert response.status_code == 302
+        assert len(write_calls) == 1
+    finally:
+        internal_db.execute_write_fn = original_execute_write_fn
+    resource_id = (
+        await internal_db.execute(
+            "select id from acl_resources where database = 'db' and resource = 't'"
+        )
+    ).single_value()
+    assert get_id_maps(ds).resources[("db", "t", None)] == resource_id
+    row = (await internal_db.execute("select group_id, resource_id from acl")).first()
+    assert tuple(row) == (get_id_maps(ds).groups["dev"], resource_id)
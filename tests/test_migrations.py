@@ -0,0 +1,57 @@
+from datasette.app import Datasette
+from datasette_acl.migrations import CREATE_TABLES_SQL, MIGRATIONS, run_migrations
+import pytest
+
+
+async def get_indexes(db):
+    return {
+        row["name"]
+        for row in await db.execute(
+            "select name from sqlite_master where type = 'index' and name like 'acl_%'"
+        )
+    }
+
+
+@pytest.mark.asyncio
+async def test_migrations_on_new_database():
+    datasette = Datasette()
+    await datasette.invoke_startup()
+    db = datasette.get_internal_database()
+    versions = [
+        row["version"]
+        for row in await db.execute(
+            "select version from acl_migrations order by version"
+        )
+    ]
+    assert versions == [version for version, _ in MIGRATIONS]
+    assert {
+        "acl_group_resource_action",
+        "acl_resource",
+        "acl_actor_groups_group",
+        "acl_audit_resource",
+        "acl_groups_audit_group",
+    }.issubset(await get_indexes(db))
+    assert "acl_audit_resource_timestamp" not in await get_indexes(db)
+    # Running again should do nothing
+    assert await run_migrations(db) == []
+
+
+@pytest.mark.asyncio
+async def test_migrations_upgrade_existing_database():
+    datasette = Datasette()
+    db = datasette.get_internal_database()
+    # A database created by an older version of the plugin
+    await db.execute_write_script(CREATE_TABLES_SQL)
+    await db.execute_write("insert into acl_groups (name) values ('existing')")
+    assert await get_indexes(db) == set()
+    assert await run_migrations(db) == [version for version, _ in MIGRATIONS]
+    assert "acl_group_resource_action" in await get_indexes(db)
+    # Existing data is preserved
+    assert (
+        await db.execute("select name from acl_groups")
+    ).single_value() == "existing"
+    # Generation triggers are in place
+    await db.execute_write("insert into acl_groups (name) values ('new')")
+    assert (
+        await db.execute("select generation from acl_generation")
+    ).single_value() == 1
@@ -0,0 +1,129 @@
+from datasette_acl import allowed_table_actions
+from datasette_acl.index import get_permission_index
+import pytest
+
+
+async def post(ds, csrftoken, path, data):
+    response = await ds.client.post(
+        path,
+        data={**data, "csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    assert response.status_code == 302
+    return response
+
+
+async def get_closure(db):
+    return {
+        (row["ancestor"], row["descendant"], row["paths"])
+        for row in await db.execute(
+            """
+            select ancestor.name as ancestor, descendant.name as descendant, paths
+            from acl_group_closure
+            join acl_groups ancestor on ancestor.id = ancestor_id
+            join acl_groups descendant on descendant.id = descendant_id
+            where ancestor_id != descendant_id
+            """
+        )
+    }
+
+
+@pytest.mark.asyncio
+async def test_group_closure_maintained(ds, csrftoken):
+    internal_db = ds.get_internal_database()
+    for group in ("engineering", "platform", "data", "infra"):
+        await post(ds, csrftoken, "/-/acl/groups", {"new_group": group})
+    # A diamond: infra is in engineering through both platform and data
+    await post(ds, csrftoken, "/-/acl/groups/engineering", {"add_group": "platform"})
+    await post(ds, csrftoken, "/-/acl/groups/engineering", {"add_group": "data"})
+    await post(ds, csrftoken, "/-/acl/groups/platform", {"add_group": "infra"})
+    await post(ds, csrftoken, "/-/acl/groups/data", {"add_group": "infra"})
+    assert await get_closure(internal_db) == {
+        ("engineering", "platform", 1),
+        ("engineering", "data", 1),
+        ("engineering", "infra", 2),
+        ("platform", "infra", 1),
+        ("data", "infra", 1),
+    }
+
+    # Cycles are not allowed
+    response = await ds.client.get(
+        "/-/acl/groups/infra",
+        cookies={"ds_actor": ds.client.actor_cookie({"id": "root"})},
+    )
+    assert "<option>engineering</option>" not in response.text
+    assert "<option>dev</option>" in response.text
+    await post(ds, csrftoken, "/-/acl/groups/infra", {"add_group": "engineering"})
+    assert ("infra", "engineering", 1) not in await get_closure(internal_db)
+
+    # Removing one path keeps the other
+    await post(ds, csrftoken, "/-/acl/groups/platform", {"remove_group": "infra"})
+    assert await get_closure(internal_db) == {
+        ("engineering", "platform", 1),
+        ("engineering", "data", 1),
+        ("engineering", "infra", 1),
+        ("data", "infra", 1),
+    }
+
+    # Deleting a group removes it from the hierarchy
+    await post(ds, csrftoken, "/-/acl/groups/data", {"delete_group": "1"})
+    assert await get_closure(internal_db) == {("engineering", "platform", 1)}
+    audit_rows = [
+        (row["group_name"], row["operation"], row["member_group"])
+        for row in await internal_db.execute(
+            """
+            select acl_groups.name as group_name, operation, member.name as member_group
+            from acl_groups_audit
+            join acl_groups on acl_groups.id = acl_groups_audit.group_id
+            join acl_groups member on member.id = acl_groups_audit.member_group_id
+            order by acl_groups_audit.id
+            """
+        )
+    ]
+    assert audit_rows[:5] == [
+        ("engineering", "added", "platform"),
+        ("engineering", "added", "data"),
+        ("platform", "added", "infra"),
+        ("data", "added", "infra"),
+        ("platform", "removed", "infra"),
+    ]
+    # Both of the deleted group's nestings, in either order
+    assert set(audit_rows[5:]) == {
+        ("engineering", "removed", "data"),
+        ("data", "removed", "infra"),
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_index", (True, False))
+async def test_nested_group_permissions(ds, csrftoken, use_index):
+    ds.config["plugins"]["datasette-acl"]["permission-index"] = use_index
+    for group in ("engineering", "platform"):
+        await post(ds, csrftoken, "/-/acl/groups", {"new_group": group})
+    await post(
+        ds, csrftoken, "/db/t/-/acl", {"group_permissions_engineering": "insert-row"}
+    )
+    await post(ds, csrftoken, "/-/acl/groups/platform", {"add": "paulo"})
+    paulo = {"id": "paulo"}
+    staff = {"id": "simon", "is_staff": True}
+    assert not await ds.permission_allowed(paulo, "insert-row", ["db", "t"])
+
+    # Members of platform, and of the dynamic staff group, get engineering's grants
+    await post(ds, csrftoken, "/-/acl/groups/engineering", {"add_group": "platform"})
+    await post(ds, csrftoken, "/-/acl/groups/platform", {"add_group": "staff"})
+    assert await ds.permission_allowed(paulo, "insert-row", ["db", "t"])
+    assert await ds.permission_allowed(staff, "insert-row", ["db", "t"])
+    assert not await ds.permission_allowed(paulo, "update-row", ["db", "t"])
+    assert await allowed_table_actions(ds, staff, "db") == {"t": {"insert-row"}}
+    if use_index:
+        # Direct memberships are unchanged, nesting is resolved separately
+        index = get_permission_index(ds)
+        assert index.actors["paulo"].groups == {"platform"}
+        assert index.ancestors["platform"] == {"platform", "engineering"}
+
+    await post(ds, csrftoken, "/-/acl/groups/engineering", {"remove_group": "platform"})
+    assert not await ds.permission_allowed(paulo, "insert-row", ["db", "t"])
+    assert not await ds.permission_allowed(staff, "insert-row", ["db", "t"])
@@ -0,0 +1,223 @@
+from datasette_acl import ACL_DATABASE_SQL, allowed_table_actions
+from datasette_acl.index import get_permission_index
+import pytest
+
+
+async def grant_to_group(ds, csrftoken, group, actions):
+    response = await ds.client.post(
+        "/db/t/-/acl",
+        data={f"group_permissions_{group}": actions, "csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    assert response.status_code == 302
+
+
+@pytest.mark.asyncio
+async def test_cache_hit_runs_no_sql(ds, csrftoken, monkeypatch):
+    await grant_to_group(ds, csrftoken, "staff", "insert-row")
+    actor = {"id": "simon", "is_staff": True}
+    assert await ds.permission_allowed(actor, "insert-row", ["db", "t"])
+
+    internal_db = ds.get_internal_database()
+    index = get_permission_index(ds)
+    assert index.actors["simon"].groups == {"staff"}
+    assert index.groups["staff"] == {("db", "t", "insert-row")}
+
+    executed = []
+
+    async def execute(sql, params=None, *args, **kwargs):
+        executed.append(sql)
+        raise AssertionError("Should not have executed SQL")
+
+    monkeypatch.setattr(internal_db, "execute", execute)
+    assert await index.allowed(internal_db, "simon", "db", "t", "insert-row")
+    assert not await index.allowed(internal_db, "simon", "db", "t", "update-row")
+    assert executed == []
+
+
+@pytest.mark.asyncio
+async def test_index_updated_by_writes(ds, csrftoken):
+    actor = {"id": "simon", "is_staff": True}
+    cookies = {
+        "ds_actor": ds.client.actor_cookie({"id": "root"}),
+        "ds_csrftoken": csrftoken,
+    }
+    # Populate the index before making any changes
+    assert not await ds.permission_allowed(actor, "update-row", ["db", "t"])
+
+    # Group grant
+    await grant_to_group(ds, csrftoken, "staff", "update-row")
+    assert await ds.permission_allowed(actor, "update-row", ["db", "t"])
+    await grant_to_group(ds, csrftoken, "staff", [])
+    assert not await ds.permission_allowed(actor, "update-row", ["db", "t"])
+
+    # Group membership
+    await grant_to_group(ds, csrftoken, "dev", "delete-row")
+    assert not await ds.permission_allowed(actor, "delete-row", ["db", "t"])
+    await ds.client.post(
+        "/-/acl/groups/dev",
+        data={"add": "simon", "csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    assert await ds.permission_allowed(actor, "delete-row", ["db", "t"])
+    await ds.client.post(
+        "/-/acl/groups/dev",
+        data={"remove": "simon", "csrftoken": csrftoken},
+        cookies=cookies,
+    )
+    assert not await ds.permission_allowed(actor, "delete-row", ["db", "t"])
+
+    # Direct grant
+    await ds.client.post(
+        "/db/t/-/acl",
+        data={
+            "new_actor_id": "simon",
+            "new_user_actions": "drop-table",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    assert await ds.permission_allowed(actor, "drop-table", ["db", "t"])
+    simon = get_permission_index(ds).actors["simon"]
+    assert ("db", "t", "drop-table") in simon.grants
+
+
+@pytest.mark.asyncio
+async def test_generation_tracks_own_writes(ds, csrftoken):
+    actor = {"id": "simon", "is_staff": True}
+    internal_db = ds.get_internal_database()
+    index = get_permission_index(ds)
+    await grant_to_group(ds, csrftoken, "dev", "insert-row")
+    assert not await ds.permission_allowed(actor, "insert-row", ["db", "t"])
+    generation = index.generation
+    assert generation == await get_generation(internal_db)
+
+    await grant_to_group(ds, csrftoken, "staff", "insert-row")
+    # The write moved the generation on without dropping the index
+    assert index.generation > generation
+    assert "simon" in index.actors
+    assert index.generation == await get_generation(internal_db)
+
+
+@pytest.mark.asyncio
+async def test_generation_detects_external_writes(ds, csrftoken):
+    actor = {"id": "simon", "is_staff": True}
+    internal_db = ds.get_internal_database()
+    index = get_permission_index(ds)
+    index.check_interval = 0
+    await grant_to_group(ds, csrftoken, "dev", "insert-row")
+    assert not await ds.permission_allowed(actor, "insert-row", ["db", "t"])
+    assert "simon" in index.actors
+
+    # Simulate another process adding simon to the dev group
+    await internal_db.execute_write(
+        """
+        insert into acl_actor_groups (actor_id, group_id)
+        values ('simon', (select id from acl_groups where name = 'dev'))
+        """
+    )
+    assert await ds.permission_allowed(actor, "insert-row", ["db", "t"])
+
+
+async def get_generation(db):
+    return (await db.execute("select generation from acl_generation")).single_value()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_index", (True, False))
+async def test_allowed_table_actions(ds, csrftoken, use_index):
+    ds.config["plugins"]["datasette-acl"]["permission-index"] = use_index
+    await ds.get_database("db").execute_write("create table t2 (id primary key)")
+    cookies = {
+        "ds_actor": ds.client.actor_cookie({"id": "root"}),
+        "ds_csrftoken": csrftoken,
+    }
+    await grant_to_group(ds, csrftoken, "staff", ["insert-row", "update-row"])
+    await ds.client.post(
+        "/db/t2/-/acl",
+        data={
+            "new_actor_id": "simon",
+            "new_user_actions": "drop-table",
+            "csrftoken": csrftoken,
+        },
+        cookies=cookies,
+    )
+    actor = {"id": "simon", "is_staff": True}
+    assert await allowed_table_actions(ds, actor, "db") == {
+        "t": {"insert-row", "update-row"},
+        "t2": {"drop-table"},
+    }
+    assert await allowed_table_actions(ds, actor, "db", ["update-row"]) == {
+        "t": {"update-row"}
+    }
+    assert await allowed_table_actions(ds, actor, "other") == {}
+    assert await allowed_table_actions(ds, {"id": "nobody"}, "db") == {}
+
+
+@pytest.mark.asyncio
+async def test_database_grants_query_uses_indexes(ds):
+    plan = await ds.get_internal_database().execute(
+        "explain query plan " + ACL_DATABASE_SQL,
+        {
+            "actor_id": "simon",
+            "database": "db",
+            "exclude_groups": "[]",
+            "include_groups": "[]",
+        },
+    )
+    details = [row["detail"] for row in plan]
+    assert any(
+        detail.startswith("SEARCH acl USING") and "(actor_id=?)" in detail
+        for detail in details
+    )
+    assert any(
+        detail.startswith("SEARCH acl USING") and "(group_id=?)" in detail
+        for detail in details
+    )
+    assert not any(detail.startswith("SCAN acl ") for detail in details)
+
+@pytest.mark.asyncio
+async def test_short_circuit_runs_no_sql(ds, csrftoken, monkeypatch):
+    internal_db = ds.get_internal_database()
+    index = get_permission_index(ds)
+    index.check_interval = 3600
+    await grant_to_group(ds, csrftoken, "staff", "insert-row")
+    presence = await index.get_presence(internal_db)
+    assert presence.tables == {("db", "t")}
+    assert presence.actors == set()
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("Should not have touched the database")
+
+    monkeypatch.setattr(internal_db, "execute", fail)
+    monkeypatch.setattr(internal_db, "execute_write_fn", fail)
+    # An actor with no grants, memberships or dynamic groups
+    assert not await ds.permission_allowed({"id": "nobody"}, "insert-row", ["db", "t"])
+    # A table nobody has been granted anything on
+    assert not await ds.permission_allowed(
+        {"id": "simon", "is_staff": True}, "insert-row", ["db", "other"]
+    )
+    assert await allowed_table_actions(ds, {"id": "nobody"}, "db") == {}
+    monkeypatch.undo()
+
+    # Writes keep the sets up to date
+    await ds.client.post(
+        "/db/-/acl?glob=sales_*",
+        data={
+            "new_actor_id": "alex",
+            "new_user_actions": "insert-row",
+            "csrftoken": csrftoken,
+        },
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    assert index.presence is presence
+    assert "alex" in presence.actors
+    assert presence.covers("db", "sales_1")
+    assert not presence.covers("db", "other")
+    assert await ds.permission_allowed({"id": "alex"}, "insert-row", ["db", "sales_1"])
@@ -0,0 +1,130 @@
+from datasette_acl.stats import Stats, to_prometheus
+import pytest
+
+
+def test_stats_histogram_buckets():
+    stats = Stats()
+    stats.observe("check_seconds", 0.0003, path="index_hit")
+    stats.observe("check_seconds", 0.002, path="index_hit")
+    stats.observe("check_seconds", 20, path="index_hit")
+    stats.increment("checks_total", path="index_hit")
+    data = stats.to_json()
+    histogram = data["histograms"][0]
+    assert histogram["name"] == "datasette_acl_check_seconds"
+    assert histogram["labels"] == {"path": "index_hit"}
+    assert histogram["count"] == 3
+    assert histogram["buckets"]["0.0001"] == 0
+    assert histogram["buckets"]["0.0005"] == 1
+    assert histogram["buckets"]["0.0025"] == 2
+    assert histogram["buckets"]["10.0"] == 2
+    assert histogram["buckets"]["+Inf"] == 3
+    text = to_prometheus(data)
+    assert "# TYPE datasette_acl_checks_total counter" in text
+    assert 'datasette_acl_checks_total{path="index_hit"} 1' in text
+    assert "# TYPE datasette_acl_check_seconds histogram" in text
+    assert 'datasette_acl_check_seconds_bucket{path="index_hit",le="+Inf"} 3' in text
+    assert 'datasette_acl_check_seconds_count{path="index_hit"} 3' in text
+
+
+@pytest.mark.asyncio
+async def test_stats_endpoint(ds, csrftoken):
+    actor = {"id": "simon", "is_staff": True}
+    await ds.client.post(
+        "/db/t/-/acl",
+        data={"group_permissions_staff": "insert-row", "csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    for _ in range(3):
+        await ds.permission_allowed(actor, "update-row", ("db", "t"))
+    await ds.permission_allowed(actor, "insert-row", ("db", "other"))
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    response = await ds.client.get("/-/acl/stats", cookies=cookies)
+    assert response.status_code == 200
+    data = response.json()
+    counters = {
+        (counter["name"], tuple(sorted(counter["labels"].items()))): counter["value"]
+        for counter in data["counters"]
+    }
+    assert (
+        counters[
+            (
+                "datasette_acl_permission_checks_total",
+                (("allowed", "false"), ("path", "index_load")),
+            )
+        ]
+        == 1
+    )
+    assert (
+        counters[
+            (
+                "datasette_acl_permission_checks_total",
+                (("allowed", "false"), ("path", "index_hit")),
+            )
+        ]
+        == 2
+    )
+    assert (
+        counters[
+            (
+                "datasette_acl_permission_checks_total",
+                (("allowed", "false"), ("path", "short_circuit")),
+            )
+        ]
+        == 1
+    )
+    assert (
+        counters[("datasette_acl_writes_total", (("source", "manage_table_acls"),))]
+        == 1
+    )
+    assert counters[
+        ("datasette_acl_dynamic_group_syncs_total", (("result", "changed"),))
+    ]
+    assert "permission-index" in data["caches"]
+    histogram_names = {histogram["name"] for histogram in data["histograms"]}
+    assert "datasette_acl_permission_check_seconds" in histogram_names
+
+    text_response = await ds.client.get("/-/acl/stats.txt", cookies=cookies)
+    assert text_response.headers["content-type"].startswith("text/plain")
+    assert "datasette_acl_permission_check_seconds_bucket{" in text_response.text
+
+    # Requires the datasette-acl permission
+    forbidden = await ds.client.get(
+        "/-/acl/stats", cookies={"ds_actor": ds.client.actor_cookie({"id": "simon"})}
+    )
+    assert forbidden.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_stats_text_groups_samples_by_metric(ds, csrftoken):
+    # A grant and a check populate more than one cache
+    await ds.client.post(
+        "/db/t/-/acl",
+        data={"group_permissions_staff": "insert-row", "csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    await ds.permission_allowed(
+        {"id": "simon", "is_staff": True}, "insert-row", ("db", "t")
+    )
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    data = (await ds.client.get("/-/acl/stats", cookies=cookies)).json()
+    assert len(data["caches"]) > 1
+    text = (await ds.client.get("/-/acl/stats.txt", cookies=cookies)).text
+    families = []
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            families.append(line.split()[2])
+            continue
+        name = line.split("{")[0].split(" ")[0]
+        for suffix in ("_bucket", "_sum", "_count"):
+            if name.endswith(suffix) and name[: -len(suffix)] == families[-1]:
+                name = families[-1]
+        # Every sample follows the TYPE line for its own metric
+        assert name == families[-1], line
+    assert len(families) == len(set(families))
+    assert "datasette_acl_cache_hits_total" in families
@@ -1,6 +1,8 @@
 from collections import namedtuple
 from datasette.app import Datasette
 from datasette_acl import update_dynamic_groups
+from datasette_acl.utils import _background_tasks
+import asyncio
 import pytest
 
 
@@ -545,3 +547,234 @@ async def test_table_actions(ds, should_work):
         assert fragment in response.text
     else:
         assert fragment not in response.text
+
+
+@pytest.mark.asyncio
+async def test_update_dynamic_groups_single_write():
+    datasette = Datasette(
+        config={
+            "plugins": {
+                "datasette-acl": {
+                    "dynamic-groups": {
+                        "staff": {"is_staff": True},
+                        "admin": {"is_admin": True},
+                        "sales": {"department": "sales"},
+                    }
+                }
+            }
+        }
+    )
+    await datasette.invoke_startup()
+    db = datasette.get_internal_database()
+    original_execute_write_fn = db.execute_write_fn
+    write_calls = []
+
+    async def execute_write_fn(fn, *args, **kwargs):
+        write_calls.append(fn)
+        return await original_execute_write_fn(fn, *args, **kwargs)
+
+    db.execute_write_fn = execute_write_fn
+    actor = {"id": "sam", "is_staff": True, "is_admin": True, "department": "sales"}
+    await update_dynamic_groups(datasette, actor, skip_cache=True)
+    assert len(write_calls) == 1
+    assert {
+        row["name"]
+        for row in await db.execute(
+            """
+            select acl_groups.name from acl_actor_groups
+            join acl_groups on acl_groups.id = acl_actor_groups.group_id
+            where actor_id = 'sam'
+            """
+        )
+    } == {"staff", "admin", "sales"}
+    assert (
+        await db.execute(
+            "select count(*) from acl_groups_audit where operation = 'added'"
+        )
+    ).single_value() == 3
+    # No changes means no writes at all
+    await update_dynamic_groups(datasette, actor, skip_cache=True)
+    assert len(write_calls) == 1
+    # Leaving two groups is also a single write
+    await update_dynamic_groups(
+        datasette, {"id": "sam", "is_staff": True}, skip_cache=True
+    )
+    assert len(write_calls) == 2
+    assert (
+        await db.execute(
+            "select count(*) from acl_groups_audit where operation = 'removed'"
+        )
+    ).single_value() == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_index", (True, False))
+@pytest.mark.parametrize("mode", ("virtual", "virtual-audited"))
+async def test_virtual_dynamic_groups(ds, csrftoken, mode, use_index):
+    ds.config["plugins"]["datasette-acl"]["dynamic-groups-mode"] = mode
+    ds.config["plugins"]["datasette-acl"]["permission-index"] = use_index
+    internal_db = ds.get_internal_database()
+    await ds.client.post(
+        "/db/t/-/acl",
+        data={"group_permissions_staff": "insert-row", "csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    # A stale stored membership from before should be ignored
+    await internal_db.execute_write(
+        """
+        insert into acl_actor_groups (actor_id, group_id)
+        values ('former', (select id from acl_groups where name = 'staff'))
+        """
+    )
+    assert await ds.permission_allowed(
+        {"id": "simon", "is_staff": True}, "insert-row", ["db", "t"]
+    )
+    # Let any background work finish
+    await asyncio.gather(*_background_tasks)
+    assert not await ds.permission_allowed(
+        {"id": "former", "is_staff": False}, "insert-row", ["db", "t"]
+    )
+    await asyncio.gather(*_background_tasks)
+    members = {
+        row["actor_id"]
+        for row in await internal_db.execute(
+            """
+            select actor_id from acl_actor_groups
+            where group_id = (select id from acl_groups where name = 'staff')
+            """
+        )
+    }
+    if mode == "virtual":
+        # Nothing should have been written
+        assert members == {"former"}
+    else:
+        # Changes were recorded in the background
+        assert members == {"simon"}
+        audit_rows = {
+            (row["operation"], row["actor_id"])
+            for row in await internal_db.execute(
+                "select operation, actor_id from acl_groups_audit"
+            )
+        }
+        assert audit_rows == {("added", "simon"), ("removed", "former")}
+
+
+@pytest.mark.asyncio
+async def test_update_dynamic_groups_fingerprint_cache():
+    datasette = Datasette(
+        config={
+            "plugins": {
+                "datasette-acl": {
+                    "dynamic-groups": {"staff": {"is_staff": True}},
+                }
+            }
+        }
+    )
+    await datasette.invoke_startup()
+    db = datasette.get_internal_database()
+    original_execute = db.execute
+    queries = []
+
+    async def execute(sql, *args, **kwargs):
+        queries.append(sql)
+        return await original_execute(sql, *args, **kwargs)
+
+    db.execute = execute
+
+    async def staff_members():
+        return [
+            row["actor_id"]
+            for row in await original_execute("select actor_id from acl_actor_groups")
+        ]
+
+    actor = {"id": "sam", "is_staff": True}
+    await update_dynamic_groups(datasette, actor)
+    assert len(queries) == 1
+    assert await staff_members() == ["sam"]
+    # Same actor again, even as a different dictionary, runs no SQL
+    await update_dynamic_groups(datasette, {"is_staff": True, "id": "sam"})
+    assert len(queries) == 1
+    # Changing an attribute takes effect immediately
+    await update_dynamic_groups(datasette, {"id": "sam", "is_staff": False})
+    assert len(queries) == 2
+    assert await staff_members() == []
+
+
+@pytest.mark.asyncio
+async def test_manage_table_permissions_single_transaction(ds, csrftoken):
+    internal_db = ds.get_internal_database()
+    await internal_db.execute_write_many(
+        "insert into acl_groups (name) values (:name)",
+        [{"name": f"group{i}"} for i in range(20)],
+    )
+    original_execute_write_fn = internal_db.execute_write_fn
+    write_calls = []
+
+    async def execute_write_fn(fn, *args, **kwargs):
+        write_calls.append(fn)
+        return await original_execute_write_fn(fn, *args, **kwargs)
+
+    internal_db.execute_write_fn = execute_write_fn
+    post_data = {
+        f"group_permissions_group{i}": ["insert-row", "update-row"] for i in range(20)
+    }
+    response = await ds.client.post(
+        "/db/t/-/acl",
+        data={
+            **post_data,
+            "new_actor_id": "newbie",
+            "new_user_actions": ["drop-table"],
+            "csrftoken": csrftoken,
+        },
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    assert response.status_code == 302
+    # The resource and all 41 changes are written in one transaction
+    assert len(write_calls) == 1
+    assert (await internal_db.execute("select count(*) from acl")).single_value() == 41
+    assert (
+        await internal_db.execute("select count(*) from acl_audit")
+    ).single_value() == 41
+    assert await ds.permission_allowed({"id": "newbie"}, "drop-table", ["db", "t"])
+
+
+@pytest.mark.asyncio
+async def test_table_audit_log_pagination(ds):
+    internal_db = ds.get_internal_database()
+    cookies = {"ds_actor": ds.client.actor_cookie({"id": "root"})}
+    # Before any permissions have been edited
+    data = (await ds.client.get("/db/t/-/acl/audit.json", cookies=cookies)).json()
+    assert data == {"audit_log": [], "next": None, "next_url": None}
+
+    await internal_db.execute_write(
+        "insert into acl_resources (database, resource) values ('db', 't')"
+    )
+    await internal_db.execute_write_many(
+        """
+        insert into acl_audit (operation_by, operation, action_id, resource_id, actor_id)
+        values (
+            'root', 'added', (select id from acl_actions where name = 'insert-row'),
+            (select id from acl_resources where database = 'db' and resource = 't'),
+            ?
+        )
+        """,
+        [("user{}".format(i),) for i in range(60)],
+    )
+    data = (await ds.client.get("/db/t/-/acl/audit.json", cookies=cookies)).json()
+    assert len(data["audit_log"]) == 50
+    assert data["audit_log"][0]["actor_id"] == "user59"
+    assert data["audit_log"][0]["action_name"] == "insert-row"
+    data2 = (await ds.client.get(data["next_url"], cookies=cookies)).json()
+    assert [row["actor_id"] for row in data2["audit_log"]] == [
+        "user{}".format(i) for i in reversed(range(10))
+    ]
+    assert data2["next"] is None
+
+    page = await ds.client.get("/db/t/-/acl", cookies=cookies)
+    assert "?_next={}".format(data["next"]) in page.text
@@ -0,0 +1,113 @@
+from datasette_acl.utils import _background_tasks
+from datasette_acl.write_queue import get_write_queue
+import asyncio
+import pytest
+
+AUDIT_SQL = """
+insert into acl_groups_audit (operation_by, operation, group_id, actor_id)
+values (:operation_by, 'added', (select id from acl_groups where name = 'dev'), :actor_id)
+"""
+
+
+@pytest.mark.asyncio
+async def test_dynamic_group_changes_are_batched(ds, csrftoken):
+    ds.config["plugins"]["datasette-acl"]["dynamic-groups-mode"] = "virtual-audited"
+    internal_db = ds.get_internal_database()
+    # Checks for tables without any permissions never sync dynamic groups
+    await ds.client.post(
+        "/db/t/-/acl",
+        data={"group_permissions_staff": "insert-row", "csrftoken": csrftoken},
+        cookies={
+            "ds_actor": ds.client.actor_cookie({"id": "root"}),
+            "ds_csrftoken": csrftoken,
+        },
+    )
+    write_calls = []
+    original_execute_write_fn = internal_db.execute_write_fn
+
+    async def counting_execute_write_fn(fn, *args, **kwargs):
+        write_calls.append(fn)
+        return await original_execute_write_fn(fn, *args, **kwargs)
+
+    internal_db.execute_write_fn = counting_execute_write_fn
+    try:
+        await asyncio.gather(
+            *[
+                ds.permission_allowed(
+                    {"id": "staff{}".format(i), "is_staff": True},
+                    "insert-row",
+                    ("db", "t"),
+                )
+                for i in range(20)
+            ]
+        )
+        await asyncio.gather(*_background_tasks)
+    finally:
+        internal_db.execute_write_fn = original_execute_write_fn
+    # All twenty actors were written in a single transaction
+    assert len(write_calls) == 1
+    assert get_write_queue(ds).flushes == 1
+    members = await internal_db.execute(
+        """
+        select actor_id from acl_actor_groups
+        where group_id = (select id from acl_groups where name = 'staff')
+        """
+    )
+    assert len(members.rows) == 20
+    audit = await internal_db.execute(
+        "select count(*) from acl_groups_audit where operation = 'added'"
+    )
+    assert audit.single_value() == 20
+
+
+@pytest.mark.asyncio
+async def test_write_queue_flushes_at_size(ds):
+    queue = get_write_queue(ds)
+    queue.interval = 60
+    queue.size = 3
+    futures = [
+        queue.submit(
+            lambda conn, i=i: (i, [(AUDIT_SQL, {"operation_by": "root", "actor_id": i})])
+        )
+        for i in range(3)
+    ]
+    assert await asyncio.gather(*futures) == [0, 1, 2]
+    assert queue.flushes == 1
+
+
+@pytest.mark.asyncio
+async def test_write_queue_failure_is_isolated(ds):
+    queue = get_write_queue(ds)
+
+    def fail(conn):
+        conn.execute("insert into no_such_table values (1)")
+
+    good = queue.submit(
+        lambda conn: ("ok", [(AUDIT_SQL, {"operation_by": "root", "actor_id": "a"})])
+    )
+    bad = queue.submit(fail)
+    assert await good == "ok"
+    with pytest.raises(Exception):
+        await bad
+
+
+@pytest.mark.asyncio
+async def test_write_queue_flushed_on_shutdown(ds):
+    queue = get_write_queue(ds)
+    queue.interval = 60
+    future = queue.submit(
+        lambda conn: ("done", [(AUDIT_SQL, {"operation_by": "root", "actor_id": "b"})])
+    )
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    await ds.app()({"type": "lifespan"}, receive, send)
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+    assert future.done()
+    assert future.result() == "done"